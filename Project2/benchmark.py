@@ -0,0 +1,242 @@
+import sys
+import os
+import argparse
+import json
+import time
+import shutil
+import tempfile
+import subprocess
+import numpy
+
+# Import the pipeline being measured
+from find_ORF import *
+from find_ORF import _encode_codons, _find_stops, _merge_ORFs
+
+# Peak memory is only available on Unix
+try:
+    import resource
+except ImportError:
+    resource = None
+
+"""
+Fraction of bases that are randomly replaced in each copy of a synthetic genome
+Keeps the copies from being identical while preserving the ORF structure
+"""
+MUTATION_RATE = 0.01
+
+"""
+Seed of the random number generator used for synthetic genomes
+"""
+SYNTHETIC_SEED = 427
+
+"""
+Number of bases in a megabase
+"""
+MEGABASE = 1000000
+
+def _peak_rss():
+    """
+    Returns the peak resident memory of this process in kilobytes
+        or None if the platform does not report it
+    """
+
+    if resource is None:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # Mac OS reports bytes instead of kilobytes
+    if sys.platform == 'darwin':
+        peak /= 1024
+    return peak
+
+def _commit():
+    """
+    Returns the git commit of the working tree or None if unknown
+    """
+
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def make_synthetic_genome(sequence, length, seed=SYNTHETIC_SEED):
+    """
+    Tiles the processed sequence up to the given length
+        and mutates MUTATION_RATE of the bases at random
+    The same seed always returns the same genome
+    """
+
+    random = numpy.random.RandomState(seed)
+    bases = numpy.frombuffer(sequence, dtype=numpy.uint8)
+    bases = numpy.resize(bases, length)
+
+    mutations = random.randint(0, length, int(length * MUTATION_RATE))
+    alphabet = numpy.frombuffer(''.join(NUCLEOTIDES), dtype=numpy.uint8)
+    bases[mutations] = alphabet[random.randint(0, len(NUCLEOTIDES), len(mutations))]
+
+    return bases.tostring()
+
+def run_phases(label, text, annotations, results):
+    """
+    Runs each phase of find_ORF.py on the raw FASTA text
+    Appends one result per phase containing:
+        the wall time in seconds,
+        the peak resident memory of the process so far,
+        and how much that peak grew during the phase
+    The phases are named after the functions of find_ORF.py they originally timed
+        so that results stay comparable with those of earlier runs
+    Returns a tuple of (processed sequence, ORFs, log ratios) for checking against a reference
+    """
+
+    def measure(phase, function, *args):
+        before = _peak_rss()
+        startTime = time.time()
+        value = function(*args)
+        elapsed = time.time() - startTime
+        after = _peak_rss()
+
+        results.append({
+            'genome': label,
+            'phase': phase,
+            'seconds': elapsed,
+            'peak_rss_kb': after,
+            'peak_rss_growth_kb': None if after is None else after - before
+        })
+        print >> sys.stderr, '%s %s: %f seconds' % (label, phase, elapsed)
+        return value
+
+    sequence = measure('process_fasta', process_fasta, text)
+    codons = measure('_encode_codons', _encode_codons, sequence)
+    stops = measure('_find_stops', _find_stops, codons)
+
+    ORFs = measure('_find_ORFs_offset', _merge_ORFs, stops)
+    gene_probs, not_gene_probs = measure('_compute_markov_chain', compute_markov_chains, sequence, ORFs)
+
+    ratios = measure('_calculate_log_ratio', calculate_log_ratios,
+            sequence, ORFs, gene_probs, not_gene_probs)
+
+    # The histogram is written into a scratch directory and the table is discarded
+    def output_histogram():
+        directory = tempfile.mkdtemp()
+        cwd = os.getcwd()
+        stdout = sys.stdout
+        try:
+            os.chdir(directory)
+            sys.stdout = open(os.devnull, 'w')
+            compare_ORFs(ORFs, ratios, annotations, True)
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+            os.chdir(cwd)
+            shutil.rmtree(directory)
+    measure('histogram', output_histogram)
+
+    return sequence, ORFs, ratios
+
+def check_reference(filename, label, sequence, ORFs, ratios):
+    """
+    Compares the ORFs and log ratios against those saved in the reference file
+        Labels missing from the reference are added to it, as computed by the pipeline of find_ORF.py
+        (find_ORFs, compute_markov_chains, and calculate_log_ratios) on the processed sequence
+    Returns True if the outputs match
+    """
+
+    reference = {}
+    if os.path.exists(filename):
+        with numpy.load(filename) as saved:
+            reference = dict(saved.items())
+
+    if label + '-ORFs' not in reference:
+        expectedORFs = find_ORFs(sequence)
+        gene_probs, not_gene_probs = compute_markov_chains(sequence, expectedORFs)
+        reference[label + '-ORFs'] = numpy.array(expectedORFs, dtype=int).reshape((-1, 2))
+        reference[label + '-ratios'] = numpy.array(
+                calculate_log_ratios(sequence, expectedORFs, gene_probs, not_gene_probs))
+        with open(filename, 'wb') as f:
+            numpy.savez(f, **reference)
+        print >> sys.stderr, '%s: saved the output of find_ORF.py as the reference' % label
+
+    ORFs = numpy.array(ORFs, dtype=int).reshape((-1, 2))
+    ratios = numpy.array(ratios)
+
+    matches = numpy.array_equal(ORFs, reference[label + '-ORFs']) \
+        and numpy.allclose(ratios, reference[label + '-ratios'])
+    print >> sys.stderr, '%s: %s the reference' % (label, 'matches' if matches else 'DOES NOT MATCH')
+    return matches
+
+def compare_results(previous, current):
+    """
+    Prints the speedup of each phase relative to a previous set of results
+    """
+
+    seconds = {}
+    for result in previous['results']:
+        seconds[(result['genome'], result['phase'])] = result['seconds']
+
+    print 'Compared to commit %s:' % previous.get('commit')
+    for result in current['results']:
+        key = (result['genome'], result['phase'])
+        if key in seconds and result['seconds'] > 0:
+            print '%s %s: %f -> %f seconds (%.2fx)' % (key[0], key[1],
+                    seconds[key], result['seconds'], seconds[key] / result['seconds'])
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+            description='Times each phase of find_ORF.py on the given sequence and on synthetic genomes built from it')
+    parser.add_argument('sequence', type=str, help='A FASTA sequence, i.e. NC_000909.fna')
+    parser.add_argument('--annotations', type=str, required=False,
+        help='GeneBank annotations of the given sequence; synthetic genomes are never annotated')
+    parser.add_argument('--synthetic', type=int, nargs='*', default=[],
+        help='Sizes (in megabases) of the synthetic genomes to time, i.e. 10 100')
+    parser.add_argument('--output', type=str, required=False,
+        help='File to save the JSON results, otherwise they are printed')
+    parser.add_argument('--compare', type=str, required=False,
+        help='JSON results of a previous run to compare against')
+    parser.add_argument('--reference', type=str, required=False,
+        help='NumPy archive of the expected ORFs and log ratios; created from the output of find_ORF.py if it does not exist')
+    args = parser.parse_args()
+
+    # Read the sequence in as a string
+    assert os.path.splitext(args.sequence)[1] == FASTA, 'Unknown sequence file format'
+    with open(args.sequence) as f:
+        text = f.read().strip()
+
+    annotations = AnnotationIndex([])
+    if args.annotations is not None:
+        assert os.path.splitext(args.annotations)[1] == GENEBANK, 'Unknown genebank file format'
+        with open(args.annotations) as f:
+            annotations = process_genebank(f)
+
+    # Time the real genome, then the synthetic ones
+    genomes = [(os.path.splitext(os.path.basename(args.sequence))[0], text, annotations)]
+    for size in args.synthetic:
+        synthetic = make_synthetic_genome(process_fasta(text), size * MEGABASE)
+        genomes.append(('synthetic-%dMb' % size, '>synthetic\n' + synthetic, AnnotationIndex([])))
+
+    results = {
+        'commit': _commit(),
+        'python': sys.version.split()[0],
+        'numpy': numpy.__version__,
+        'results': []
+    }
+    matches = True
+    for label, genome, index in genomes:
+        sequence, ORFs, ratios = run_phases(label, genome, index, results['results'])
+        if args.reference is not None:
+            matches = check_reference(args.reference, label, sequence, ORFs, ratios) and matches
+
+    # Save or print the results
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        print json.dumps(results, indent=2)
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            compare_results(json.load(f), results)
+
+    if not matches:
+        exit(1)
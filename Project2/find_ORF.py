@@ -2,9 +2,13 @@ import sys
 import os
 import argparse
 import re
+import numpy
 
 from math import log
 
+# Import the GenBank feature parser
+from genebank import *
+
 """
 File extension that triggers some additional processing
 Lines starting with '>' are removed
@@ -14,7 +18,7 @@ FASTA = '.fna'
 
 """
 File extension that triggers some additional processing
-All lines that do not start with 'CDS' are removed
+Only the coding sequences of the feature table are kept
 """
 GENEBANK = '.gbk'
 
@@ -39,11 +43,44 @@ the probability of starting with the given key
 """
 START = 'START'
 
+"""
+Default number of bases scored by each window of the coding potential track
+"""
+TRACK_WINDOW = 96
+
+"""
+File extension that saves the coding potential track as a binary NumPy archive
+Any other extension saves the track as a bedGraph
+"""
+TRACK_BINARY = '.npz'
+
+"""
+Names of the six reading frames of the coding potential track
+"""
+TRACK_FRAMES = ['+1', '+2', '+3', '-1', '-2', '-3']
+
 """
 The four possible nucleotides
 """
 NUCLEOTIDES = ['A', 'C', 'G', 'T']
 
+"""
+Codons that end an open reading frame
+"""
+STOP_CODONS = ['TAA', 'TAG', 'TGA']
+
+"""
+Codons that can start a gene
+"""
+START_CODONS = ['ATG', 'GTG', 'TTG']
+
+"""
+Maps each byte of a processed sequence to its index in NUCLEOTIDES
+"""
+NUCLEOTIDE_CODES = numpy.zeros(256, dtype=numpy.int8)
+for code, base in enumerate(NUCLEOTIDES):
+    NUCLEOTIDE_CODES[ord(base)] = code
+
 def process_fasta(text):
     """
     Removes the comments and whitespace
@@ -58,77 +95,125 @@ def process_fasta(text):
     text = text.upper()
     return re.sub(r'[^ACGT]', 'T', text)
 
-def process_genebank(text):
-    """Extracts all coding sequences from the genebank file"""
-
-    lines = text.split('\n')
-    lines = [line.strip() for line in lines]
-    lines = filter(lambda x: x.startswith('CDS'), lines)
+def process_genebank(file):
+    """
+    Streams all coding sequences out of the genebank file
+    Returns an AnnotationIndex over the coding sequences
+    """
 
     # Ignore complementary strands as per the assignment
-    lines = filter(lambda x: "complement" not in x, lines)
+    return AnnotationIndex(filter(lambda x: x.strand == FORWARD_STRAND,
+                                  genebank_features(file)))
+
+def _encode_codon(codon):
+    """
+    Helper for _encode_codons
+    Returns the integer code of a single three letter codon
+    """
+
+    return sum(NUCLEOTIDES.index(codon[index]) * 4 ** (2 - index) for index in range(3))
 
-    # Extract the coding sequence indices
-    regex = re.compile('(\d*)\.\.(\d*)')
-    ORFs = [regex.search(line).groups() for line in lines]
+def _encode_codons(sequence):
+    """
+    Helper for find_ORFs
+    Encodes the codon starting at every index of the sequence as an integer
+    The returned array is two shorter than the sequence
+    """
+
+    bases = NUCLEOTIDE_CODES.take(numpy.frombuffer(sequence, dtype=numpy.uint8))
+    return 16 * bases[:-2] + 4 * bases[1:-1] + bases[2:]
+
+def _find_codons(codons, targets):
+    """
+    Helper for find_ORFs
+    Returns the indices of all codons in the list of targets
+    The returned array is in ascending order
+    """
 
-    # Transform the sequences to integers and 0-based indices
-    return [(int(ORF[0]) - 1, int(ORF[1]) - 1) for ORF in ORFs]
+    return numpy.flatnonzero(numpy.in1d(codons, [_encode_codon(codon) for codon in targets]))
 
-def _find_stops(sequence):
+def _find_stops(codons):
     """
     Helper for find_ORFs
     Returns the indices of all stop codons TAA, TAG, or TGA
-    The returned list is in ascending order
+    The returned array is in ascending order
     """
 
-    matches = []
-    regex = re.compile('(TAA|TAG|TGA)')
-    match = regex.search(sequence)
-    while (match is not None):
-        index = match.start()
-        matches.append(index)
-        match = regex.search(sequence, index + 1)
+    return _find_codons(codons, STOP_CODONS)
+
+def _find_starts(codons):
+    """
+    Helper for find_ORFs
+    Returns the indices of all start codons ATG, GTG, or TTG
+    The returned array is in ascending order
+    """
 
-    # This should already be in ascending order
-    matches.sort()
-    return matches
+    return _find_codons(codons, START_CODONS)
 
-def _find_ORFs_offset(stops, offset):
+def _find_ORFs_offset(stops, offset, starts=None):
     """
     Helper for find_ORFs
-    Takes a list of stop codon positions
-    Returns a list of the open reading frames
-        starting at some offset
+    Takes an array of stop codon positions
+    Returns a tuple of arrays (start indices, end indices)
+        of the open reading frames starting at some offset
+    If an array of start codon positions is given,
+        each ORF is trimmed to its first in-frame start codon
+        and ORFs without one are dropped
     See find_ORFs for the return format
     """
 
     # Filter out other offsets and adjacent stops
-    stops = filter(lambda x: (x % 3) == offset, stops)
-    stops = [stops[0]] + map(lambda x: stops[x],
-                    filter(lambda x: (stops[x] - 3) != stops[x - 1],
-                            range(1, len(stops))))
-    return map(lambda x: (offset, stops[x]) if x == 0 else (stops[x - 1] + 3, stops[x]),
-                range(len(stops)))
+    stops = stops[stops % 3 == offset]
+    if len(stops) == 0:
+        return numpy.array([], dtype=int), numpy.array([], dtype=int)
+    stops = stops[numpy.concatenate(([True], numpy.diff(stops) != 3))]
+    begins = numpy.concatenate(([offset], stops[:-1] + 3))
+
+    if starts is not None:
+        # The first start codon at or after the beginning of each ORF
+        starts = starts[starts % 3 == offset]
+        starts = numpy.append(starts, numpy.iinfo(starts.dtype).max)
+        begins = starts[numpy.searchsorted(starts, begins)]
+
+        # Which must still come before the stop codon
+        keep = begins < stops
+        begins = begins[keep]
+        stops = stops[keep]
+
+    return begins, stops
+
+def _merge_ORFs(stops, starts=None):
+    """
+    Helper for find_ORFs
+    Finds the open reading frames at every offset (see _find_ORFs_offset)
+        and merges them in order of their start index
+    See find_ORFs for the return format
+    """
+
+    begins, ends = zip(*[_find_ORFs_offset(stops, offset, starts) for offset in range(3)])
+    begins = numpy.concatenate(begins)
+    ends = numpy.concatenate(ends)
+    order = numpy.argsort(begins, kind='mergesort')
 
-def find_ORFs(sequence):
+    return zip(begins[order].tolist(), ends[order].tolist())
+
+def find_ORFs(sequence, trim_starts=False):
     """
     Returns a sorted list of the open reading frames
         Tuple format: (start index, end index)
         The end excludes the stop codon
+    If trim_starts is set, each ORF begins at its first in-frame start codon
     """
 
-    stops = _find_stops(sequence)
-    ORFs =        _find_ORFs_offset(stops, 0)
-    ORFs = ORFs + _find_ORFs_offset(stops, 1)
-    ORFs = ORFs + _find_ORFs_offset(stops, 2)
-    ORFs.sort(key=lambda x: x[0])
+    codons = _encode_codons(sequence)
+    stops = _find_stops(codons)
+    starts = _find_starts(codons) if trim_starts else None
 
-    return ORFs
+    return _merge_ORFs(stops, starts)
 
 def _compute_markov_chain(sequence, ORFs, degree):
     """
-    Helper for compare_ORFs
+    Helper for compute_markov_chains
     Looks up the ORFs in the sequence
         and calculates the posterior transition probabilities of each state
     The degree determines the total number of possible states
@@ -185,7 +270,7 @@ def _compute_markov_chain(sequence, ORFs, degree):
     
 def _calculate_log_ratio(sequence, gene_probs, not_gene_probs):
     """
-    Helper for compare_ORFs
+    Helper for calculate_log_ratios
     Takes a sequence and two Markov chain probability matrices
         and calculates the log ratio of probabilities
     """
@@ -208,17 +293,13 @@ def _calculate_log_ratio(sequence, gene_probs, not_gene_probs):
     
     return ratio
 
-def compare_ORFs(sequence, ORFs, annotations, output_LaTeX):
+def compute_markov_chains(sequence, ORFs):
     """
-    Declares an ORF to be a "gene"
-        iff the stop index matches a stop index of an annotation
-    Also declares an ORF to be a "gene" based on Markov chains
-    Prints out how many ORFs of a given length are and are not "genes"
-        and the average log ratio of Markov chain probabilities
-        and the number of ORFs with positive log ratios
+    Trains the "gene" and "not gene" Markov chains
+        on the longest and shortest ORFs respectively
+    See _compute_markov_chain for the format of each chain
     """
-    
-    # Calculate the Markov chain probabilities
+
     gene_probs = _compute_markov_chain(sequence,
             filter(lambda x: (x[1] - x[0]) > GENE_THRESHOLD, ORFs),
             MARKOV_CHAIN_DEGREE)
@@ -226,13 +307,131 @@ def compare_ORFs(sequence, ORFs, annotations, output_LaTeX):
             filter(lambda x: (x[1] - x[0]) < NOT_GENE_THRESHOLD, ORFs),
             MARKOV_CHAIN_DEGREE)
 
-    # Extract all the stop codons within the annotated genes
-    annot_stops = set()
-    for annot in annotations:
-        stops = _find_stops(sequence[annot[0]:(annot[1] + 3)])
-        stops = [annot[0] + stop for stop in stops]
-        annot_stops = annot_stops.union(stops)
+    return gene_probs, not_gene_probs
+
+def _tabulate_log_ratio(gene_probs, not_gene_probs):
+    """
+    Helper for compute_coding_track
+    Flattens two Markov chain probability matrices into arrays of log ratios
+        indexed by the encoded key (and the encoded next base)
+    Returns a tuple of (start log ratios, transition log ratios)
+    """
+
+    degree = len(gene_probs.keys()[0])
+    starts = numpy.zeros(len(NUCLEOTIDES) ** degree)
+    transitions = numpy.zeros((len(NUCLEOTIDES) ** degree, len(NUCLEOTIDES)))
+    for key in gene_probs:
+        code = 0
+        for base in key:
+            code = code * len(NUCLEOTIDES) + NUCLEOTIDES.index(base)
+        starts[code] = gene_probs[key][START] - not_gene_probs[key][START]
+        for next in range(len(NUCLEOTIDES)):
+            base = NUCLEOTIDES[next]
+            transitions[code, next] = gene_probs[key][base] - not_gene_probs[key][base]
+
+    return starts, transitions
+
+def _window_log_ratios(bases, starts, transitions, degree, window):
+    """
+    Helper for compute_coding_track
+    Takes an encoded sequence and the tabulated log ratios
+    Returns the log ratio of every window of the given size
+        Entry i equals _calculate_log_ratio(sequence[i:(i + window)], ...)
+        A sequence shorter than the window has none
+    """
+
+    if len(bases) < window:
+        return numpy.zeros(0)
+
+    # Encode the key starting at every index
+    keys = numpy.zeros(len(bases) - degree + 1, dtype=int)
+    for offset in range(degree):
+        keys = keys * len(NUCLEOTIDES) + bases[offset:(len(bases) - degree + 1 + offset)]
+
+    # Score every transition once (note the same skipped base as _calculate_log_ratio)
+    #   and turn the windowed sums into differences of a cumulative sum
+    scores = transitions[keys[:(len(bases) - degree - 1)], bases[(degree + 1):]]
+    cumulative = numpy.concatenate(([0], numpy.cumsum(scores)))
+
+    count = len(bases) - window + 1
+    inside = window - degree - 1
+    return starts[keys[:count]] + cumulative[inside:(inside + count)] - cumulative[:count]
+
+def compute_coding_track(sequence, gene_probs, not_gene_probs, window):
+    """
+    Calculates the log ratio of the two Markov chains
+        over every window of the given size in all six reading frames
+    Runs in time linear to the length of the sequence
+    Returns a list of arrays in the order of TRACK_FRAMES
+        Entry i of a frame belongs to the i-th window in that frame,
+        i.e. the window starting 3 * i + (frame offset) bases
+        from the 5' end of its strand
+        The arrays are empty if the sequence is shorter than the window
+    """
 
+    degree = len(gene_probs.keys()[0])
+    assert window > degree + 1, 'Windows must be longer than %d bases' % (degree + 1)
+    starts, transitions = _tabulate_log_ratio(gene_probs, not_gene_probs)
+
+    # Complementing an encoded base is the same as subtracting it from 3
+    bases = NUCLEOTIDE_CODES.take(numpy.frombuffer(sequence, dtype=numpy.uint8)).astype(int)
+    forward = _window_log_ratios(bases, starts, transitions, degree, window)
+    reverse = _window_log_ratios(3 - bases[::-1], starts, transitions, degree, window)
+
+    return [forward[offset::3] for offset in range(3)] \
+         + [reverse[offset::3] for offset in range(3)]
+
+def write_coding_track(filename, name, track, window):
+    """
+    Saves the output of compute_coding_track
+    With the TRACK_BINARY extension, each frame is saved as a float32 array
+    Otherwise, each frame is written as a bedGraph track
+        where each score covers the first codon of its window
+        in the coordinates of the given sequence, in order of those coordinates
+    """
+
+    if os.path.splitext(filename)[1] == TRACK_BINARY:
+        frames = dict([(TRACK_FRAMES[index], track[index].astype(numpy.float32))
+                       for index in range(len(TRACK_FRAMES))])
+        numpy.savez(filename, window=window, **frames)
+        return
+
+    length = len(track[0]) + len(track[1]) + len(track[2]) + window - 1
+    with open(filename, 'w') as file:
+        for index in range(len(TRACK_FRAMES)):
+            file.write('track type=bedGraph name="%s %s" description="Window of %d bases"\n'
+                    % (name, TRACK_FRAMES[index], window))
+
+            # Reverse frames count from the other end of the sequence
+            #   so their rows are written backwards to keep the starts in order
+            starts = numpy.arange(len(track[index])) * 3 + index % 3
+            scores = track[index]
+            if index >= 3:
+                starts = (length - starts - 3)[::-1]
+                scores = scores[::-1]
+            file.writelines(['%s\t%d\t%d\t%.4f\n' % (name, start, start + 3, score)
+                             for start, score in zip(starts.tolist(), scores.tolist())])
+
+def calculate_log_ratios(sequence, ORFs, gene_probs, not_gene_probs):
+    """
+    Returns the log ratio of the two Markov chains for each ORF
+    See _calculate_log_ratio
+    """
+
+    return [_calculate_log_ratio(sequence[ORF[0]:ORF[1]], gene_probs, not_gene_probs)
+            for ORF in ORFs]
+
+def compare_ORFs(ORFs, ratios, annotations, output_LaTeX):
+    """
+    Takes the ORFs and their Markov chain log ratios
+    Declares an ORF to be a "gene"
+        iff the stop index matches a stop index of an annotation
+    Also declares an ORF to be a "gene" based on Markov chains
+    Prints out how many ORFs of a given length are and are not "genes"
+        and the average log ratio of Markov chain probabilities
+        and the number of ORFs with positive log ratios
+    """
+    
     # Store the comparison in a map from ORF length to a hash
     comparison = {}
     SIMPLE_GENE = 'SIMPLE_GENE'
@@ -241,7 +440,7 @@ def compare_ORFs(sequence, ORFs, annotations, output_LaTeX):
     POSITIVE_LOG_RATIO = 'POSITIVE_LOG_RATIO'
     POSITIVE_HIT = 'POSITIVE_HIT'
 
-    for ORF in ORFs:
+    for ORF, ratio in zip(ORFs, ratios):
         length = ORF[1] - ORF[0]
         if length not in comparison:
             comparison[length] = {SIMPLE_GENE:0, 
@@ -251,17 +450,18 @@ def compare_ORFs(sequence, ORFs, annotations, output_LaTeX):
                                   POSITIVE_HIT:0}
 
         # Increment the counts for the simple heuristic
-        if ORF[1] in annot_stops:
+        # An ORF matches if its stop codon starts within an annotated gene
+        match = annotations.covers(ORF[1])
+        if match:
             comparison[length][SIMPLE_GENE] += 1
         else:
             comparison[length][NOT_SIMPLE_GENE] += 1
             
         # Update the values for the Markov heuristic
-        ratio = _calculate_log_ratio(sequence[ORF[0]:ORF[1]], gene_probs, not_gene_probs)
         comparison[length][AVERAGE_LOG_RATIO] += ratio
         if ratio > 0:
             comparison[length][POSITIVE_LOG_RATIO] += 1
-            if ORF[1] in annot_stops:
+            if match:
                 comparison[length][POSITIVE_HIT] += 1
     
     # Average out the AVERAGE_LOG_RATIO field
@@ -313,16 +513,18 @@ if __name__ == '__main__':
     parser.add_argument('sequence', type=str)
     parser.add_argument('annotations', type=str)
     parser.add_argument('--LaTeX', action='store_true')
+    parser.add_argument('--trim_starts', action='store_true',
+        help='Start each ORF at its first in-frame start codon?')
+    parser.add_argument('--track', type=str, required=False,
+        help='File to save the coding potential of every window in all six frames')
+    parser.add_argument('--window', type=int, default=TRACK_WINDOW,
+        help='Number of bases in each window of the coding potential track')
     args = parser.parse_args()
 
     # Read the sequence in as a string
     with open(args.sequence) as f:
         sequence = f.read().strip()
 
-    # Read the annotation information in as a string
-    with open(args.annotations) as f:
-        annotations = f.read().strip()
-
     # Handle sequence files
     if os.path.splitext(args.sequence)[1] == FASTA:
         sequence = process_fasta(sequence)
@@ -332,10 +534,20 @@ if __name__ == '__main__':
 
     # Handle GeneBank files
     if os.path.splitext(args.annotations)[1] == GENEBANK:
-        annotations = process_genebank(annotations)
+        with open(args.annotations) as f:
+            annotations = process_genebank(f)
     else:
         print 'Unknown genebank file format'
         exit()
 
-    ORFs = find_ORFs(sequence)
-    compare_ORFs(sequence, ORFs, annotations, args.LaTeX)
+    ORFs = find_ORFs(sequence, args.trim_starts)
+    gene_probs, not_gene_probs = compute_markov_chains(sequence, ORFs)
+    ratios = calculate_log_ratios(sequence, ORFs, gene_probs, not_gene_probs)
+    compare_ORFs(ORFs, ratios, annotations, args.LaTeX)
+
+    # Score the whole sequence with the same Markov chains
+    if args.track is not None:
+        track = compute_coding_track(sequence, gene_probs, not_gene_probs, args.window)
+        write_coding_track(args.track,
+                os.path.splitext(os.path.basename(args.sequence))[0],
+                track, args.window)
@@ -0,0 +1,200 @@
+import re
+
+from bisect import bisect_left, bisect_right
+from collections import namedtuple
+
+"""
+Feature key of the annotations that describe coding sequences
+"""
+CODING_SEQUENCE = 'CDS'
+
+"""
+Strand of a feature that is read along the given sequence
+"""
+FORWARD_STRAND = '+'
+
+"""
+Strand of a feature that is read along the complement of the given sequence
+"""
+REVERSE_STRAND = '-'
+
+"""
+Column at which the location of a feature starts in a GenBank feature table
+"""
+LOCATION_COLUMN = 21
+
+"""
+Usage: LOCATION_TOKEN_REGEX.findall(location)
+Tokenizes a feature location into operators, closing parentheses, and ranges
+"""
+LOCATION_TOKEN_REGEX = re.compile(r"(complement|join|order)\(|(\))|([^,()]+)")
+
+"""
+A single annotated feature
+    Strand is either FORWARD_STRAND or REVERSE_STRAND
+    Segments is a list of 0-based (inclusive start, exclusive end) tuples
+        in ascending order
+"""
+Feature = namedtuple('Feature', ['strand', 'segments'])
+
+def parse_location(location):
+    """
+    Parses a GenBank feature location such as:
+        '1..10', '<1..>10', 'complement(join(1..10,20..30))'
+    Fuzzy bounds are taken at face value
+    Remote references and between-base sites are ignored
+    Returns a Feature or None if the location has no usable segments
+    """
+
+    segments = []
+    complemented = []
+    stack = []
+    for operator, close, span in LOCATION_TOKEN_REGEX.findall(location.replace(' ', '')):
+        if operator:
+            stack.append(operator)
+        elif close:
+            stack.pop()
+
+        # Skip anything that does not refer to this sequence
+        elif ':' in span or '^' in span:
+            continue
+
+        else:
+            bounds = span.replace('<', '').replace('>', '').split('..')
+            start = int(bounds[0].split('.')[0])
+            end = int(bounds[-1].split('.')[-1])
+            segments.append((start - 1, end))
+            complemented.append(stack.count('complement') % 2 == 1)
+
+    if not segments:
+        return None
+
+    # Trans-spliced features may mix strands, in which case the forward strand wins
+    strand = REVERSE_STRAND if all(complemented) else FORWARD_STRAND
+    return Feature(strand, sorted(segments))
+
+def _feature_locations(file):
+    """
+    Helper for genebank_features
+    Streams the lines of a GenBank file
+    Yields a (key, location) tuple for every entry in the feature tables
+        Locations spanning several lines are joined back together
+    """
+
+    inFeatures = False
+    key = None
+    location = []
+    locationDone = True
+    for line in file:
+        line = line.rstrip('\r\n')
+
+        # Anything in the first column starts a new section (usually ORIGIN)
+        # Anything in the key column starts a new feature
+        if not line.startswith(' ') or line[:LOCATION_COLUMN].strip():
+            if key is not None:
+                yield key, ''.join(location)
+            key = None
+
+            if not line.startswith(' '):
+                inFeatures = line.startswith('FEATURES')
+            elif inFeatures:
+                key = line[:LOCATION_COLUMN].strip()
+                location = [line[LOCATION_COLUMN:].strip()]
+                locationDone = False
+            continue
+
+        # The location continues until the first qualifier
+        if key is not None and not locationDone:
+            text = line[LOCATION_COLUMN:].strip()
+            if text.startswith('/'):
+                locationDone = True
+            else:
+                location.append(text)
+
+    if key is not None:
+        yield key, ''.join(location)
+
+def genebank_features(file, key=CODING_SEQUENCE):
+    """
+    Streams the lines of a GenBank file
+    Yields a Feature for every entry in the feature tables with the given key
+    The sequence itself is never held in memory
+    """
+
+    for featureKey, location in _feature_locations(file):
+        if featureKey != key:
+            continue
+
+        feature = parse_location(location)
+        if feature is not None:
+            yield feature
+
+class AnnotationIndex(object):
+    """
+    Sorted interval index over the segments of a collection of features
+    Every query is a binary search, i.e. O(log n) plus the size of the result
+    """
+
+    def __init__(self, features):
+        self.features = list(features)
+
+        # Segments sorted by start, along with the feature they came from
+        segments = []
+        for index, feature in enumerate(self.features):
+            segments.extend([(segment[0], segment[1], index) for segment in feature.segments])
+        segments.sort()
+        self.starts = [segment[0] for segment in segments]
+        self.ends = [segment[1] for segment in segments]
+        self.owners = [segment[2] for segment in segments]
+
+        # The running maximum of the ends answers "is anything covering this?"
+        #   and the longest segment bounds how far back an overlap can start
+        self.maxEnds = []
+        self.maxLength = 0
+        for start, end in zip(self.starts, self.ends):
+            self.maxEnds.append(max(end, self.maxEnds[-1] if self.maxEnds else end))
+            self.maxLength = max(self.maxLength, end - start)
+
+        # Features sorted by their exclusive 3' end
+        threePrime = [(feature.segments[-1][1] if feature.strand == FORWARD_STRAND
+                            else feature.segments[0][0], index)
+                        for index, feature in enumerate(self.features)]
+        threePrime.sort()
+        self.threePrimeEnds = [item[0] for item in threePrime]
+        self.threePrimeOwners = [item[1] for item in threePrime]
+
+    def __len__(self):
+        return len(self.features)
+
+    def covers(self, position):
+        """
+        Returns True iff some segment contains the given 0-based position
+        """
+
+        index = bisect_right(self.starts, position) - 1
+        return index >= 0 and self.maxEnds[index] > position
+
+    def overlapping(self, start, end):
+        """
+        Returns the features with a segment overlapping
+            the 0-based (inclusive start, exclusive end) range
+        """
+
+        low = bisect_right(self.starts, start - self.maxLength)
+        high = bisect_left(self.starts, end)
+        owners = set()
+        for index in range(low, high):
+            if self.ends[index] > start:
+                owners.add(self.owners[index])
+        return [self.features[owner] for owner in sorted(owners)]
+
+    def ending_at(self, end):
+        """
+        Returns the features whose 3' end is at the given position
+            For forward strand features this is the exclusive end
+            For reverse strand features this is the inclusive start
+        """
+
+        low = bisect_left(self.threePrimeEnds, end)
+        high = bisect_right(self.threePrimeEnds, end)
+        return [self.features[self.threePrimeOwners[index]] for index in range(low, high)]
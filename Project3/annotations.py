@@ -0,0 +1,179 @@
+import re
+import numpy
+
+"""
+File extensions of the NCBI feature tables, i.e. NC_000909.rnt
+Each line after the header starts with a 1-based inclusive location, like '97429..97537'
+"""
+FEATURE_TABLES = ['.rnt', '.ptt']
+
+"""
+File extension of GenBank files
+"""
+GENEBANK = '.gbk'
+
+"""
+Feature keys read from GenBank files, matching the contents of an .rnt table
+"""
+RNA_FEATURES = ['rRNA', 'tRNA', 'ncRNA', 'tmRNA', 'misc_RNA']
+
+"""
+Column at which the location of a feature starts in a GenBank feature table
+"""
+LOCATION_COLUMN = 21
+
+"""
+Usage: LOCATION_REGEX.match(line)
+Matches the location at the start of a line of a feature table
+"""
+LOCATION_REGEX = re.compile(r"^\s*<?(\d+)\.\.>?(\d+)\s")
+
+def parse_feature_table(file):
+    """
+    Reads an NCBI feature table (see FEATURE_TABLES)
+    Returns a list of 0-based (inclusive start, exclusive end) tuples
+    """
+
+    features = []
+    for line in file:
+        match = LOCATION_REGEX.match(line)
+        if match is not None:
+            features.append((int(match.group(1)) - 1, int(match.group(2))))
+    return features
+
+def parse_genebank(file, keys=RNA_FEATURES):
+    """
+    Reads the features with the given keys from a GenBank file
+    Each feature spans from its first to its last base, including any introns
+    Returns a list of 0-based (inclusive start, exclusive end) tuples
+    """
+
+    features = []
+    inFeatures = False
+    location = None
+    for line in file:
+        line = line.rstrip('\r\n')
+
+        # Anything in the first column starts a new section (usually ORIGIN)
+        # Anything in the key column starts a new feature
+        if not line.startswith(' ') or line[:LOCATION_COLUMN].strip():
+            if location is not None:
+                features.append(_location_span(''.join(location)))
+            location = None
+
+            if not line.startswith(' '):
+                inFeatures = line.startswith('FEATURES')
+            elif inFeatures and line[:LOCATION_COLUMN].strip() in keys:
+                location = [line[LOCATION_COLUMN:].strip()]
+            continue
+
+        # The location continues until the first qualifier
+        if location is not None and not location[-1].startswith('/'):
+            location.append(line[LOCATION_COLUMN:].strip())
+
+    if location is not None:
+        features.append(_location_span(''.join(location)))
+
+    return [feature for feature in features if feature is not None]
+
+def _location_span(location):
+    """
+    Helper for parse_genebank
+    Returns the span of a GenBank location (before any qualifiers)
+        or None if it refers to another sequence
+    """
+
+    location = location.split('/')[0]
+    if ':' in location:
+        return None
+
+    bases = [int(number) for number in re.findall(r"\d+", location)]
+    if not bases:
+        return None
+    return min(bases) - 1, max(bases)
+
+def load_annotations(filename):
+    """
+    Reads the features of a feature table or GenBank file
+    Returns an IntervalIndex or None if the file format is unknown
+    """
+
+    extension = filename[filename.rfind('.'):]
+    with open(filename) as f:
+        if extension in FEATURE_TABLES:
+            return IntervalIndex(parse_feature_table(f))
+        if extension == GENEBANK:
+            return IntervalIndex(parse_genebank(f))
+    return None
+
+class IntervalIndex(object):
+    """
+    Sorted index over a set of (inclusive start, exclusive end) features
+        which may overlap each other
+    Compares sorted, disjoint hits against the features
+        in O((n + m) log m) for n hits and m features
+    """
+
+    def __init__(self, features):
+        features = numpy.array(sorted(features), dtype=int).reshape((-1, 2))
+        self.starts = features[:, 0]
+        self.ends = features[:, 1]
+
+        # Merge overlapping features, so each annotated base is counted once
+        # A feature starts a new merged interval if it starts after every end before it
+        reach = numpy.maximum.accumulate(self.ends)
+        first = numpy.ones(len(features), dtype=bool)
+        first[1:] = self.starts[1:] > reach[:-1]
+        self.merged_starts = self.starts[first]
+        self.merged_ends = reach[numpy.append(numpy.flatnonzero(first)[1:] - 1, len(features) - 1)] \
+            if len(features) > 0 else reach
+
+        # Number of annotated bases before each merged interval
+        self.covered = numpy.concatenate(([0], numpy.cumsum(self.merged_ends - self.merged_starts)))
+
+    def __len__(self):
+        return len(self.starts)
+
+    def annotated_before(self, positions):
+        """
+        Returns the number of annotated bases before each of the given positions
+        """
+
+        positions = numpy.asarray(positions)
+        if len(self.merged_starts) == 0:
+            return numpy.zeros(positions.shape, dtype=int)
+
+        index = numpy.searchsorted(self.merged_starts, positions, 'right') - 1
+        inside = numpy.minimum(positions, self.merged_ends[index]) - self.merged_starts[index]
+        return numpy.where(index >= 0, self.covered[numpy.maximum(index, 0)] + inside, 0)
+
+    def evaluate(self, hits):
+        """
+        Compares the sorted, disjoint (inclusive start, exclusive end) hits against the features
+        Returns a dictionary of:
+            features: the number of features
+            featuresHit: the number of features overlapped by a hit
+            hits: the number of hits
+            hitsAnnotated: the number of hits overlapping a feature
+            sensitivity: the fraction of annotated bases inside a hit
+            precision: the fraction of bases inside a hit that are annotated
+        """
+
+        hits = numpy.array(hits, dtype=int).reshape((-1, 2))
+        overlap = self.annotated_before(hits[:, 1]) - self.annotated_before(hits[:, 0])
+
+        # The first hit ending after the start of a feature is the only one that might overlap it
+        index = numpy.searchsorted(hits[:, 1], self.starts, 'right')
+        featuresHit = index < len(hits)
+        featuresHit[featuresHit] = hits[index[featuresHit], 0] < self.ends[featuresHit]
+
+        annotated = self.covered[-1]
+        hitBases = numpy.sum(hits[:, 1] - hits[:, 0])
+        return {
+            'features': len(self),
+            'featuresHit': int(numpy.sum(featuresHit)),
+            'hits': len(hits),
+            'hitsAnnotated': int(numpy.sum(overlap > 0)),
+            'sensitivity': float(numpy.sum(overlap)) / annotated if annotated > 0 else 0.0,
+            'precision': float(numpy.sum(overlap)) / hitBases if hitBases > 0 else 0.0
+        }
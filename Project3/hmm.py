@@ -0,0 +1,696 @@
+import json
+import numpy
+
+# Import the (optional) timing of each phase
+from timing import NO_TIMER
+
+"""
+The four possible nucleotides
+Also the four emissions of the Hidden Markov Model
+"""
+NUCLEOTIDES = ['A', 'C', 'G', 'T']
+
+"""
+Maps each byte of a processed sequence to its index in NUCLEOTIDES
+"""
+NUCLEOTIDE_CODES = numpy.zeros(256, dtype=numpy.int8)
+for code, base in enumerate(NUCLEOTIDES):
+    NUCLEOTIDE_CODES[ord(base)] = code
+
+"""
+Initial belief of the first state
+The remaining belief is split evenly between the other states
+"""
+FIRST_STATE_PROBABILITY = 0.9999
+
+"""
+Models with more states than this step through one base at a time
+    to find the probabilities entering each block
+Otherwise the steps of each block are multiplied out, which costs
+    an extra factor of the number of states in arithmetic
+    but loops only about sqrt(N) times in Python
+"""
+BLOCKED_STATES_LIMIT = 8
+
+"""
+Number of steps summed at once when adding up the log probability of a path
+"""
+SUMMATION_LENGTH = 2 ** 20
+
+"""
+Most bases held in the forward and backward probabilities at once
+The forward-backward algorithm works through longer sequences a group of blocks at a time
+"""
+FORWARD_BACKWARD_LENGTH = 2 ** 22
+
+class HMM(object):
+    """
+    Hidden Markov Model over nucleotide sequences with any number of states
+    The emission of each base may depend on the 'order' bases before it
+
+    Probabilities are held as NumPy arrays indexed by:
+        initial[State]
+        transition[Start state, End state]
+        emission[State, Context, Base]
+            Where the context encodes the previous bases like a base-4 number
+    Along with the logarithm of every step of the Viterbi algorithm:
+        steps[Symbol, Start state, End state]
+            Where the symbol is an encoded (context, base) pair (see encode)
+    And the probability of every step of the forward-backward algorithm:
+        step_probabilities[Symbol, Start state, End state]
+    """
+
+    def __init__(self, transition, emission, initial=None):
+        self.transition = numpy.array(transition, dtype=float)
+        self.emission = numpy.array(emission, dtype=float)
+        if self.emission.ndim == 2:
+            self.emission = self.emission[:, numpy.newaxis, :]
+
+        self.states = range(self.transition.shape[0])
+        assert len(self.states) <= 256, 'Back-pointers only hold up to 256 states'
+        self.order = 0
+        while len(NUCLEOTIDES) ** self.order < self.emission.shape[1]:
+            self.order += 1
+        assert self.emission.shape == (len(self.states), len(NUCLEOTIDES) ** self.order, len(NUCLEOTIDES)), \
+            'Emission matrix does not match %d states of order %d' % (len(self.states), self.order)
+
+        if initial is None:
+            initial = numpy.empty(len(self.states))
+            initial.fill((1 - FIRST_STATE_PROBABILITY) / max(1, len(self.states) - 1))
+            initial[0] = FIRST_STATE_PROBABILITY
+        self.initial = numpy.array(initial, dtype=float)
+
+        self.update()
+
+    def update(self):
+        """
+        Recomputes the log probabilities
+        Must be called after changing any of the probability matrices
+        """
+
+        # The first bases have no full context,
+        #   so they are emitted from the average over all contexts
+        contexts = len(NUCLEOTIDES) ** self.order
+        emission = numpy.concatenate((self.emission,
+                numpy.mean(self.emission, 1)[:, numpy.newaxis, :]), 1)
+        emission = numpy.reshape(emission, (len(self.states), -1))
+
+        # The extra padding symbol always stays in the same state
+        steps = self.transition[numpy.newaxis, :, :] \
+            * numpy.transpose(emission)[:, numpy.newaxis, :]
+        with numpy.errstate(divide='ignore'):
+            self.steps = numpy.concatenate((numpy.log(steps),
+                numpy.where(numpy.identity(len(self.states)), 0, -numpy.inf)[numpy.newaxis]))
+            self.initial_steps = numpy.log(self.initial[:, numpy.newaxis] * emission)
+        self.step_probabilities = numpy.exp(self.steps)
+        self.initial_probabilities = numpy.exp(self.initial_steps)
+
+        self.unknown_context = contexts
+        self.padding = len(self.steps) - 1
+        self.symbol_type = numpy.min_scalar_type(self.padding)
+
+    def encode(self, sequence):
+        """
+        Converts the processed sequence into an array of symbols
+            Each symbol is (context * len(NUCLEOTIDES) + base)
+        """
+
+        bases = NUCLEOTIDE_CODES.take(numpy.frombuffer(sequence, dtype=numpy.uint8))
+        symbols = bases.astype(self.symbol_type)
+
+        # Add the previous bases onto each symbol
+        if self.order > 0:
+            contexts = numpy.empty(len(bases), dtype=self.symbol_type)
+            contexts.fill(self.unknown_context)
+            contexts[self.order:] = 0
+            for offset in range(self.order):
+                contexts[self.order:] = contexts[self.order:] * len(NUCLEOTIDES) \
+                    + bases[offset:(len(bases) - self.order + offset)]
+            symbols += contexts * len(NUCLEOTIDES)
+
+        return symbols
+
+    def viterbi(self, symbols, checkpoint=False, timer=NO_TIMER):
+        """
+        Runs the Viterbi algorithm on the encoded sequence
+        Returns the most probable path as an array of states
+            and the log probability of that path
+        If checkpoint is set, only the probabilities entering each block are kept
+            and the back-pointers are recomputed a few blocks at a time
+            during the back-trace, which bounds the memory used
+        The forward pass, back-trace, and summation are timed as separate phases
+        """
+
+        # Each loop below runs about sqrt(N) times over arrays covering every block
+        blocks = self._cut_blocks(symbols[1:])
+        count, size = blocks.shape
+
+        # Find the probabilities entering each block
+        initial = self.initial_steps[:, symbols[0]]
+        with timer.phase('forward', len(symbols)):
+            entering, _ = self._enter_blocks(blocks, initial)
+
+        # Decode groups of blocks at once, from the last group to the first
+        group = max(1, count)
+        if checkpoint:
+            group = int(numpy.sqrt(count)) + 1
+        path = numpy.empty(1 + count * size, dtype=numpy.uint8)
+        last = numpy.argmax(initial)
+        for first in range(((count - 1) // group) * group, -1, -group):
+            chosen = slice(first, min(count, first + group))
+            with timer.phase('forward'):
+                previous_state, ending = self._decode_blocks(blocks[chosen], entering[chosen])
+            if first + group >= count:
+                last = numpy.argmax(ending[-1])
+            with timer.phase('traceback', (chosen.stop - chosen.start) * size):
+                last = self._trace_blocks(previous_state, last,
+                        numpy.reshape(path[(1 + chosen.start * size):(1 + chosen.stop * size)], (-1, size)))
+        path[0] = last
+        path = path[:len(symbols)]
+
+        # Sum up the log probability of the path in the same order as the recursion
+        # So that it exactly matches the maximum probability
+        with timer.phase('path probability', len(symbols)):
+            max_prob = initial[path[0]]
+            for start in range(1, len(symbols), SUMMATION_LENGTH):
+                end = min(len(symbols), start + SUMMATION_LENGTH)
+                terms = self.steps[symbols[start:end], path[(start - 1):(end - 1)], path[start:end]]
+                max_prob = numpy.cumsum(numpy.concatenate(([max_prob], terms)))[-1]
+
+        return path, max_prob
+
+    def _cut_blocks(self, symbols):
+        """
+        Helper for viterbi, forward_backward, and ViterbiStream
+        Cuts the steps of the given symbols into about sqrt(N) blocks of about sqrt(N) steps
+        Returns the symbols[Block, Column], padded at the end
+        """
+
+        size = int(numpy.sqrt(len(symbols))) + 1
+        count = (len(symbols) + size - 1) // size
+        blocks = numpy.empty(count * size, dtype=self.symbol_type)
+        blocks.fill(self.padding)
+        blocks[:len(symbols)] = symbols
+        return numpy.reshape(blocks, (count, size))
+
+    def _enter_blocks(self, blocks, max_log_probabilities):
+        """
+        Helper for viterbi and ViterbiStream
+        Carries the maximum probabilities before the first block through every block
+        Returns the maximum probabilities[Block, State] entering each block
+            and the maximum probabilities after the last block
+        """
+
+        count, size = blocks.shape
+        entering = numpy.empty((count, len(self.states)))
+        if len(self.states) <= BLOCKED_STATES_LIMIT:
+            # Multiply out (in the max-plus algebra) the steps within each block
+            # Holds the probability[Block, Start state, End state]
+            products = self.steps[blocks[:, 0]]
+            for column in range(1, size):
+                products = numpy.max(products[:, :, :, numpy.newaxis]
+                                     + self.steps[blocks[:, column]][:, numpy.newaxis, :, :], 2)
+
+            # Carry the maximum probabilities from block to block
+            for block in range(count):
+                entering[block] = max_log_probabilities
+                max_log_probabilities = numpy.max(max_log_probabilities[:, numpy.newaxis] + products[block], 0)
+
+        else:
+            # Too many states to multiply out, so step through one base at a time
+            for block in range(count):
+                entering[block] = max_log_probabilities
+                for column in range(size):
+                    max_log_probabilities = numpy.max(max_log_probabilities[:, numpy.newaxis]
+                                                      + self.steps[blocks[block, column]], 0)
+
+        return entering, max_log_probabilities
+
+    def _decode_blocks(self, blocks, entering):
+        """
+        Helper for viterbi
+        Steps through every given block at once, from the given entering probabilities
+        Returns the back-pointers of every column (see _back_pointers)
+            and the maximum probabilities at the end of each block
+        """
+
+        # Two states only need one bit per back-pointer
+        # So pack the bits of each column together
+        packed = len(self.states) == 2
+        previous_state = []
+        max_log_probabilities = entering
+        for column in range(blocks.shape[1]):
+            probabilities = max_log_probabilities[:, :, numpy.newaxis] + self.steps[blocks[:, column]]
+            pointers = numpy.argmax(probabilities, 1).astype(numpy.uint8)
+            previous_state.append(numpy.packbits(pointers) if packed else pointers)
+            max_log_probabilities = numpy.max(probabilities, 1)
+
+        return previous_state, max_log_probabilities
+
+    def _back_pointers(self, previous_state, column, count):
+        """
+        Helper for viterbi
+        Returns the previous state[Block, End state] of a column of count blocks
+        """
+
+        pointers = previous_state[column]
+        if len(self.states) == 2:
+            pointers = numpy.reshape(numpy.unpackbits(pointers)[:(2 * count)], (count, 2))
+        return pointers
+
+    def _block_maps(self, previous_state, count, size):
+        """
+        Helper for viterbi and ViterbiStream
+        Returns the state[Block, End state] entering each of the first count blocks
+            from every possible last state of the block
+        """
+
+        rows = numpy.arange(count)
+        state = numpy.tile(numpy.array(self.states, dtype=numpy.uint8), (count, 1))
+        for column in range(size - 1, -1, -1):
+            state = self._back_pointers(previous_state, column, count)[rows[:, numpy.newaxis], state]
+        return state
+
+    def _trace_blocks(self, previous_state, last, path):
+        """
+        Helper for viterbi
+        Back-traces through the decoded blocks, given the state after the last one
+        Fills in the path[Block, Column] and returns the state before the first block
+            The path may cover only the first few blocks
+        """
+
+        count, size = path.shape
+        rows = numpy.arange(count)
+        state = self._block_maps(previous_state, count, size)
+
+        # Then link the blocks together, starting from the last
+        ending = numpy.empty(count, dtype=numpy.uint8)
+        for block in range(count - 1, -1, -1):
+            ending[block] = last
+            last = state[block, last]
+
+        # Now the state at the end of each block is known, so trace through every block at once
+        for column in range(size - 1, -1, -1):
+            path[:, column] = ending
+            ending = self._back_pointers(previous_state, column, count)[rows, ending]
+
+        return last
+
+    def forward_backward(self, symbols, timer=NO_TIMER):
+        """
+        Runs the forward-backward algorithm on the encoded sequence
+        Returns a tuple of:
+            the log probability of the sequence,
+            the posterior probability[Position, State] of every base (as float32),
+            the expected number of emissions[State, Context, Base],
+            and the expected number of transitions[Start state, End state]
+        The expected counts skip the first bases, which have no context
+        The forward and backward probabilities are rescaled at every step
+            and only kept for FORWARD_BACKWARD_LENGTH bases at a time
+        The block boundaries, forward pass, and backward pass are timed as separate phases
+        """
+
+        blocks = self._cut_blocks(symbols[1:])
+        count, size = blocks.shape
+        steps = self.step_probabilities
+
+        # Find the (normalized) forward probabilities entering each block
+        #   and the backward probabilities leaving each block
+        initial = self.initial_probabilities[:, symbols[0]]
+        entering = numpy.empty((count, len(self.states)))
+        leaving = numpy.empty((count, len(self.states)))
+        forward = initial / numpy.sum(initial)
+        backward = numpy.ones(len(self.states)) / len(self.states)
+        with timer.phase('block boundaries', len(symbols)):
+            if len(self.states) <= BLOCKED_STATES_LIMIT:
+                # Multiply out the steps within each block
+                # Each product is rescaled so that it never underflows
+                products = steps[blocks[:, 0]]
+                for column in range(1, size):
+                    products = numpy.sum(products[:, :, :, numpy.newaxis]
+                                         * steps[blocks[:, column]][:, numpy.newaxis, :, :], 2)
+                    products /= numpy.max(numpy.max(products, 2), 1)[:, numpy.newaxis, numpy.newaxis]
+
+                for block in range(count):
+                    entering[block] = forward
+                    forward = numpy.dot(forward, products[block])
+                    forward /= numpy.sum(forward)
+                for block in range(count - 1, -1, -1):
+                    leaving[block] = backward
+                    backward = numpy.dot(products[block], backward)
+                    backward /= numpy.sum(backward)
+
+            else:
+                # Too many states to multiply out, so step through one base at a time
+                for block in range(count):
+                    entering[block] = forward
+                    for column in range(size):
+                        forward = numpy.dot(forward, steps[blocks[block, column]])
+                        forward /= numpy.sum(forward)
+                for block in range(count - 1, -1, -1):
+                    leaving[block] = backward
+                    for column in range(size - 1, -1, -1):
+                        backward = numpy.dot(steps[blocks[block, column]], backward)
+                        backward /= numpy.sum(backward)
+
+        # The scaling factors of the forward probabilities add up to the log probability
+        log_prob = numpy.log(numpy.sum(initial))
+        posteriors = numpy.empty((1 + count * size, len(self.states)), dtype=numpy.float32)
+        emissions = numpy.zeros((len(self.states), len(steps)))
+        transitions = numpy.zeros((len(self.states), len(self.states)))
+
+        # Then work through groups of blocks at once, each from both ends
+        group = max(1, FORWARD_BACKWARD_LENGTH // size)
+        first_backward = numpy.ones(len(self.states))
+        for first in range(0, count, group):
+            chosen = blocks[first:(first + group)]
+            with timer.phase('forward', len(chosen) * size):
+                forwards = numpy.empty((size + 1, len(chosen), len(self.states)))
+                forwards[0] = entering[first:(first + group)]
+                for column in range(size):
+                    forward = numpy.sum(forwards[column][:, :, numpy.newaxis] * steps[chosen[:, column]], 1)
+                    scale = numpy.sum(forward, 1)
+                    log_prob += numpy.sum(numpy.log(scale))
+                    forwards[column + 1] = forward / scale[:, numpy.newaxis]
+
+            with timer.phase('backward', len(chosen) * size):
+                backward = leaving[first:(first + group)]
+                for column in range(size - 1, -1, -1):
+                    step = steps[chosen[:, column]]
+                    posterior = forwards[column + 1] * backward
+                    posterior /= numpy.sum(posterior, 1)[:, numpy.newaxis]
+                    posteriors[(1 + first * size + column)::size][:len(chosen)] = posterior
+
+                    # The padding at the end is never counted
+                    for state in self.states:
+                        emissions[state] += numpy.bincount(chosen[:, column],
+                                weights=posterior[:, state], minlength=len(steps))
+                    expected = forwards[column][:, :, numpy.newaxis] * step * backward[:, numpy.newaxis, :]
+                    expected /= numpy.sum(numpy.sum(expected, 2), 1)[:, numpy.newaxis, numpy.newaxis]
+                    transitions += numpy.sum(expected[chosen[:, column] != self.padding], 0)
+
+                    backward = numpy.sum(step * backward[:, numpy.newaxis, :], 2)
+                    backward /= numpy.sum(backward, 1)[:, numpy.newaxis]
+
+            if first == 0:
+                first_backward = backward[0]
+
+        # The first base comes before every block
+        posterior = initial * first_backward
+        posterior /= numpy.sum(posterior)
+        posteriors[0] = posterior
+        emissions[:, symbols[0]] += posterior
+
+        # Drop the unknown contexts and padding
+        contexts = len(NUCLEOTIDES) ** self.order
+        emissions = numpy.reshape(emissions[:, :(contexts * len(NUCLEOTIDES))], self.emission.shape)
+
+        return log_prob, posteriors[:len(symbols)], emissions, transitions
+
+    def save_emission(self, filename):
+        """
+        Saves the emission probability matrix in the same JSON format as load_hmm
+        """
+
+        emission = {}
+        for state in self.states:
+            emission[state] = {}
+            for context in range(self.emission.shape[1]):
+                probabilities = {}
+                for base in range(len(NUCLEOTIDES)):
+                    probabilities[NUCLEOTIDES[base]] = float(self.emission[state, context, base])
+
+                if self.order == 0:
+                    emission[state] = probabilities
+                else:
+                    emission[state][_decode_context(context, self.order)] = probabilities
+
+        with open(filename, 'w') as f:
+            json.dump(emission, f, indent=2)
+
+    def save_transition(self, filename):
+        """
+        Saves the transition probability matrix in the same JSON format as load_hmm
+        """
+
+        transition = {}
+        for start in self.states:
+            transition[start] = {}
+            for end in self.states:
+                transition[start][end] = float(self.transition[start, end])
+
+        with open(filename, 'w') as f:
+            json.dump(transition, f, indent=2)
+
+class ViterbiStream(object):
+    """
+    Runs the Viterbi algorithm on a sequence that arrives a chunk at a time
+    Segments of the most probable path are returned as soon as they are known:
+        once every surviving path agrees on them (traceback convergence)
+        or, given a lag, once they are more than lag bases behind the last base
+            even if the surviving paths still disagree
+    Only the back-pointers of the bases that are not yet known are held in memory
+        So with a lag, the memory is bounded
+
+    Usage:
+        stream = ViterbiStream(model, lag)
+        for chunk in chunks:
+            for start, end, state in stream.feed(chunk): ...
+        for start, end, state in stream.finish(): ...
+    Segments are (inclusive start, exclusive end, state) tuples, in order
+    """
+
+    def __init__(self, model, lag=None):
+        self.model = model
+        self.lag = lag
+
+        # Number of bases fed so far, the last few of them (the context of the next chunk),
+        #   and the maximum probabilities of the last one
+        self.length = 0
+        self.context = ''
+        self.max_log_probabilities = None
+
+        # Decoded chunks that are not yet entirely known
+        #   Each is a tuple of (position of the first step, number of steps, block size,
+        #   back-pointers (see HMM._decode_blocks), state[Block, End state] entering each block,
+        #   and state[End state] entering the chunk)
+        self.pending = []
+
+        # Number of bases whose state is known (and returned)
+        #   and the (start, state) of the last segment, which is still open
+        self.known = 0
+        self.segment = None
+
+    def feed(self, chunk):
+        """
+        Decodes the next chunk of the processed sequence
+        Returns the segments that became known
+        """
+
+        if not chunk:
+            return []
+
+        model = self.model
+        symbols = model.encode(self.context + chunk)[len(self.context):]
+        if model.order > 0:
+            self.context = (self.context + chunk)[-model.order:]
+
+        # The first base has no step into it
+        start = self.length
+        self.length += len(chunk)
+        if self.max_log_probabilities is None:
+            self.max_log_probabilities = model.initial_steps[:, symbols[0]]
+            symbols = symbols[1:]
+            start += 1
+
+        if len(symbols) > 0:
+            blocks = model._cut_blocks(symbols)
+            count, size = blocks.shape
+            entering, self.max_log_probabilities = model._enter_blocks(blocks, self.max_log_probabilities)
+            previous_state, _ = model._decode_blocks(blocks, entering)
+            maps = model._block_maps(previous_state, count, size)
+
+            state = numpy.array(model.states, dtype=numpy.uint8)
+            for block in range(count - 1, -1, -1):
+                state = maps[block, state]
+            self.pending.append((start, len(symbols), size, previous_state, maps, state))
+
+        # Find the latest base that every surviving path agrees on
+        #   or the base lag bases back along the most probable path, whichever is later
+        found = self._locate(numpy.array(model.states, dtype=numpy.uint8), self.length - 1)
+        if self.lag is not None:
+            lagged = self._locate(numpy.array([numpy.argmax(self.max_log_probabilities)], dtype=numpy.uint8),
+                                  self.length - 1 - self.lag)
+            if found is None or (lagged is not None and lagged[0] > found[0]):
+                found = lagged
+
+        if found is None:
+            return []
+        return self._emit(*found)
+
+    def finish(self):
+        """
+        Ends the sequence
+        Returns the remaining segments
+        """
+
+        if self.max_log_probabilities is None:
+            return []
+
+        segments = []
+        found = self._locate(numpy.array([numpy.argmax(self.max_log_probabilities)], dtype=numpy.uint8),
+                             self.length - 1)
+        if found is not None:
+            segments = self._emit(*found)
+        if self.segment is not None:
+            segments.append((self.segment[0], self.length, self.segment[1]))
+            self.segment = None
+        return segments
+
+    def log_probability(self):
+        """
+        Returns the log probability of the most probable path so far
+            The returned segments only follow this path if the lag was never reached
+        """
+
+        return numpy.max(self.max_log_probabilities)
+
+    def _locate(self, states, limit):
+        """
+        Helper for feed and finish
+        Walks back from the given possible states of the last base, a block at a time,
+            to the latest block boundary, no later than the limit, where all the states agree
+        Returns a tuple of (position, pending chunk, block, state) of that boundary
+            or None if there is no such boundary after the known bases
+        The boundary is the last base before the block (or the first base for chunk -1)
+        """
+
+        def agree(position, states):
+            return position <= limit and numpy.all(states == states[0])
+
+        for index in range(len(self.pending) - 1, -1, -1):
+            start, length, size, previous_state, maps, entering = self.pending[index]
+
+            # Only walk through the blocks of the chunk holding the boundary
+            before = entering[states]
+            if not agree(start - 1, before):
+                states = before
+                continue
+
+            for block in range(len(maps), -1, -1):
+                position = start + min(block * size, length) - 1
+                if position < self.known:
+                    return None
+                if agree(position, states):
+                    return position, index, block, states[0]
+                if block > 0:
+                    states = maps[block - 1, states]
+
+        # Otherwise, the boundary may be the first base
+        if self.known == 0 and agree(0, states):
+            return 0, -1, 0, states[0]
+        return None
+
+    def _emit(self, position, index, block, last):
+        """
+        Helper for feed and finish
+        Back-traces from the given boundary (see _locate) to the known bases
+        Returns the segments that became known and forgets the chunks before them
+        """
+
+        # Back-trace through the chunk holding the boundary and the ones before it
+        pieces = []
+        begin = position + 1
+        for chunk in range(index, -1, -1):
+            start, length, size, previous_state, maps, entering = self.pending[chunk]
+            blocks = block if chunk == index else len(maps)
+            path = numpy.empty((blocks, size), dtype=numpy.uint8)
+            last = self.model._trace_blocks(previous_state, last, path)
+            pieces.append(numpy.ravel(path)[:min(blocks * size, length)])
+            begin = start
+            if begin <= self.known:
+                break
+
+        # The back-trace ends on the first base, which comes before every chunk
+        if begin > self.known:
+            pieces.append(numpy.array([last], dtype=numpy.uint8))
+            begin -= 1
+        path = numpy.concatenate(pieces[::-1])[(self.known - begin):]
+
+        # Chunks that are entirely known are no longer needed
+        self.pending = [chunk for chunk in self.pending if chunk[0] + chunk[1] - 1 > position]
+        first = self.known
+        self.known = position + 1
+
+        # Split the path into segments, extending the one that is still open
+        segments = []
+        changes = numpy.flatnonzero(numpy.diff(path)) + 1
+        for run in [0] + changes.tolist():
+            state = int(path[run])
+            if self.segment is not None and self.segment[1] != state:
+                segments.append((self.segment[0], first + run, self.segment[1]))
+                self.segment = None
+            if self.segment is None:
+                self.segment = (first + run, state)
+
+        return segments
+
+def _decode_context(context, order):
+    """
+    Converts an encoded context back into a string of bases
+    """
+
+    bases = []
+    for index in range(order):
+        bases.append(NUCLEOTIDES[context % len(NUCLEOTIDES)])
+        context /= len(NUCLEOTIDES)
+    return ''.join(bases[::-1])
+
+def _encode_context(context):
+    """
+    Converts a string of bases into an encoded context
+    """
+
+    code = 0
+    for base in context:
+        code = code * len(NUCLEOTIDES) + NUCLEOTIDES.index(base)
+    return code
+
+def load_hmm(emissionFile, transitionFile, initialFile=None):
+    """
+    Loads a Hidden Markov Model from JSON files
+    JSON doesn't support integer keys, so the states are strings of integers
+        The emission file maps each state to the probability of each base
+            or for higher order models, each state to each context
+            (a string of the previous bases) to the probability of each base
+        The transition file maps each start state to each end state
+        The optional initial file maps each state to its initial belief
+    """
+
+    with open(transitionFile) as f:
+        transition = json.load(f)
+    states = range(len(transition))
+    transition = [[transition[str(start)][str(end)] for end in states] for start in states]
+
+    with open(emissionFile) as f:
+        emission = json.load(f)
+    emission = [emission[str(state)] for state in states]
+
+    # Higher order emissions have another level of nesting
+    order = 0
+    if isinstance(emission[0].values()[0], dict):
+        order = len(emission[0].keys()[0])
+    matrix = numpy.empty((len(states), len(NUCLEOTIDES) ** order, len(NUCLEOTIDES)))
+    for state in states:
+        contexts = emission[state] if order > 0 else {'': emission[state]}
+        for context in contexts:
+            for base in range(len(NUCLEOTIDES)):
+                matrix[state, _encode_context(context), base] = contexts[context][NUCLEOTIDES[base]]
+
+    initial = None
+    if initialFile is not None:
+        with open(initialFile) as f:
+            initial = json.load(f)
+        initial = [initial[str(state)] for state in states]
+
+    return HMM(transition, matrix, initial)
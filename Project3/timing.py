@@ -0,0 +1,107 @@
+import sys
+import os
+import json
+import time
+
+from contextlib import contextmanager
+
+# Peak memory is only available on Unix
+try:
+    import resource
+except ImportError:
+    resource = None
+
+def _peak_rss():
+    """
+    Returns the peak resident memory of this process in kilobytes
+        or None if the platform does not report it
+    """
+
+    if resource is None:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # Mac OS reports bytes instead of kilobytes
+    if sys.platform == 'darwin':
+        peak /= 1024
+    return peak
+
+def _cpu_time():
+    """
+    Returns the user and system CPU time of this process in seconds
+    """
+
+    times = os.times()
+    return times[0] + times[1]
+
+class PhaseTimer(object):
+    """
+    Measures the wall time, CPU time, and peak memory of each phase of a program
+    Phases with the same name add up until they are reported
+        Each report writes one JSON object per phase, one per line, in the order the phases started
+    A timer without a file measures nothing
+
+    Usage:
+        timer = PhaseTimer(file)
+        with timer.phase('forward', bases):
+            ...
+        timer.report(iteration=1)
+    """
+
+    def __init__(self, file=None):
+        self.file = file
+        self.phases = []
+        self.totals = {}
+
+    @contextmanager
+    def phase(self, name, bases=None):
+        """
+        Times the enclosed code as part of the named phase
+            The bases are the number processed, to report the throughput
+        """
+
+        if self.file is None:
+            yield
+            return
+
+        wall = time.time()
+        cpu = _cpu_time()
+        try:
+            yield
+        finally:
+            if name not in self.totals:
+                self.phases.append(name)
+                self.totals[name] = {'wall_seconds': 0.0, 'cpu_seconds': 0.0, 'bases': None}
+            total = self.totals[name]
+            total['wall_seconds'] += time.time() - wall
+            total['cpu_seconds'] += _cpu_time() - cpu
+            total['peak_rss_kb'] = _peak_rss()
+            if bases is not None:
+                total['bases'] = (total['bases'] or 0) + bases
+
+    def report(self, **fields):
+        """
+        Writes out the phases timed since the last report, along with the given fields
+        """
+
+        if self.file is None:
+            return
+
+        for name in self.phases:
+            total = self.totals[name]
+            line = dict(fields)
+            line.update(total)
+            line['phase'] = name
+            if total['bases'] is not None and total['wall_seconds'] > 0:
+                line['bases_per_second'] = total['bases'] / total['wall_seconds']
+            self.file.write(json.dumps(line, sort_keys=True) + '\n')
+        self.file.flush()
+
+        self.phases = []
+        self.totals = {}
+
+"""
+Timer used when nothing is being timed
+"""
+NO_TIMER = PhaseTimer()
@@ -3,11 +3,19 @@ import os
 import argparse
 import re
 import numpy
-import json
-import time
+import multiprocessing
+import cProfile
 
-from math import log
-from numpy import zeros
+from contextlib import contextmanager
+
+# Import the Hidden Markov Model
+from hmm import *
+
+# Import the annotations that hits are compared against
+from annotations import *
+
+# Import the timing of each phase
+from timing import *
 
 """
 File extension that triggers some additional processing
@@ -16,41 +24,30 @@ Lines starting with '>' are removed
 """
 FASTA = '.fna'
 
-"""
-The four possible nucleotides
-Also the four emissions of the Hidden Markov Model
-"""
-NUCLEOTIDES = ['A', 'C', 'G', 'T']
-
 #######################################
 ## States of the Hidden Markov Model ##
 #######################################
 # Note: The states should be consecutive numbers, in order, starting from 0
+#   Models with more states are ordered by increasing GC content,
+#   so the last state is the one reported as high GC content
 STATE_LOW_GC = 0
 STATE_HIGH_GC = 1
 
 """
-Convenient collection of all states in the model
+Most iterations of training to run when waiting for convergence
 """
-STATES = [STATE_LOW_GC, STATE_HIGH_GC]
+MAX_ITERATIONS = 100
 
 """
-Emission probability matrix
+Number of bases counted at once during emission training
+Bounds the temporary arrays to a few megabytes
 """
-EMISSION_PROBABILITY = {}
+COUNTING_LENGTH = 2 ** 20
 
 """
-Initial belief of state
+Number of bases read in and decoded at once when streaming
 """
-INITIAL_STATE_PROBABILITY = {
-    STATE_LOW_GC : 0.9999,
-    STATE_HIGH_GC: 0.0001
-}
-
-"""
-Transition probability matrix
-"""
-TRANSITION_PROBABILITY = {}
+STREAM_LENGTH = 2 ** 16
 
 def process_fasta(text):
     """
@@ -66,237 +63,575 @@ def process_fasta(text):
     text = text.upper()
     return re.sub(r'[^ACGT]', 'T', text)
 
-def run_viterbi(sequence):
+def process_fasta_records(text):
+    """
+    Splits a (multi-record) FASTA file into its records
+    Returns a list of (name, sequence) tuples, in order
+        The name is the first word after the '>' of the record
+        Each sequence is processed like process_fasta
+        Records without any bases are dropped
+    """
+
+    records = []
+    chunks = re.split(r'(?m)^>', text)
+
+    # Bases before the first '>' form an unnamed record
+    if chunks[0].strip():
+        records.append(('', process_fasta(chunks[0])))
+
+    for chunk in chunks[1:]:
+        header, _, body = chunk.partition('\n')
+        words = header.split()
+        sequence = process_fasta(body)
+        if sequence:
+            records.append((words[0] if words else '', sequence))
+
+    return records
+
+def stream_fasta(file, length=STREAM_LENGTH):
+    """
+    Reads a (multi-record) FASTA file a line at a time
+    Yields (record number, name, bases) tuples of about the given number of bases
+        Each record gets a new number, and the name is the first word after its '>'
+        The bases are processed like process_fasta
+    """
+
+    number = 0
+    name = ''
+    started = False
+    lines = []
+    count = 0
+    for line in file:
+        if line.startswith('>'):
+            if lines:
+                yield number, name, ''.join(lines)
+                lines = []
+                count = 0
+            if started:
+                number += 1
+            words = line[1:].split()
+            name = words[0] if words else ''
+            started = True
+            continue
+
+        line = re.sub(r'[^ACGT]', 'T', line.strip().upper())
+        if line:
+            started = True
+            lines.append(line)
+            count += len(line)
+        if count >= length:
+            yield number, name, ''.join(lines)
+            lines = []
+            count = 0
+
+    if lines:
+        yield number, name, ''.join(lines)
+
+def print_evaluation(annotations, hits):
+    """
+    Compares the sorted (inclusive start, exclusive end) hits against the annotations
+    And prints how well they match (see IntervalIndex.evaluate)
+    """
+
+    evaluation = annotations.evaluate(hits)
+    print 'Annotated features hit: %d of %d' % (evaluation['featuresHit'], evaluation['features'])
+    print 'Hits overlapping an annotated feature: %d of %d' % (evaluation['hitsAnnotated'], evaluation['hits'])
+    print 'Sensitivity (fraction of annotated bases hit): %f' % evaluation['sensitivity']
+    print 'Precision (fraction of hit bases annotated): %f' % evaluation['precision']
+
+def _number_filename(filename, number):
     """
-    Runs the Viterbi algorithm on the given sequence
-        using the global probability matrices
+    Numbers a filename with two digits at the end, before the extension
+        replacing any number it already ends with (i.e. Emission00.json to Emission01.json)
+    """
+
+    name, extension = os.path.splitext(filename)
+    return '%s%02d%s' % (re.sub(r'\d+$', '', name), number, extension)
+
+class _Tee(object):
+    """
+    Helper for viterbi.py --results
+    Writes everything printed to standard output to a file as well
+    """
+
+    def __init__(self, stream, file):
+        self.stream = stream
+        self.file = file
+
+    def write(self, text):
+        self.stream.write(text)
+        self.file.write(text)
+
+@contextmanager
+def _saving_output(filename):
+    """
+    Helper for viterbi.py --results
+    Also writes everything printed to standard output within to the given file, if any
+    """
+
+    if filename is None:
+        yield
+        return
+
+    stdout = sys.stdout
+    with open(filename, 'w') as f:
+        sys.stdout = _Tee(stdout, f)
+        try:
+            yield
+        finally:
+            sys.stdout = stdout
+
+def run_viterbi(model, symbols, checkpoint=False, timer=NO_TIMER):
+    """
+    Runs the Viterbi algorithm on the given encoded sequence (see HMM.encode)
+        using the given Hidden Markov Model
     Returns a dictionary containing one entry per state
         Each entry is a list of 2-tuples denoting indices (inclusive, exclusive)
             which are predicted to be in the given state
     Also returns the log probability of the Viterbi path
+    See HMM.viterbi for the checkpoint option
+    """
+
+    viterbi_path, max_prob = model.viterbi(symbols, checkpoint, timer)
+
+    with timer.phase('segmentation', len(symbols)):
+        # Split the path into contiguous chunks of one state
+        starts, ends, states = _segment_path(viterbi_path)
+        starts = starts.tolist()
+        ends = ends.tolist()
+
+        # And filter them into the proper buckets
+        results = {}
+        for state in model.states:
+            results[state] = [(starts[index], ends[index])
+                    for index in numpy.flatnonzero(states == state)]
+
+    return results, max_prob
+
+def run_streaming_viterbi(model, file, lag=None, timer=NO_TIMER):
+    """
+    Runs the Viterbi algorithm on every record of a FASTA file while it is read
+        See ViterbiStream for when segments become known and for the lag
+    Yields a (name, offset, start, end, state) tuple for every segment as soon as it is known
+        The offset is the global index of the first base of the record
+        The start and end are the inclusive and exclusive indices within the record
+    """
+
+    stream = None
+    for number, name, bases in stream_fasta(file):
+        if stream is None or number != current:
+            if stream is not None:
+                with timer.phase('stream'):
+                    segments = stream.finish()
+                for segment in segments:
+                    yield (record, offset) + segment
+                offset += stream.length
+            else:
+                offset = 0
+            stream = ViterbiStream(model, lag)
+            current = number
+            record = name
+
+        with timer.phase('stream', len(bases)):
+            segments = stream.feed(bases)
+        for segment in segments:
+            yield (record, offset) + segment
+
+    if stream is not None:
+        with timer.phase('stream'):
+            segments = stream.finish()
+        for segment in segments:
+            yield (record, offset) + segment
+
+def run_forward_backward(model, symbols, threshold, timer=NO_TIMER):
     """
+    Runs the forward-backward algorithm on the given encoded sequence (see HMM.encode)
+        using the given Hidden Markov Model
+    Returns a dictionary like run_viterbi, but decoded from the posterior probabilities
+        Bases go to the last (high GC) state if its posterior probability is at least the threshold
+        Otherwise they go to the most probable of the remaining states
+    Also returns the log probability of the sequence
+        and a tuple of the expected (emission, transition) counts used in training
+    """
+
+    log_prob, posteriors, emissions, transitions = model.forward_backward(symbols, timer)
+
+    with timer.phase('segmentation', len(symbols)):
+        path = numpy.zeros(len(symbols), dtype=numpy.uint8)
+        if len(model.states) > 2:
+            path[:] = numpy.argmax(posteriors[:, :-1], 1)
+        path[posteriors[:, -1] >= threshold] = model.states[-1]
+
+        starts, ends, states = _segment_path(path)
+        starts = starts.tolist()
+        ends = ends.tolist()
+
+        results = {}
+        for state in model.states:
+            results[state] = [(starts[index], ends[index])
+                    for index in numpy.flatnonzero(states == state)]
+
+    return results, log_prob, (emissions, transitions)
 
-    # Initialize space to hold the calculated Viterbi probabilities
-    max_log_probabilities = zeros(len(STATES))
-    previous_state        = zeros((len(STATES), len(sequence)))
-    #Note: The first column of 'previous_state' is meaningless
-
-    # Fill in the start state probability
-    max_log_probabilities[:] = [
-        log(INITIAL_STATE_PROBABILITY[STATE_LOW_GC] * EMISSION_PROBABILITY[STATE_LOW_GC][sequence[0]]),
-        log(INITIAL_STATE_PROBABILITY[STATE_HIGH_GC] * EMISSION_PROBABILITY[STATE_HIGH_GC][sequence[0]])
-    ]
-
-    # Define how to step through the Viterbi algorithm and fill in the appropriate values
-    probabilities = zeros((len(STATES), len(STATES)));
-    def viterbi_step(previous, index):
-        # Calculate the len(STATES) ** 2 number of probabilities
-        # Holds the probability[End state, Start state]
-        for endState in STATES:
-            for startState in STATES:
-                probabilities[endState, startState] = \
-                    previous[startState] \
-                    + log(TRANSITION_PROBABILITY[startState][endState] \
-                        * EMISSION_PROBABILITY[endState][sequence[index]])
-
-        # Keep the maximums
-        previous_state[:, index] = numpy.argmax(probabilities, 1)
-        return numpy.max(probabilities, 1)
-
-    # Fill in the remainder of the probabilities
-    max_log_probabilities[:] = reduce(viterbi_step, range(1, len(sequence)), max_log_probabilities)
-
-    # Back-trace to find all the predicted states
-    # First initialize the space required
-    viterbi_path = zeros(len(sequence))
-
-    # Fill in the last value
-    viterbi_path[len(sequence) - 1] = numpy.argmax(max_log_probabilities)
-
-    # Define how to step back through the states and determine the Viterbi path
-    def viterbi_backstep(previous, index):
-        viterbi_path[index] = previous_state[previous, index + 1]
-        return viterbi_path[index]
-
-    # Back-fill in the remainder of the path
-    reduce(viterbi_backstep, range(len(sequence) - 2, -1, -1), viterbi_path[len(sequence) - 1])
-
-    # Yay, now I can use functional programming to do the remaining transformation
-    # Namely, the transformation of the path to the return value
-    # First, find all the indices where there is a state transition
-    #   This will be the inclusive end of all the contiguous state chunks
-    thresholds = filter(lambda x: viterbi_path[x] != viterbi_path[x + 1],
-                        range(0, len(viterbi_path) - 1))
-    # Pretend that there's also a state transition at the end
-    thresholds.append(len(viterbi_path) - 1)
-
-    # Now transform these indices into tuples of (inclusive start, exclusive end)
-    thresholds = map(lambda x:(0 if x <= 0 else (thresholds[x - 1] + 1), thresholds[x] + 1),
-                     range(len(thresholds)))
-
-    # And filter them into the proper buckets
-    results = {}
-    for state in STATES:
-        results[state] = filter(lambda x: viterbi_path[x[0]] == state, thresholds)
-
-    return results, numpy.max(max_log_probabilities)
-
-def run_transition_training(viterbi):
+def _segment_path(path):
+    """
+    Helper for run_viterbi
+    Returns the run-length encoding of the path as three arrays
+        The inclusive start, exclusive end, and state of each contiguous chunk
+    """
+
+    # Each change of state starts a new chunk
+    changes = numpy.flatnonzero(numpy.diff(path)) + 1
+    starts = numpy.concatenate(([0], changes))
+    ends = numpy.concatenate((changes, [len(path)]))
+    return starts, ends, path[starts]
+
+def _unwrap_segments(model, viterbi):
+    """
+    Helper for count_viterbi
+    Unwraps the first output result of running the Viterbi algorithm
+      from: {state: [(start, end), ...], ...}
+        to: the arrays returned by _segment_path
+    """
+
+    segments = numpy.array([(item[0], item[1], state)
+            for state in model.states for item in viterbi[state]], dtype=int).reshape((-1, 3))
+    segments = segments[numpy.argsort(segments[:, 0], kind='mergesort')]
+    return segments[:, 0], segments[:, 1], segments[:, 2]
+
+def count_viterbi(model, symbols, viterbi):
     """
     Takes the first output result of running the Viterbi algorithm
-    And calculates a new transition probability matrix
-        Note: this replaces the global probability matrices
+        And the encoded sequence used to calculate the output
+    Returns a tuple of the (emission, transition) counts used in training
+        in the same format as the expected counts of run_forward_backward
+    Counts of several sequences can be added together before training
     """
 
-    # First zero-out the matrix
-    for start in STATES:
-        TRANSITION_PROBABILITY[start] = {}
-        for end in STATES:
-            TRANSITION_PROBABILITY[start][end] = 0
+    starts, ends, states = _unwrap_segments(model, viterbi)
 
-    # Next, let's unwrap the results
-    #   from: {state: (start, end), ...}
-    #     to: [(start, end, state), ...]
-    unwrapped = []
-    for state in STATES:
-        unwrapped.extend([(item[0], item[1], state) for item in viterbi[state]])
+    # Rebuild the path of states (one byte per base)
+    path = numpy.repeat(states.astype(numpy.uint8), ends - starts)
 
-    # Sort the unwrapped results in ascending order
-    unwrapped.sort(key=lambda x: x[0])
+    # Count each (state, symbol) pair, a block of the sequence at a time
+    # The first bases of the sequence have no context and are not counted
+    size = numpy.size(model.emission[0])
+    emissions = numpy.zeros(len(model.states) * size)
+    for block in range(model.order, len(symbols), COUNTING_LENGTH):
+        pairs = path[block:block + COUNTING_LENGTH].astype(int) * size \
+            + symbols[block:block + COUNTING_LENGTH]
+        emissions += numpy.bincount(pairs, minlength=len(emissions))
+    emissions = numpy.reshape(emissions, model.emission.shape)
 
-    # Add up transition counts
-    for index in range(len(unwrapped)):
-        start = unwrapped[index][2]
+    # Add up the (state, next state) pairs
+    #   Within a chunk, every base is counted as a transition from the state to itself
+    #   Between chunks, there is a single transition from one state to another
+    size = len(model.states)
+    transitions = numpy.bincount(states * (size + 1), weights=ends - starts, minlength=size * size)
+    transitions += numpy.bincount(states[:-1] * size + states[1:], minlength=size * size)
+    transitions = numpy.reshape(transitions, (size, size))
 
-        # Add a single transition from one state to another
-        if index < len(unwrapped) - 1:
-            end = unwrapped[index + 1][2]
-            TRANSITION_PROBABILITY[start][end] += 1
+    return emissions, transitions
 
-        # Add transitions from one state to itself
-        TRANSITION_PROBABILITY[start][start] += unwrapped[index][1] - unwrapped[index][0]
+def run_transition_training(model, counts):
+    """
+    Takes the (emission, transition) counts of count_viterbi or run_forward_backward
+    And calculates a new transition probability matrix
+        Note: this replaces the model's probability matrix
+    """
 
     # Normalize the transition counts to probabilities
-    for start in STATES:
-        total = 0.0
-        for end in STATES:
-            total += TRANSITION_PROBABILITY[start][end]
-        for end in STATES:
-            TRANSITION_PROBABILITY[start][end] /= total
+    transitions = counts[1]
+    model.transition = transitions / numpy.sum(transitions, 1)[:, numpy.newaxis]
+    model.update()
 
-def run_emission_training(sequence, viterbi):
+def run_emission_training(model, counts):
     """
-    Takes the first output result of running the Viterbi algorithm
-        And the sequence used to calculate the output
+    Takes the (emission, transition) counts of count_viterbi or run_forward_backward
     And calculates a new emission probability matrix
-        Note: this replaces the global probability matrices
-    """
-
-    # First zero-out the matrix
-    for start in STATES:
-        EMISSION_PROBABILITY[start] = {}
-        for emit in NUCLEOTIDES:
-            EMISSION_PROBABILITY[start][emit] = 0
-
-    # Add up the emission counts in each state
-    for state in viterbi:
-        # Concatenate each subsequence together
-        subsequence = []
-        for result in viterbi[state]:
-            subsequence.append(sequence[result[0]:result[1]])
-        subsequence = ''.join(subsequence)
-
-        # Count the number of each emission
-        for emit in NUCLEOTIDES:
-            EMISSION_PROBABILITY[state][emit] += reduce(
-                    lambda x, y: x + (1 if subsequence[y] == emit else 0),
-                    range(len(subsequence)),
-                    0) # Initializer, necessary otherwise the first letter will be ignored
+        Note: this replaces the model's probability matrix
+    """
 
-    # Normalize the transition counts to probabilities
-    for start in STATES:
-        total = 0.0
-        for emit in NUCLEOTIDES:
-            total += EMISSION_PROBABILITY[start][emit]
-        for emit in NUCLEOTIDES:
-            EMISSION_PROBABILITY[start][emit] /= total
+    # Normalize the emission counts to probabilities
+    # Contexts that never appear in a state fall back to a uniform emission
+    emissions = counts[0]
+    totals = numpy.sum(emissions, 2)[:, :, numpy.newaxis]
+    with numpy.errstate(invalid='ignore'):
+        model.emission = numpy.where(totals > 0, emissions / totals, 1.0 / len(NUCLEOTIDES))
+    model.update()
+
+def decode_record(model, symbols, posterior=None, checkpoint=False, timer=NO_TIMER):
+    """
+    Decodes one encoded sequence with run_viterbi
+        or with run_forward_backward if given a posterior threshold
+    Returns a tuple of the results dictionary, the log probability,
+        and the (emission, transition) counts used in training
+    """
+
+    if posterior is not None:
+        return run_forward_backward(model, symbols, posterior, timer)
+
+    results, max_prob = run_viterbi(model, symbols, checkpoint, timer)
+    with timer.phase('counting', len(symbols)):
+        counts = count_viterbi(model, symbols, results)
+    return results, max_prob, counts
+
+"""
+Encoded records held by each process of the pool (see decode_records)
+"""
+_worker_records = None
+
+def _initialize_worker(records):
+    """
+    Helper for decode_records
+    Hands the encoded records to a process of the pool, once
+    """
+
+    global _worker_records
+    _worker_records = records
+
+def _decode_worker(task):
+    """
+    Helper for decode_records
+    Decodes one of the records held by this process of the pool
+    """
+
+    model, index, posterior, checkpoint = task
+    return index, decode_record(model, _worker_records[index], posterior, checkpoint)
+
+def decode_records(model, records, posterior=None, checkpoint=False, pool=None, timer=NO_TIMER):
+    """
+    Runs decode_record on every encoded record
+        If given a pool started with _initialize_worker(records),
+        the records are decoded in parallel, longest first
+        and only timed as a whole
+    Returns the outputs of decode_record, in order
+    """
+
+    if pool is None:
+        return [decode_record(model, symbols, posterior, checkpoint, timer) for symbols in records]
+
+    order = sorted(range(len(records)), key=lambda index: -len(records[index]))
+    tasks = [(model, index, posterior, checkpoint) for index in order]
+    decoded = [None] * len(records)
+    with timer.phase('parallel decoding', sum([len(symbols) for symbols in records])):
+        for index, output in pool.imap_unordered(_decode_worker, tasks):
+            decoded[index] = output
+    return decoded
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
             description='Runs the Viterbi algorithm on the given sequence, looking for areas of high GC content')
-    parser.add_argument('sequence', type=str)
+    parser.add_argument('sequence', type=str, help="A FASTA sequence, or '-' to stream one from standard input")
     parser.add_argument('--inE', type=str, help='JSON matrix used to initialize the emission probability matrix')
     parser.add_argument('--inT', type=str, help='JSON matrix used to initialize the transition probability matrix')
+    parser.add_argument('--inI', type=str, required=False,
+        help='JSON vector used to initialize the initial state probabilities')
     parser.add_argument('--outE', type=str, required=False,
         help='File to save the trained emission probability matrix')
     parser.add_argument('--outT', type=str, required=False,
         help='File to save the trained transition probability matrix')
+    parser.add_argument('--iterations', type=int, required=False,
+        help='Number of times to decode and retrain the model (default 1, or %d when converging)' % MAX_ITERATIONS)
+    parser.add_argument('--until_converged', type=float, required=False,
+        help='Stop iterating once the log probability or every probability changes by at most this much')
+    parser.add_argument('--intermediate', action='store_true',
+        help='Also save the matrices of every iteration, numbered after --inE and --inT '
+            + '(i.e. Emission01.json after the first iteration from Emission00.json)?')
+    parser.add_argument('--results', type=str, required=False,
+        help='Also save the printed results of every iteration, numbered after this file '
+            + 'with the iteration of the matrices decoded (i.e. Results00.out for --inE and --inT)')
     parser.add_argument('--verbose', action='store_true', help='Print every high GC hit?')
-    parser.add_argument('--time', action='store_true', help='Time the algorithm?')
+    parser.add_argument('--time', type=str, nargs='?', const='-', required=False,
+        help='Write the wall time, CPU time, peak memory, and throughput of each phase '
+            + 'as JSON lines to this file (default standard error)')
+    parser.add_argument('--profile', type=str, required=False,
+        help='Save the statistics of cProfile to this file (processes of the pool are not profiled)')
+    parser.add_argument('--posterior', type=float, nargs='?', const=0.5, required=False,
+        help='Decode with the forward-backward algorithm and train with Baum-Welch instead, '
+            + 'reporting bases whose posterior probability of high GC content is at least this (default 0.5)')
+    parser.add_argument('--checkpoint', action='store_true',
+        help='Recompute the back-pointers during the back-trace to bound memory?')
+    parser.add_argument('--jobs', type=int, default=1,
+        help='Number of processes decoding the records of a multi-record sequence at once')
+    parser.add_argument('--annotations', type=str, required=False,
+        help='Feature table (.rnt, .ptt) or GenBank file (.gbk) to compare the high GC hits against, '
+            + 'in global coordinates')
+    parser.add_argument('--stream', action='store_true',
+        help='Print each high GC hit as soon as it is known, while reading the sequence (no training)?')
+    parser.add_argument('--lag', type=int, required=False,
+        help='When streaming, also settle the bases this far behind the last one read, '
+            + 'which bounds the memory used')
     args = parser.parse_args()
 
-    # Read the sequence in as a string
-    with open(args.sequence) as f:
-        sequence = f.read().strip()
-
-    # Handle sequence files
-    if os.path.splitext(args.sequence)[1] == FASTA:
-        sequence = process_fasta(sequence)
-    else:
-        print 'Unknown sequence file format'
+    # If specified, time each phase and profile everything
+    timer = NO_TIMER
+    if args.time is not None:
+        timer = PhaseTimer(sys.stderr if args.time == '-' else open(args.time, 'w'))
+    profiler = None
+    if args.profile is not None:
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    # Load the annotations
+    annotations = None
+    if args.annotations is not None:
+        annotations = load_annotations(args.annotations)
+        if annotations is None:
+            print 'Unknown annotation file format'
+            exit()
+
+    # Streaming decodes the sequence as it is read
+    if args.stream or args.lag is not None or args.sequence == '-':
+        if args.sequence != '-' and os.path.splitext(args.sequence)[1] != FASTA:
+            print 'Unknown sequence file format'
+            exit()
+        if args.outE is not None or args.outT is not None or args.posterior is not None \
+                or (args.iterations or 1) > 1 or args.until_converged is not None:
+            print 'Streaming only decodes, with the Viterbi algorithm'
+            exit()
+
+        with timer.phase('matrix loading'):
+            model = load_hmm(args.inE, args.inT, args.inI)
+        highGC = model.states[-1]
+
+        hits = []
+        print 'High GC content hits (one-based index, global and within each record):'
+        print '     Start | End | Record:Start-End'
+        sys.stdout.flush()
+        f = sys.stdin if args.sequence == '-' else open(args.sequence)
+        for name, offset, start, end, state in run_streaming_viterbi(model, f, args.lag, timer):
+            if state == highGC:
+                hits.append((offset + start, offset + end))
+                print '%*d | %d | %s:%d-%d' % (10, offset + start + 1, offset + end + 1, name, start + 1, end + 1)
+                sys.stdout.flush()
+        print 'Number of high GC content hits: %d' % len(hits)
+        if annotations is not None:
+            with timer.phase('evaluation'):
+                print_evaluation(annotations, hits)
+        timer.report()
+
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
         exit()
 
-    # Load the the emission probability matrix
-    with open(args.inE) as f:
-        emission = json.load(f)
-
-        # JSON doesn't support integer keys
-        # But the states are defined as integers
-        # So convert it here
-        for key in emission.keys():
-            EMISSION_PROBABILITY[int(key)] = emission[key]
-
-    # Load the the transition probability matrix
-    with open(args.inT) as f:
-        transition = json.load(f)
-
-        # Again, JSON doesn't support integer keys
-        for key in transition.keys():
-            subTransition = {}
-            for subkey in transition[key]:
-                subTransition[int(subkey)] = transition[key][subkey]
-            TRANSITION_PROBABILITY[int(key)] = subTransition
-
-    # If specified, time the iteration
-    if args.time:
-        startTime = time.clock()
-
-    # Run the Viterbi algorithm
-    results, max_prob = run_viterbi(sequence)
-
-    # Print the results
-    print 'Viterbi log probability: %f' % max_prob
-    print 'Number of high GC content hits: %d' % len(results[STATE_HIGH_GC])
-    if args.verbose:
-        print 'High GC content hits (one-based index):'
-        print '     Start | End '
-        for item in results[STATE_HIGH_GC]:
-            print '%*d | %d' % (10, item[0] + 1, item[1] + 1)
-
-    # Train the new emission matrix
+    # Read the sequence in as a string
+    with timer.phase('FASTA parsing'):
+        with open(args.sequence) as f:
+            sequence = f.read().strip()
+
+        # Handle sequence files
+        if os.path.splitext(args.sequence)[1] == FASTA:
+            records = process_fasta_records(sequence)
+        else:
+            print 'Unknown sequence file format'
+            exit()
+    names = [record[0] for record in records]
+    bases = sum([len(record[1]) for record in records])
+
+    # Global coordinates run through every record, in order
+    offsets = numpy.cumsum([0] + [len(record[1]) for record in records]).tolist()
+
+    # Load the Hidden Markov Model
+    with timer.phase('matrix loading'):
+        model = load_hmm(args.inE, args.inT, args.inI)
+    highGC = model.states[-1]
+
+    # The sequences are only encoded once for all iterations
+    with timer.phase('encoding', bases):
+        records = [model.encode(record[1]) for record in records]
+    timer.report()
+
+    # Each process of the pool gets its own copy of the records, once
+    pool = None
+    if args.jobs > 1 and len(records) > 1:
+        pool = multiprocessing.Pool(args.jobs, _initialize_worker, (records,))
+
+    iterations = args.iterations
+    if iterations is None:
+        iterations = 1 if args.until_converged is None else MAX_ITERATIONS
+
+    previous_prob = None
+    for iteration in range(1, iterations + 1):
+        with timer.phase('iteration', bases):
+            # Run the Viterbi or forward-backward algorithm on every record
+            decoded = decode_records(model, records, args.posterior, args.checkpoint, pool, timer)
+
+            # The records are independent, so their probabilities multiply
+            #   and their training counts add up
+            max_prob = sum([output[1] for output in decoded])
+            counts = (sum([output[2][0] for output in decoded]),
+                      sum([output[2][1] for output in decoded]))
+
+            # Print the results
+            # Also saving them, numbered after the matrices that were decoded
+            if iterations > 1:
+                print 'Iteration %d' % iteration
+            results = _number_filename(args.results, iteration - 1) if args.results else None
+            with _saving_output(results):
+                if args.posterior is None:
+                    print 'Viterbi log probability: %f' % max_prob
+                else:
+                    print 'Forward log probability: %f' % max_prob
+                print 'Number of high GC content hits: %d' % sum([len(output[0][highGC]) for output in decoded])
+                if args.verbose and len(records) == 1:
+                    print 'High GC content hits (one-based index):'
+                    print '     Start | End '
+                    for item in decoded[0][0][highGC]:
+                        print '%*d | %d' % (10, item[0] + 1, item[1] + 1)
+                elif args.verbose:
+                    print 'High GC content hits (one-based index, global and within each record):'
+                    print '     Start | End | Record:Start-End'
+                    for index, output in enumerate(decoded):
+                        for item in output[0][highGC]:
+                            print '%*d | %d | %s:%d-%d' % (10, offsets[index] + item[0] + 1, offsets[index] + item[1] + 1,
+                                                           names[index], item[0] + 1, item[1] + 1)
+                if annotations is not None:
+                    with timer.phase('evaluation'):
+                        print_evaluation(annotations, [(offsets[index] + item[0], offsets[index] + item[1])
+                                for index, output in enumerate(decoded) for item in output[0][highGC]])
+
+            # Train the new matrices
+            # The last iteration only trains the matrices that are saved
+            emission = model.emission
+            transition = model.transition
+            if args.outE is not None or iteration < iterations:
+                with timer.phase('emission training'):
+                    run_emission_training(model, counts)
+            if args.outT is not None or iteration < iterations:
+                with timer.phase('transition training'):
+                    run_transition_training(model, counts)
+
+            # Save the intermediate matrices
+            # Every iteration but the last trains both matrices
+            if args.intermediate and iteration < iterations:
+                model.save_emission(_number_filename(args.inE, iteration))
+                model.save_transition(_number_filename(args.inT, iteration))
+
+        timer.report(iteration=iteration)
+
+        # Check for convergence
+        if args.until_converged is not None and iteration < iterations:
+            change = numpy.max(numpy.abs(numpy.concatenate((
+                    numpy.ravel(model.emission - emission),
+                    numpy.ravel(model.transition - transition)))))
+            if change <= args.until_converged or (previous_prob is not None
+                    and abs(max_prob - previous_prob) <= args.until_converged):
+                print 'Converged after %d iterations' % iteration
+                break
+        previous_prob = max_prob
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    # Save the trained matrices
     if args.outE is not None:
-        run_emission_training(sequence, results)
-        with open(args.outE, 'w') as f:
-            json.dump(EMISSION_PROBABILITY, f, indent=2)
-
-    # Train the new transition matrix
+        model.save_emission(args.outE)
     if args.outT is not None:
-        run_transition_training(results)
-        with open(args.outT, 'w') as f:
-            json.dump(TRANSITION_PROBABILITY, f, indent=2)
-
-    # If specified, print the time elapsed
-    if args.time:
-        elapsed = (time.clock() - startTime)
-        print 'Iteration time %f seconds' % elapsed
+        model.save_transition(args.outT)
 
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(args.profile)
@@ -4,74 +4,374 @@ import argparse
 import re
 import json
 import time
+import shutil
+import tempfile
+import multiprocessing
 import numpy
 
 # Import some helper functions and globals
-from shared import *
+from reads import *
+from mismatches import *
 
 """
-File extension indicating that an input file should be parsed as a SAM file
+Number of shards of the input filtered by each process (see --jobs)
+  More shards than processes keeps every process busy when some shards filter faster
 """
-SAM_FILE = '.sam'
+SHARDS_PER_JOB = 4
 
-def parse_SAM_data(line):
+"""
+Options of filter.py that each stage of a pipeline may set (see compile_pipeline)
+"""
+STAGE_OPTIONS = ['dereverse', 'matches_only', 'min_mismatch', 'max_align_score', 'min_polyAlen',
+                 'min_UTRlen', 'max_non_tail_mismatches', 'compute_background', 'background_width']
+
+"""
+File extension of the summary saved next to each output (see --save_summaries)
+"""
+SUMMARY_FILE = '.out'
+
+def _concatenate(strings):
+    """
+    Helper for count_background
+    Joins the given strings into a single NumPy array of bytes
+    Returns a tuple of (bytes, start of each string, end of each string)
+    """
+
+    text = ''.join(strings)
+    if isinstance(text, unicode):
+        text = text.encode('ascii', 'replace')
+
+    lengths = numpy.array([len(string) for string in strings], dtype=int)
+    ends = numpy.cumsum(lengths)
+    return numpy.frombuffer(text, dtype=numpy.uint8), ends - lengths, ends
+
+def poly_tail_lengths(sequences, reverse):
+    """
+    Finds the length of the poly-A tail of each of the given sequences
+        or of the leading poly-T tail of the sequences marked in the reverse mask
+    Same as POLY_A_TAIL_SEARCH_REGEX (or POLY_T_TAIL_SEARCH_REGEX), without the regex
+    Returns a NumPy array of lengths, where 0 means the sequence has no tail
+    """
+
+    return numpy.array([len(sequence) - len(sequence.lstrip(POLY_T_BASES) if isReverse
+                                             else sequence.rstrip(POLY_A_BASES))
+                        for sequence, isReverse in zip(sequences, reverse.tolist())], dtype=int)
+
+def utr_lengths(sequences):
+    """
+    Finds the length of the UTR region of each of the given sequences
+        which ends where the poly-A tail starts (see POLY_A_TAIL_SEARCH_REGEX)
+    Returns a NumPy array of lengths
+    """
+
+    return numpy.array([len(sequence) for sequence in sequences], dtype=int) \
+        - poly_tail_lengths(sequences, numpy.zeros(len(sequences), dtype=bool))
+
+def count_background(sequences, width=WMM_LENGTH):
+    """
+    Counts the nucleotides at each position of every window of the given width of the given sequences
+    Same as adding up count_wmm_windows(matrixify_sequence(sequence), width)
+        but over every sequence at once
+    Returns a 4 by width matrix
+    """
+
+    bases, starts, ends = _concatenate(sequences)
+    windowed = ends - starts >= width
+
+    # Every base of a sequence with a window is seen by each position of the WMM,
+    #   except for the bases too close to the start or end to fit the rest of the window
+    total = numpy.bincount(bases[numpy.repeat(windowed, ends - starts)], minlength=256)
+    starts = starts[windowed]
+    ends = ends[windowed]
+    heads = [numpy.bincount(bases[starts + offset], minlength=256) for offset in range(width - 1)]
+    tails = [numpy.bincount(bases[ends - 1 - offset], minlength=256) for offset in range(width - 1)]
+
+    counts = numpy.zeros((4, width))
+    for column in range(width):
+        seen = total - sum(heads[:column], 0) - sum(tails[:(width - 1 - column)], 0)
+        counts[:, column] = numpy.dot(seen, BASE_COUNTS)
+    return counts
+
+def _cached(cache, name, reads, size, compute):
+    """
+    Helper for the filters of compile_filters
+    Returns the named value of each of the given reads out of a batch of the given size
+        only computing (with compute(reads)) the values not yet in the cache
+    """
+
+    if name not in cache:
+        cache[name] = numpy.full(size, -1, dtype=int)
+    values = cache[name]
+    missing = reads[values[reads] < 0]
+    if len(missing) > 0:
+        values[missing] = compute(missing)
+    return values[reads]
+
+def _tail_lengths(batch, reads, cache):
+    """
+    Helper for the filters of compile_filters
+    Finds the length of the poly-A tail of each of the given reads (see poly_tail_lengths)
+        accounting for reverse complements
+    """
+
+    return _cached(cache, 'tails', reads, len(batch), lambda missing: poly_tail_lengths(
+        batch.values(SAM_SEQ, missing), batch.flags[missing] & SAM_REV_COMPLEMENT_FLAG_MASK != 0))
+
+def _sequence_lengths(batch, reads, cache):
+    """
+    Helper for the filters of compile_filters
+    Finds the length of each of the given reads
+    """
+
+    return _cached(cache, 'lengths', reads, len(batch), lambda missing: numpy.array(
+        [len(sequence) for sequence in batch.values(SAM_SEQ, missing)], dtype=int))
+
+def _decoded_mismatches(batch, cache):
+    """
+    Helper for the filters of compile_filters
+    Decodes the mismatching positions of every read of the batch once (see decode_mismatches)
+    Returns a tuple of (MismatchTable, mask of the reads that were reverse complements when decoded)
+        Dereversing a read afterwards reverses both, so the counts of the table stay the same
+    """
+
+    if 'mismatches' not in cache:
+        cache['mismatches'] = (decode_mismatches(batch.column(SAM_MSMAT)),
+                               batch.flags & SAM_REV_COMPLEMENT_FLAG_MASK != 0)
+    return cache['mismatches']
+
+def _matches_only(batch, reads, value, cache):
+    """
+    Helper for compile_filters
+    Removes all sequences that are unmapped
+    """
+
+    return batch.flags[reads] & SAM_UNMAPPED_FLAG_MASK == 0
+
+def _min_mismatch(batch, reads, value, cache):
+    """
+    Helper for compile_filters
+    Removes all sequences that strongly match the reference
+    """
+
+    return ~batch.hasNumMismatches[reads] | (batch.numMismatches[reads] >= value)
+
+def _max_align_score(batch, reads, value, cache):
+    """
+    Helper for compile_filters
+    Filters out sequences with high scores
+    """
+
+    return ~batch.hasAlignScores[reads] | (batch.alignScores[reads] <= value)
+
+def _min_polyAlen(batch, reads, value, cache):
+    """
+    Helper for compile_filters
+    Removes all sequences without a significant poly-A tail (a length of 0 means there is no tail)
     """
-    Takes a tab-delimited line of processed mapping data in SAM format
-    And parses it into a dictionary of appropriate values
+
+    tails = _tail_lengths(batch, reads, cache)
+    return (tails > 0) & (tails >= value)
+
+def _min_UTRlen(batch, reads, value, cache):
+    """
+    Helper for compile_filters
+    Removes all sequences with a short UTR region
+    """
+
+    tails = _tail_lengths(batch, reads, cache)
+    return (tails == 0) | (_sequence_lengths(batch, reads, cache) - tails >= value)
+
+def _max_non_tail_mismatches(batch, reads, value, cache):
+    """
+    Helper for compile_filters
+    Removes all sequences with major mismatching in the 3' UTR
+        counting the UTR region from the other end of reverse complements
     """
 
-    result = {}
-    tokens = line.strip().split('\t')
+    table, reverse = _decoded_mismatches(batch, cache)
+    utrLengths = _sequence_lengths(batch, reads, cache) - _tail_lengths(batch, reads, cache)
+    return table.count_non_tail(reads, utrLengths, reverse[reads]) <= value
 
-    # Capture the 11 mandatory fields in order
-    result[SAM_QNAME] = tokens[ 0]
-    result[SAM_FLAG ] = tokens[ 1]
-    result[SAM_RNAME] = tokens[ 2]
-    result[SAM_POS  ] = tokens[ 3]
-    result[SAM_MAPQ ] = tokens[ 4]
-    result[SAM_CIGAR] = tokens[ 5]
-    result[SAM_RNEXT] = tokens[ 6]
-    result[SAM_PNEXT] = tokens[ 7]
-    result[SAM_TLEN ] = tokens[ 8]
-    result[SAM_SEQ  ] = tokens[ 9]
-    result[SAM_QUAL ] = tokens[10]
+"""
+Filters of filter.py, from the cheapest to the most expensive (see compile_filters)
+  Each is the option choosing the filter and a function of (batch, NumPy array of indices of reads,
+  value of the option, cache shared by the filters of a batch) returning a mask of the reads passing
+"""
+FILTERS = [
+    ('matches_only', _matches_only),
+    ('min_mismatch', _min_mismatch),
+    ('max_align_score', _max_align_score),
+    ('min_polyAlen', _min_polyAlen),
+    ('min_UTRlen', _min_UTRlen),
+    ('max_non_tail_mismatches', _max_non_tail_mismatches)
+]
 
-    # Parse the remaining interesting optional fields
-    for token in tokens[11:]:
-        if token.startswith(SAM_A_SCR):
-            result[SAM_A_SCR] = token[len(SAM_A_SCR):]
+def compile_filters(options):
+    """
+    Chooses the filters (see FILTERS) set in the given dictionary of options of filter.py
+    Returns a list of (option, filter function, value of the option), from the cheapest filter
+    """
 
-        elif token.startswith(SAM_NUMMM):
-            result[SAM_NUMMM] = token[len(SAM_NUMMM):]
+    return [(option, function, options[option]) for option, function in FILTERS if options.get(option)]
 
-        elif token.startswith(SAM_MSMAT):
-            result[SAM_MSMAT] = token[len(SAM_MSMAT):]
+def filter_batch(batch, filters, reads, cache):
+    """
+    Runs the given compiled filters (see compile_filters) over the given reads of a batch, in order
+        so each filter only sees the reads passing every cheaper filter
+    Returns a tuple of (NumPy array of indices of the reads passing every filter,
+        list of the number of reads removed by each filter)
+    """
 
-    return result
+    rejected = [0] * len(filters)
+    for index, (option, function, value) in enumerate(filters):
+        if len(reads) == 0:
+            break
+        passed = function(batch, reads, value, cache)
+        rejected[index] = len(reads) - numpy.count_nonzero(passed)
+        reads = reads[passed]
+    return reads, rejected
 
-def sam_generator(filename):
+def compile_pipeline(spec):
     """
-    Opens the given SAM file and iterates over the file
-    Each iteration parses and returns a single sequence with its mapping data
+    Compiles a pipeline of filters, given as a list of stages
+        Each stage is a dictionary with a name, an output file (in JSON or a read set),
+        any of the options of filter.py (see STAGE_OPTIONS), and the name of the stage
+        whose output it filters (the input file of the pipeline if missing)
+        Every stage must come after the stage it filters
+    Returns a list of the stages, each a dictionary of its options
+        with the index of the stage it filters (None for the input file), its compiled filters
+        (see compile_filters), and whether it sees dereversed reads (see filter_reads)
     """
 
-    with open(filename, 'r') as file:
-        for line in file:
-            # Skip headers
-            if line.startswith('@'):
-                continue
+    names = {}
+    stages = []
+    for stage in spec:
+        for key in stage:
+            assert key in ['name', 'input', 'output'] + STAGE_OPTIONS, \
+                'Unknown option "%s" of stage "%s"' % (key, stage.get('name'))
+        assert 'name' in stage and 'output' in stage, 'Every stage requires a name and an output'
+        assert stage['name'] not in names, 'Stage "%s" is named twice' % stage['name']
+        assert stage.get('input') is None or stage['input'] in names, \
+            'Stage "%s" must come after the stage "%s" it filters' % (stage['name'], stage['input'])
+        assert split_extension(stage['output'])[1] in [JSON_FILE, READS_FILE], \
+            'File "%s" requires %s or %s extension' % (stage['output'], JSON_FILE, READS_FILE)
+        if stage.get('compute_background'):
+            assert_is_json_file(stage['compute_background'])
 
-            # Parse sequence mapping data
+        compiled = dict([(option, stage.get(option)) for option in STAGE_OPTIONS])
+        compiled['name'] = stage['name']
+        compiled['output'] = stage['output']
+        compiled['input'] = names.get(stage.get('input'))
+        compiled['background_width'] = stage.get('background_width') or WMM_LENGTH
+        compiled['filters'] = compile_filters(stage)
+        compiled['dereversed'] = bool(stage.get('dereverse')) or \
+            (compiled['input'] is not None and stages[compiled['input']]['dereversed'])
+        names[stage['name']] = len(stages)
+        stages.append(compiled)
+    return stages
+
+def filter_reads(stages, filename, outputs, limit=None, start=0, end=None):
+    """
+    Runs a compiled pipeline (see compile_pipeline) over the reads of the given file
+        or only those in the given range of bytes (see batch_boundaries), reading the file once
+    Writes the reads passing each stage to the output file opened for it, in JSON or as a read set
+    Returns a list of the statistics of each stage, as a dictionary of the number of reads,
+        the number of reads passing, the number of reads removed by each filter,
+        and the list of the background counted from the reads not passing, one per batch
+    """
+
+    statistics = [{'reads': 0, 'passed': 0, 'rejected': [0] * len(stage['filters']), 'backgrounds': []}
+                  for stage in stages]
+
+    # Reads are only dereversed in place, so the stages that see them as they are in the file run first
+    #   Dereversing a read that an unrelated stage has already dereversed changes nothing
+    order = sorted(range(len(stages)), key=lambda index: stages[index]['dereversed'])
+
+    # Since the input file might not fit in memory
+    # Use a generator to read in and process the file a batch of reads at a time
+    # Every filter runs over the whole batch at once
+    for batch in read_batches(filename, limit, start, end):
+        passing = [None] * len(stages)
+        cache = {}
+        for index in order:
+            stage = stages[index]
+            reads = numpy.arange(len(batch)) if stage['input'] is None else passing[stage['input']]
+
+            # Transform reverse complements into non-reverse complements
+            if stage['dereverse']:
+                reverse = numpy.zeros(len(batch), dtype=bool)
+                reverse[reads] = batch.flags[reads] & SAM_REV_COMPLEMENT_FLAG_MASK != 0
+                batch.dereverse(reverse)
+
+            passing[index], rejected = filter_batch(batch, stage['filters'], reads, cache)
+            stageStatistics = statistics[index]
+            stageStatistics['reads'] += len(reads)
+            stageStatistics['passed'] += len(passing[index])
+            stageStatistics['rejected'] = [total + count for total, count in zip(stageStatistics['rejected'], rejected)]
+
+            # Data passed the filter, so save it
+            if split_extension(stage['output'])[1] == READS_FILE:
+                write_read_set(outputs[index], batch, passing[index])
             else:
-                yield parse_SAM_data(line)
+                outputs[index].writelines(batch.to_json(passing[index]))
+
+            # Count and aggregate the nucleotide frequencies of the data not passing the filter
+            if stage['compute_background']:
+                sequences = batch.values(SAM_SEQ, numpy.setdiff1d(reads, passing[index]))
+                stageStatistics['backgrounds'].append(count_background(sequences, stage['background_width']))
+
+    return statistics
+
+def _filter_worker(task):
+    """
+    Helper for filter.py --jobs
+    Filters one shard of the input file into its own part of each output
+    """
+
+    stages, filename, start, end, partNames = task
+    outputs = [open(partName, 'wb') for partName in partNames]
+    statistics = filter_reads(stages, filename, outputs, None, start, end)
+    for output in outputs:
+        output.close()
+    return statistics
+
+def _append_part(output, partName):
+    """
+    Helper for filter.py --jobs
+    Appends a part of the output to the output, then deletes the part
+    Every part of a read set starts with READS_MAGIC, which is only written once
+    Parts are never compressed, so a compressed output is compressed as the parts are appended
+    """
+
+    with open(partName, 'rb') as part:
+        if split_extension(output.name)[1] == READS_FILE and os.path.getsize(partName) > 0:
+            part.seek(len(READS_MAGIC))
+            if output.tell() == 0:
+                output.write(READS_MAGIC)
+        shutil.copyfileobj(part, output)
+    os.remove(partName)
+
+def _stage_summary(stage, stageStatistics):
+    """
+    Helper for filter.py --save_summaries
+    Describes how many reads passed the stage, and how many each filter removed
+    """
+
+    summary = '%d lines of input -> %d lines of output\n' % (stageStatistics['reads'], stageStatistics['passed'])
+    for (option, function, value), rejected in zip(stage['filters'], stageStatistics['rejected']):
+        summary += '  --%s%s removed %d\n' % (option, '' if value is True else ' %s' % value, rejected)
+    return summary
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
-            description='Opens a SAM file or a processed SAM file (exported in JSON) and performs the specified set of filtering operations')
-    parser.add_argument('file', type=str, help='A SAM or previously filtered SAM file')
-    parser.add_argument('output', type=str, help='Output JSON file.  Note: every line of the file will contain a JSON string')
+            description='Opens a SAM file or a processed SAM file (exported in JSON or as a read set) and performs the specified set of filtering operations')
+    parser.add_argument('file', type=str, help='A SAM or previously filtered SAM file, compressed if it ends in %s' % GZIP_FILE)
+    parser.add_argument('output', type=str, nargs='?', help='Output JSON file or read set (not used with --pipeline), compressed into BGZF if it ends in %s.  Note: every line of a JSON file will contain a JSON string' % GZIP_FILE)
     parser.add_argument('--limit', type=int, required=False, help='How many lines of input should be read?')
     parser.add_argument('--verbose', action='store_true', help='Should progress and summary statistics be printed?')
+    parser.add_argument('--jobs', type=int, default=1, help='Number of processes filtering separate parts of the input at once (ignored with --limit)')
+    parser.add_argument('--pipeline', type=str, help='JSON list of stages of filters to run in one pass over the input, instead of the filtering parameters; each stage has a name, an output, any filtering parameters (i.e. "min_polyAlen"), and the name of the stage whose output it filters as its "input", if any')
+    parser.add_argument('--save_summaries', action='store_true', help='Should the number of reads passing each stage of a pipeline also be saved next to its output (with a %s extension)?' % SUMMARY_FILE)
     parser.add_argument('--dereverse', action='store_true', help='Should any reverse complements be reversed and complemented into "ordinary" sequences?')
 
     # Filtering parameters
@@ -81,161 +381,96 @@ if __name__ == '__main__':
     parser.add_argument('--min_polyAlen', type=int, help='Filters out data with a trailing poly-A tail of less than (exclusive) the given length')
     parser.add_argument('--min_UTRlen', type=int, help='Filters out data with a leading 3\' UTR region of less than (exclusive) the given length')
     parser.add_argument('--max_non_tail_mismatches', type=int, help='Filters out data which contains more than (exclusive) the given number of mismatches in the non-tail region')
-    parser.add_argument('--compute_background', type=str, help='For all data not passing the filter, adds the data to a 6mer weight matrix model of the background')
+    parser.add_argument('--compute_background', type=str, help='For all data not passing the filter, adds the data to a weight matrix model of the background (see --background_width)')
+    parser.add_argument('--background_width', type=int, default=WMM_LENGTH, help='Length of the motifs of the background model (default %d)' % WMM_LENGTH)
 
     args = parser.parse_args()
     
     # Keep track of how much time this filter requires
+    # The processes of the pool are only counted in wall time
+    clock = time.clock if args.jobs <= 1 else time.time
     startTime = 0
     if args.verbose:
-        startTime = time.clock()
-
-    # Handle input parsing
-    fileext = os.path.splitext(args.file)[1]
-    iterator = None
-    if fileext == SAM_FILE:
-        iterator = sam_generator(args.file)
-    elif fileext == JSON_FILE:
-        iterator = json_generator(args.file)
+        startTime = clock()
+
+    # Without a pipeline, the filtering parameters make up a pipeline of one stage
+    spec = None
+    if args.pipeline:
+        assert_is_json_file(args.pipeline)
+        with open(args.pipeline, 'r') as f:
+            spec = json.load(f)
     else:
-        print 'Unknown input file format'
-        exit()
+        assert args.output is not None, 'An output file or --pipeline is required'
+        spec = [dict([(option, getattr(args, option)) for option in STAGE_OPTIONS]
+                     + [('name', args.output), ('output', args.output)])]
+    stages = compile_pipeline(spec)
 
-    # Open up the output file for writing
-    assert_is_json_file(args.output)
-    output = open(args.output, 'w')
-    
-    # Check the background model output file for correctness
-    if args.compute_background:
-        assert_is_json_file(args.compute_background)
+    # Open up the output files for writing
+    # Reads are exported in JSON or written to a read set, either of which may be compressed
+    outputs = [open_stream(stage['output'], 'wb') for stage in stages]
 
-    # Since the input file might not fit in memory
-    # Use a generator to read in and process the file line by line
-    counter = 0
-    outputLines = 0
-    backgroundModel = numpy.zeros((4, WMM_LENGTH))
-    for data in iterator:
-        # Limit the number of input lines read (for debugging purposes)
-        if args.limit is not None and counter >= args.limit:
-            break
-        counter += 1
-        
-        # Transform reverse complements into a non-reverse complement
-        if args.dereverse and int(data[SAM_FLAG]) & SAM_REV_COMPLEMENT_FLAG_MASK:
-            # Reverse and complement the relevant fields
-            data[SAM_SEQ] = complement_sequence(data[SAM_SEQ][::-1])
-            data[SAM_QUAL] = data[SAM_QUAL][::-1]
-            if SAM_MSMAT in data:
-                mismatches = ''.join(MISMATCH_SEARCH_REGEX.findall(data[SAM_MSMAT])[::-1])
-                data[SAM_MSMAT] = complement_sequence(mismatches)
-            
-            # Flip the relevant flag bits
-            data[SAM_FLAG] = int(data[SAM_FLAG]) ^ (SAM_REV_COMPLEMENT_FLAG_MASK | SAM_TRANSFORMED_REV_COMP_FLAG_MASK)
-        
-        # Count and aggregate the nucleotide frequencies
-        backgroundDelta = None
-        if args.compute_background:
-            backgroundDelta = matrixify_sequence(data[SAM_SEQ])
-            aggregator = get_wmm_count_aggregator(len(data[SAM_SEQ]))
-            backgroundDelta = numpy.dot(backgroundDelta, aggregator)
-            
-            # Save the delta
-            backgroundModel += backgroundDelta
-
-        # Remove all sequences that are unmapped
-        if args.matches_only:
-            if int(data[SAM_FLAG]) & SAM_UNMAPPED_FLAG_MASK:
-                continue
-
-        # Remove all sequences that strongly match the reference
-        if args.min_mismatch and SAM_NUMMM in data:
-            if int(data[SAM_NUMMM]) < args.min_mismatch:
-                continue
-
-        # Filter out sequences with high scores
-        if args.max_align_score and SAM_A_SCR in data:
-            if int(data[SAM_A_SCR]) > args.max_align_score:
-                continue
-
-        # Find the poly-A tail region if necessary
-        tail = None
-        if args.min_polyAlen or args.max_non_tail_mismatches:
-            regex = POLY_A_TAIL_SEARCH_REGEX
-
-            # Account for reverse complements
-            if int(data[SAM_FLAG]) & SAM_REV_COMPLEMENT_FLAG_MASK:
-                regex = POLY_T_TAIL_SEARCH_REGEX
-
-            tail = regex.search(data[SAM_SEQ])
-        if tail is not None:
-            tail = tail.groups()[0]
-
-        # Remove all sequences without a significant poly-A tail
-        if args.min_polyAlen:
-            if tail is None or len(tail) < args.min_polyAlen:
-                continue
-                
-        # Remove all sequences with a short UTR region
-        if args.min_UTRlen and tail is not None:
-            if len(data[SAM_SEQ]) - len(tail) < args.min_UTRlen:
-                continue
-
-        # Remove all sequences with major mismatching in the 3' UTR
-        # Note: to prevent too much code duplication, 
-        #         this filter only runs on "ordinary" sequences
-        if args.max_non_tail_mismatches and SAM_MSMAT in data \
-                and not int(data[SAM_FLAG]) & SAM_REV_COMPLEMENT_FLAG_MASK:
-            tailIndex = len(data[SAM_SEQ]) - (0 if tail is None else len(tail))
-
-            # Count mismatches up until the tail index is hit
-            misCount = 0
-            misIndex = 0
-            mismatches = MISMATCH_SEARCH_REGEX.findall(data[SAM_MSMAT])
-            for token in mismatches:
-                if misIndex >= tailIndex:
-                    break
-                    
-                # Token indicates a number of matches
-                try:
-                    misIndex += int(token)
-                    continue
-                except ValueError:
-                    pass
-                    
-                # Token indicates a deletion
-                if len(token) > 1:
-                    misCount += len(token) - 1
-                    misIndex += len(token) - 1
-                    
-                # Token indicates a mismatch
-                else:
-                    misCount += 1
-                    misIndex += 1
-
-            if misCount > args.max_non_tail_mismatches:
-                continue
-
-        # Data passed the filter, so save it
-        output.write(json.dumps(data))
-        output.write('\n')
-        outputLines += 1
-        
-        # Data passed the filter, so exclude it from the background
-        if args.compute_background:
-            backgroundModel -= backgroundDelta
+    # Split the input into a few shards per process, along the same batches as reading it whole
+    boundaries = [0, None]
+    if args.jobs > 1 and args.limit is None:
+        boundaries = batch_boundaries(args.file)
+        numShards = min(len(boundaries) - 1, args.jobs * SHARDS_PER_JOB)
+        boundaries = [boundaries[(index * (len(boundaries) - 1)) // numShards] for index in range(numShards + 1)]
+
+    if len(boundaries) <= 2:
+        statistics = filter_reads(stages, args.file, outputs, args.limit)
+
+    # Each shard is filtered into its own part of each output, which are put back together in order
+    else:
+        tasks = []
+        for start, end in zip(boundaries[:-1], boundaries[1:]):
+            partNames = []
+            for stage in stages:
+                handle, partName = tempfile.mkstemp(suffix=split_extension(stage['output'])[1],
+                                                    dir=os.path.dirname(os.path.abspath(stage['output'])))
+                os.close(handle)
+                partNames.append(partName)
+            tasks.append((stages, args.file, start, end, partNames))
+
+        statistics = [{'reads': 0, 'passed': 0, 'rejected': [0] * len(stage['filters']), 'backgrounds': []}
+                      for stage in stages]
+        pool = multiprocessing.Pool(args.jobs)
+        for task, shardStatistics in zip(tasks, pool.imap(_filter_worker, tasks)):
+            for output, partName, stageStatistics, shardStageStatistics in zip(outputs, task[4], statistics, shardStatistics):
+                _append_part(output, partName)
+                stageStatistics['reads'] += shardStageStatistics['reads']
+                stageStatistics['passed'] += shardStageStatistics['passed']
+                stageStatistics['rejected'] = [total + count for total, count in
+                                               zip(stageStatistics['rejected'], shardStageStatistics['rejected'])]
+                stageStatistics['backgrounds'] += shardStageStatistics['backgrounds']
+        pool.close()
+        pool.join()
+
+    # Close the output files
+    for output in outputs:
+        output.close()
+
+    for stage, stageStatistics in zip(stages, statistics):
+        # Save the background model, adding up the batches in the same order as reading the input whole
+        if stage['compute_background']:
+            backgroundModel = numpy.zeros((4, stage['background_width']))
+            for background in stageStatistics['backgrounds']:
+                backgroundModel += background
+            with open(stage['compute_background'], 'w') as f:
+                json.dump(backgroundModel.tolist(), f)
+
+        if args.save_summaries:
+            with open(split_extension(stage['output'])[0] + SUMMARY_FILE, 'w') as f:
+                f.write(_stage_summary(stage, stageStatistics))
 
-    # Close the JSON output file
-    output.close()
-    
-    # Save the background model
-    if args.compute_background:
-        with open(args.compute_background, 'w') as f:
-            json.dump(backgroundModel.tolist(), f)
-    
     if args.verbose:
         # Print how long the filter took
-        elapsed = (time.clock() - startTime)
+        elapsed = (clock() - startTime)
         print 'Filter finished in %f seconds' % elapsed
         
         # Print summary statistics about the result of the filter
-        print '%d lines of input -> %d lines of output' % (counter, outputLines)
+        if args.pipeline:
+            for stage, stageStatistics in zip(stages, statistics):
+                print '%s:' % stage['name']
+                sys.stdout.write(_stage_summary(stage, stageStatistics))
+        else:
+            print '%d lines of input -> %d lines of output' % (statistics[0]['reads'], statistics[0]['passed'])
@@ -3,17 +3,148 @@ import os
 import argparse
 import json
 import time
+import multiprocessing
 import numpy
 
 # Import some helper functions and globals
-from shared import *
+from filter import *
+
+"""
+Number of reads encoded into each padded block (see encode_reads)
+"""
+MEME_BLOCK_SIZE = 2**12
+
+"""
+Maximum number of iterations when iterating until the WMM converges
+"""
+MAX_ITERATIONS = 100
+
+def encode_reads(filename, limit=None):
+    """
+    Reads in the UTR region of every read of the given file (see utr_lengths)
+        and encodes the reads MEME_BLOCK_SIZE at a time
+    Returns a list of (matrix of codes, NumPy array of UTR lengths) blocks (see encode_sequences)
+    """
+
+    blocks = []
+    for batch in read_batches(filename, limit):
+        sequences = batch.column(SAM_SEQ)
+        for start in range(0, len(sequences), MEME_BLOCK_SIZE):
+            chosen = sequences[start:(start + MEME_BLOCK_SIZE)]
+            tails = utr_lengths(chosen)
+            codes, lengths = encode_sequences([sequence[:tail] for sequence, tail in zip(chosen, tails.tolist())])
+            blocks.append((codes, tails))
+    return blocks
+
+def run_e_step(table, block, posterior=False):
+    """
+    Applies a WMM to an encoded block of reads (see encode_reads), given its get_log_wmm_table(...)
+    The nucleotides of each window are added up, weighted by the probability of the WMM matching the window
+    Each read is assumed to hold the motif once, in any of its windows with equal chance
+        so with posterior, each window is instead weighted by the chance that it is the one
+        (adding up to 1 for each read)
+    Returns a tuple of (4 by width matrix of weighted counts, the same width as the WMM,
+        log likelihood of the reads, given the chance of the WMM matching each window)
+    """
+
+    codes, tails = block
+    width = table.shape[1]
+    scores = apply_log_odds_to_sequences(table, codes, tails)
+    numWindows = scores.shape[1]
+
+    # Reads too short for a window (or that the WMM cannot match) are left out
+    maxScores = numpy.max(scores, 1) if numWindows > 0 else numpy.zeros(len(tails))
+    windowed = maxScores > -numpy.inf
+    maxScores[~windowed] = 0
+    weights = numpy.exp(scores - maxScores[:, None])
+    totals = numpy.sum(weights, 1)
+    totals[~windowed] = 1
+    if posterior:
+        weights /= totals[:, None]
+    else:
+        weights *= numpy.exp(maxScores)[:, None]
+
+    # Each window of a read has the same chance of holding the motif
+    numReadWindows = numpy.maximum(tails - width + 1, 1)
+    logLikelihood = numpy.sum((maxScores + numpy.log(totals) - numpy.log(numReadWindows))[windowed])
+
+    # Each position of the WMM sees the nucleotides of every window, shifted by its index
+    counts = numpy.zeros((4, width))
+    for index in range(width):
+        codeCounts = numpy.bincount(codes[:, index:(index + numWindows)].ravel(), weights.ravel(), len(CODE_COUNTS))
+        counts[:, index] = numpy.dot(codeCounts, CODE_COUNTS)
+    return counts, logLikelihood
+
+"""
+Encoded blocks of reads held by each process of the pool (see run_meme_iteration)
+"""
+_worker_blocks = None
+
+def _initialize_worker(blocks):
+    """
+    Helper for run_meme_iteration
+    Hands the encoded blocks of reads to a process of the pool, once
+    """
+
+    global _worker_blocks
+    _worker_blocks = blocks
+
+def _e_step_worker(task):
+    """
+    Helper for run_meme_iteration
+    Runs the E-step on one of the blocks held by this process of the pool
+    """
+
+    table, index, posterior = task
+    return run_e_step(table, _worker_blocks[index], posterior)
+
+def run_meme_iteration(model, blocks, pool=None, posterior=False):
+    """
+    Runs one iteration of the MEME algorithm with the given normalized WMM
+        over every encoded block of reads (see encode_reads)
+        If given a pool started with _initialize_worker(blocks),
+        the blocks are run in parallel and their counts added up
+    See run_e_step(...) for posterior
+    Returns a tuple of (4 by width matrix of weighted counts, the same width as the WMM,
+        log likelihood of the reads)
+    """
+
+    table = get_log_wmm_table(model)
+    if pool is None:
+        results = [run_e_step(table, block, posterior) for block in blocks]
+    else:
+        results = pool.map(_e_step_worker, [(table, index, posterior) for index in range(len(blocks))])
+
+    counts = sum([result[0] for result in results], numpy.zeros(model.shape))
+    return counts, sum([result[1] for result in results])
+
+def random_wmms(count, width=WMM_LENGTH, seed=None):
+    """
+    Draws the given number of random normalized WMMs of the given width
+    The same seed always draws the same WMMs
+    """
+
+    random = numpy.random.RandomState(seed)
+    return [random.dirichlet(numpy.ones(4), width).T for index in range(count)]
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
-            description='Takes a weight matrix model and a filtered SAM file (exported in JSON) and runs one iteration of the MEME algorithm on the WMM and data.  Outputs a new WMM')
+            description='Takes a weight matrix model and a filtered SAM file (exported in JSON or as a read set) and runs the MEME algorithm on the WMM and data.  Outputs a new WMM')
     parser.add_argument('wmm', type=str, help='A weight matrix model')
-    parser.add_argument('file', type=str, help='A filtered SAM file')
+    parser.add_argument('file', type=str, help='A filtered SAM file, compressed if it ends in %s' % GZIP_FILE)
     parser.add_argument('output', type=str, help='Where to store the calculated weight matrix model')
+    parser.add_argument('--iterations', type=int, required=False,
+        help='Number of iterations of the MEME algorithm (default 1, or %d when converging)' % MAX_ITERATIONS)
+    parser.add_argument('--until_converged', type=float, required=False,
+        help='Stop iterating once the log likelihood or every probability of the WMM changes by at most this much')
+    parser.add_argument('--starts', type=int, default=0,
+        help='Number of random WMMs (as wide as the given WMM) to also start from; the start with the best log likelihood is saved')
+    parser.add_argument('--seed', type=int, required=False, help='Seed of the random starting WMMs')
+    parser.add_argument('--posterior', action='store_true',
+        help='Weight the windows of each read by the chance that it is the one holding the motif, '
+            + 'instead of by the probability of the WMM matching it (better for iterating until converged)')
+    parser.add_argument('--jobs', type=int, default=1,
+        help='Number of processes running each iteration over blocks of reads at once')
     parser.add_argument('--verbose', action='store_true', help='Should progress and summary statistics be printed?')
 
     args = parser.parse_args()
@@ -31,35 +162,64 @@ if __name__ == '__main__':
     model = normalize_wmm(model)
 
     # Handle SAM input
-    assert_is_json_file(args.file)
-    iterator = json_generator(args.file)
+    # The reads are only encoded once for all iterations
+    blocks = encode_reads(args.file)
 
     # Open the WMM output file
     output = open(args.output, 'w')
 
-    # Use a generator to read in and process the file line by line
-    memeModel = numpy.zeros((4, WMM_LENGTH))
-    for data in iterator:
-        # Find the location of the tail
-        tail = POLY_A_TAIL_SEARCH_REGEX.search(data[SAM_SEQ])
-        tail = len(data[SAM_SEQ]) if tail is None else tail.start()
-
-        # Extract the UTR region of the sequence
-        sequence = matrixify_sequence(data[SAM_SEQ][:tail])
-        
-        # Apply the WMM to the sequence
-        scores = apply_wmm_to_sequence(model, sequence)
-        
-        # Add up the weighted scores and add that to the new model
-        aggregator = get_wmm_count_aggregator(probabilities=scores)
-        modelDelta = numpy.dot(sequence, aggregator)
-        memeModel += modelDelta
+    # Each process of the pool gets its own copy of the reads, once
+    pool = None
+    if args.jobs > 1 and len(blocks) > 1:
+        pool = multiprocessing.Pool(args.jobs, _initialize_worker, (blocks,))
+
+    iterations = args.iterations
+    if iterations is None:
+        iterations = 1 if args.until_converged is None else MAX_ITERATIONS
+
+    # Start from the given WMM, then from each random WMM
+    best = None
+    for start, startModel in enumerate([model] + random_wmms(args.starts, model.shape[1], args.seed)):
+        if args.verbose and args.starts > 0:
+            print 'Start %d' % start
+
+        previousLikelihood = None
+        for iteration in range(1, iterations + 1):
+            iterationTime = time.time()
+            memeModel, logLikelihood = run_meme_iteration(startModel, blocks, pool, args.posterior)
+
+            if args.verbose:
+                print 'Iteration %d log likelihood: %f' % (iteration, logLikelihood)
+                print 'Iteration finished in %f seconds' % (time.time() - iterationTime)
+
+            # Check for convergence
+            previousModel = startModel
+            startModel = normalize_wmm(memeModel)
+            if args.until_converged is not None and iteration < iterations:
+                change = numpy.max(numpy.abs(startModel - previousModel))
+                if change <= args.until_converged or (previousLikelihood is not None
+                        and abs(logLikelihood - previousLikelihood) <= args.until_converged):
+                    if args.verbose:
+                        print 'Converged after %d iterations' % iteration
+                    break
+            previousLikelihood = logLikelihood
+
+        # Keep the counts of the start whose last iteration was most likely
+        if best is None or logLikelihood > best[1]:
+            best = (start, logLikelihood, memeModel)
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    if args.verbose and args.starts > 0:
+        print 'Best start: %d' % best[0]
 
     # Close the WMM output file
-    json.dump(memeModel.tolist(), output)
+    json.dump(best[2].tolist(), output)
     output.close()
 
     if args.verbose:
         # Print how long the filter took
         elapsed = (time.clock() - startTime)
-        print 'Iteration finished in %f seconds' % elapsed
+        print 'MEME finished in %f seconds' % elapsed
@@ -0,0 +1,101 @@
+import numpy
+
+# Import some helper functions
+from reads import _parse_integers
+
+"""
+The positions of each read are offset by this much in the keys of a MismatchTable
+  so that one search finds the mismatches of every read at once
+"""
+READ_KEY_SPAN = 2**32
+
+def decode_mismatches(strings):
+    """
+    Decodes the given strings of mismatching positions (see SAM_MSMAT) all at once, without a regex
+    Each token of a string (see MISMATCH_SEARCH_REGEX) is a number of matching bases, a mismatching base,
+        or a caret followed by deleted bases, so the positions count every base of the string
+        (deleted bases included) from its start
+    Reads without a string have no mismatches
+    Returns a MismatchTable
+    """
+
+    # Every string ends with a newline, so that neither numbers nor deletions run into the next string
+    lengths = numpy.array([len(string) if string is not None else 0 for string in strings], dtype=int) + 1
+    text = ''.join([(string or '') + '\n' for string in strings])
+    if isinstance(text, unicode):
+        text = text.encode('ascii', 'replace')
+    chars = numpy.frombuffer(text, dtype=numpy.uint8)
+    index = numpy.arange(len(chars))
+    firsts = numpy.cumsum(lengths) - lengths
+    isDigit = (chars >= ord('0')) & (chars <= ord('9'))
+    isLetter = (chars >= ord('A')) & (chars <= ord('Z'))
+
+    # Each number moves the position on by its value (at its last digit), and each letter by one
+    numberStarts = numpy.flatnonzero(isDigit & ~numpy.append(False, isDigit[:-1]))
+    numberEnds = numpy.flatnonzero(isDigit & ~numpy.append(isDigit[1:], False)) + 1
+    steps = isLetter.astype(int)
+    steps[numberEnds - 1] = _parse_integers(chars, numberStarts, numberEnds)
+    after = numpy.cumsum(steps)
+    readStarts = after[firsts] - steps[firsts]
+    before = after - steps - numpy.repeat(readStarts, lengths)
+
+    # Letters following a caret are the deleted bases of one token, which starts at the first of them
+    #   and any other letter is a mismatch on its own
+    letters = numpy.flatnonzero(isLetter)
+    previous = numpy.maximum.accumulate(numpy.where(isLetter, 0, index))[letters]
+    following = numpy.minimum.accumulate(numpy.where(isLetter, len(chars), index)[::-1])[::-1][letters]
+    deleted = chars[previous] == ord('^')
+    tokenStarts = numpy.where(deleted, previous + 1, letters)
+    tokenEnds = numpy.where(deleted, following, letters + 1)
+
+    reads = numpy.repeat(numpy.arange(len(strings)), lengths)[letters]
+    starts = before[tokenStarts]
+    return MismatchTable(reads, starts, starts + tokenEnds - tokenStarts, after[firsts + lengths - 1] - readStarts)
+
+class MismatchTable(object):
+    """
+    Positions of the mismatches and deleted bases of a list of reads (see decode_mismatches)
+    Every mismatch or deleted base spans from the start to the end of its token
+        so the bases of a deletion share the span of the whole deletion
+    The spans are kept in order as keys (see READ_KEY_SPAN) of a single sorted NumPy array
+        so the mismatches before any cutoff of many reads are counted by one search
+    """
+
+    def __init__(self, reads, starts, ends, lengths):
+        self.lengths = lengths
+        self.offsets = numpy.searchsorted(reads, numpy.arange(len(lengths) + 1))
+        self.startKeys = reads.astype(numpy.int64) * READ_KEY_SPAN + starts
+        self.endKeys = reads.astype(numpy.int64) * READ_KEY_SPAN + ends
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def count_before(self, reads, cutoffs):
+        """
+        Counts the mismatches and deleted bases of the given reads whose tokens start before the given positions
+            so every base of a deletion that starts before the cutoff is counted, even past it
+        """
+
+        keys = numpy.asarray(reads, dtype=numpy.int64) * READ_KEY_SPAN + numpy.maximum(cutoffs, 0)
+        return numpy.searchsorted(self.startKeys, keys, 'left') - self.offsets[reads]
+
+    def count_after(self, reads, cutoffs):
+        """
+        Counts the mismatches and deleted bases of the given reads whose tokens end within the given number of bases
+            of the end of the string, counting back from its end instead of forward from its start
+        Same as count_before(...) on the reversed string, as the read would be once dereversed
+        """
+
+        keys = numpy.asarray(reads, dtype=numpy.int64) * READ_KEY_SPAN \
+            + numpy.maximum(self.lengths[reads] - cutoffs, 0)
+        return self.offsets[numpy.asarray(reads) + 1] - numpy.searchsorted(self.endKeys, keys, 'right')
+
+    def count_non_tail(self, reads, utrLengths, reverse):
+        """
+        Counts the mismatches and deleted bases in the UTR region of each of the given reads
+            given the length of the region, from the start of "ordinary" reads
+            or from the end of the reverse complements marked in the given mask
+        Same as count_before(...) with the UTR length as the cutoff, on each read once dereversed
+        """
+
+        return numpy.where(reverse, self.count_after(reads, utrLengths), self.count_before(reads, utrLengths))
@@ -0,0 +1,871 @@
+import os
+import json
+import numpy
+
+from itertools import islice
+from collections import OrderedDict
+
+# Import some helper functions and globals
+from shared import *
+
+"""
+File extension indicating that an input file should be parsed as a SAM file
+"""
+SAM_FILE = '.sam'
+
+"""
+The mandatory fields of a SAM file, in the order they appear on each line
+"""
+SAM_FIELDS = [SAM_QNAME, SAM_FLAG, SAM_RNAME, SAM_POS, SAM_MAPQ, SAM_CIGAR,
+              SAM_RNEXT, SAM_PNEXT, SAM_TLEN, SAM_SEQ, SAM_QUAL]
+
+"""
+The optional fields parsed out of a SAM file
+"""
+SAM_TAGS = [SAM_A_SCR, SAM_NUMMM, SAM_MSMAT]
+
+"""
+Number of bytes of a SAM file read in at a time
+Each block is cut after its last complete line and parsed as one batch of reads
+"""
+SAM_BLOCK_SIZE = 2**24
+
+"""
+Number of lines of a processed SAM file (exported in JSON) parsed as one batch of reads
+"""
+JSON_BATCH_SIZE = 2**16
+
+"""
+Usage: JSON_TEMPLATE_CACHE[(keys, dereversed)]
+Caches the format of a line of JSON for each order of keys (see ReadBatch)
+"""
+JSON_TEMPLATE_CACHE = {}
+
+"""
+File extension indicating that a file should be parsed as a read set (see write_read_set)
+"""
+READS_FILE = '.reads'
+
+"""
+The first bytes of every read set
+"""
+READS_MAGIC = 'READSET2'
+
+"""
+Every column of a read set starts at a multiple of this many bytes,
+  so that it can be memory-mapped in place
+"""
+READS_ALIGNMENT = 8
+
+"""
+Fields stored by a read set as columns of integers
+"""
+READS_INTEGER_FIELDS = [SAM_FLAG, SAM_POS, SAM_MAPQ, SAM_PNEXT, SAM_TLEN, SAM_A_SCR, SAM_NUMMM]
+
+"""
+Fields stored by a read set as a column of bytes holding every value back to back
+  along with a column of offsets into the bytes (named with READS_OFFSETS), one more than the reads
+"""
+READS_STRING_FIELDS = [SAM_QNAME, SAM_RNAME, SAM_CIGAR, SAM_RNEXT, SAM_SEQ, SAM_QUAL, SAM_MSMAT]
+READS_OFFSETS = ' offsets'
+
+"""
+Other columns of a read set:
+  the order of the keys of each read, numbered in the key orders of its chunk (see ReadBatch)
+  and whether its flags were dereversed into an integer
+"""
+READS_KEY_ORDER = 'key order'
+READS_DEREVERSED = 'dereversed'
+
+def parse_SAM_data(line):
+    """
+    Takes a tab-delimited line of processed mapping data in SAM format
+    And parses it into a dictionary of appropriate values
+    """
+
+    result = {}
+    tokens = line.strip().split('\t')
+
+    # Capture the 11 mandatory fields in order
+    result[SAM_QNAME] = tokens[ 0]
+    result[SAM_FLAG ] = tokens[ 1]
+    result[SAM_RNAME] = tokens[ 2]
+    result[SAM_POS  ] = tokens[ 3]
+    result[SAM_MAPQ ] = tokens[ 4]
+    result[SAM_CIGAR] = tokens[ 5]
+    result[SAM_RNEXT] = tokens[ 6]
+    result[SAM_PNEXT] = tokens[ 7]
+    result[SAM_TLEN ] = tokens[ 8]
+    result[SAM_SEQ  ] = tokens[ 9]
+    result[SAM_QUAL ] = tokens[10]
+
+    # Parse the remaining interesting optional fields
+    for token in tokens[11:]:
+        if token.startswith(SAM_A_SCR):
+            result[SAM_A_SCR] = token[len(SAM_A_SCR):]
+
+        elif token.startswith(SAM_NUMMM):
+            result[SAM_NUMMM] = token[len(SAM_NUMMM):]
+
+        elif token.startswith(SAM_MSMAT):
+            result[SAM_MSMAT] = token[len(SAM_MSMAT):]
+
+    return result
+
+def sam_generator(filename):
+    """
+    Opens the given SAM file and iterates over the file
+    Each iteration parses and returns a single sequence with its mapping data
+    """
+
+    with open_stream(filename) as file:
+        for line in file:
+            # Skip headers
+            if line.startswith('@'):
+                continue
+
+            # Parse sequence mapping data
+            else:
+                yield parse_SAM_data(line)
+
+def sam_batches(filename, limit=None, start=0, end=None):
+    """
+    Opens the given SAM file (which may be compressed, see open_stream)
+        and iterates over the file in blocks of SAM_BLOCK_SIZE bytes
+    Each iteration parses and returns the reads of one block as a SAMBatch
+    If a limit is given, no more than that many reads are returned
+    If given a range of bytes from batch_boundaries(...), only the reads in the range are returned
+        in the same batches as reading the whole file
+    """
+
+    with open_stream(filename) as file:
+        file.seek(start)
+        position = start
+        remainder = ''
+        while limit is None or limit > 0:
+            # Blocks end at multiples of SAM_BLOCK_SIZE, wherever the range starts
+            size = SAM_BLOCK_SIZE - position % SAM_BLOCK_SIZE
+            if end is not None:
+                size = min(size, end - position)
+            block = file.read(size) if size > 0 else ''
+            position += len(block)
+
+            # The last line might not end with a newline
+            if not block:
+                if remainder:
+                    yield SAMBatch(remainder + '\n', limit)
+                return
+
+            # Parse the complete lines, saving the rest for the next block
+            block = remainder + block
+            cut = block.rfind('\n') + 1
+            remainder = block[cut:]
+            if cut == 0:
+                continue
+            batch = SAMBatch(block[:cut], limit)
+            if limit is not None:
+                limit -= len(batch)
+            yield batch
+
+def json_batches(filename, limit=None, start=0, end=None):
+    """
+    Opens a processed SAM file that was exported in JSON (which may be compressed, see open_stream)
+    And iterates over the file JSON_BATCH_SIZE lines at a time
+    Each iteration decodes and returns the reads of those lines as a JSONBatch
+    If a limit is given, no more than that many reads are returned
+    If given a range of bytes from batch_boundaries(...), only the reads in the range are returned
+        in the same batches as reading the whole file
+    """
+
+    with open_stream(filename) as file:
+        file.seek(start)
+        lines = islice(_lines_before(file, start, end), limit)
+        while True:
+            batch = JSONBatch(list(islice(lines, JSON_BATCH_SIZE)))
+            if len(batch) == 0:
+                return
+            yield batch
+
+def _lines_before(file, position, end):
+    """
+    Helper for json_batches
+    Iterates over the lines of the file, from the given position until the given end
+    """
+
+    for line in file:
+        if end is not None and position >= end:
+            return
+        position += len(line)
+        yield line
+
+def read_set_batches(filename, limit=None, start=0, end=None):
+    """
+    Memory-maps the given read set and iterates over its chunks (see write_read_set)
+        or reads in one chunk at a time, if the read set is compressed (see open_stream)
+    Each iteration returns the reads of one chunk as a ReadSetBatch
+    If a limit is given, no more than that many reads are returned
+    If given a range of bytes from batch_boundaries(...), only the chunks in the range are returned
+    An empty file holds no reads
+    """
+
+    if filename.endswith(GZIP_FILE):
+        chunks = _read_set_stream(filename)
+    else:
+        if os.path.getsize(filename) == 0:
+            return
+        data = numpy.memmap(filename, dtype=numpy.uint8, mode='r')
+        assert data[:len(READS_MAGIC)].tostring() == READS_MAGIC, 'File "%s" is not a read set' % filename
+        chunks = ((data, header, columnStart) for position, header, columnStart in _read_set_chunks(data, start, end))
+
+    for data, header, columnStart in chunks:
+        if limit is not None and limit <= 0:
+            return
+
+        # The columns are views of the file, which are only read when used
+        columns = {}
+        for name, dtype, length in header['columns']:
+            dtype = numpy.dtype(str(dtype))
+            columns[name] = data[columnStart:(columnStart + length * dtype.itemsize)].view(dtype)
+            columnStart += _aligned(length * dtype.itemsize)
+
+        numReads = header['reads'] if limit is None else min(header['reads'], limit)
+        if limit is not None:
+            limit -= numReads
+        yield ReadSetBatch(columns, numReads, header['key orders'])
+
+def _read_set_stream(filename):
+    """
+    Helper for read_set_batches
+    Iterates over the chunks of a compressed read set, which can only be read from the start
+    Each iteration returns a tuple of (bytes of the chunk, its decoded header, start of its first column)
+    """
+
+    with open_stream(filename) as file:
+        magic = file.read(len(READS_MAGIC))
+        assert magic in ['', READS_MAGIC], 'File "%s" is not a read set' % filename
+
+        while True:
+            headerLength = file.read(8)
+            if not headerLength:
+                return
+            header = json.loads(file.read(int(numpy.frombuffer(headerLength, dtype='<i8')[0])))
+            length = sum([_aligned(length * numpy.dtype(str(dtype)).itemsize)
+                          for name, dtype, length in header['columns']])
+            yield numpy.frombuffer(file.read(length), dtype=numpy.uint8), header, 0
+
+def _read_set_chunks(data, start=0, end=None):
+    """
+    Helper for read sets
+    Iterates over the chunks of a memory-mapped read set that start within the given range of bytes
+    Each iteration returns a tuple of (start of the chunk, its decoded header, start of its first column)
+    """
+
+    position = len(READS_MAGIC)
+    end = len(data) if end is None else min(end, len(data))
+    while position < end:
+        headerLength = int(data[position:(position + 8)].view('<i8')[0])
+        header = json.loads(data[(position + 8):(position + 8 + headerLength)].tostring())
+        columnStart = position + 8 + headerLength
+        if position >= start:
+            yield position, header, columnStart
+
+        position = columnStart + sum([_aligned(length * numpy.dtype(str(dtype)).itemsize)
+                                      for name, dtype, length in header['columns']])
+
+def read_batches(filename, limit=None, start=0, end=None):
+    """
+    Opens a SAM file, a processed SAM file (exported in JSON), or a read set, any of which may be compressed
+    Returns an iterator over the batches of reads in the file (see ReadBatch)
+    If a limit is given, no more than that many reads are returned
+    If given a range of bytes from batch_boundaries(...), only the reads in the range are returned
+    """
+
+    fileext = split_extension(filename)[1]
+    if fileext == SAM_FILE:
+        return sam_batches(filename, limit, start, end)
+    elif fileext == JSON_FILE:
+        return json_batches(filename, limit, start, end)
+    elif fileext == READS_FILE:
+        return read_set_batches(filename, limit, start, end)
+
+    print 'Unknown input file format'
+    exit()
+
+def batch_boundaries(filename):
+    """
+    Finds the byte offset where each batch of read_batches(filename) starts, followed by the end of the file
+    Reading the file between any two of the offsets returns the same batches as reading the whole file
+        so the file can be split up at these offsets and each part read on its own
+    A compressed file (see open_stream) can only be read from the start, so it is never split up
+    """
+
+    size = os.path.getsize(filename)
+    if filename.endswith(GZIP_FILE):
+        return [0, size]
+
+    boundaries = [0]
+    fileext = split_extension(filename)[1]
+    if fileext == SAM_FILE:
+        # A block ends after the last line before each multiple of SAM_BLOCK_SIZE (see sam_batches)
+        with open(filename, 'rb') as file:
+            for blockEnd in range(SAM_BLOCK_SIZE, size, SAM_BLOCK_SIZE):
+                file.seek(boundaries[-1])
+                cut = file.read(blockEnd - boundaries[-1]).rfind('\n') + 1
+                if cut > 0:
+                    boundaries.append(boundaries[-1] + cut)
+
+    elif fileext == JSON_FILE:
+        # A batch starts every JSON_BATCH_SIZE lines
+        with open(filename, 'rb') as file:
+            position = 0
+            for index, line in enumerate(file):
+                if index > 0 and index % JSON_BATCH_SIZE == 0:
+                    boundaries.append(position)
+                position += len(line)
+
+    elif fileext == READS_FILE and size > 0:
+        data = numpy.memmap(filename, dtype=numpy.uint8, mode='r')
+        boundaries += [position for position, header, columnStart in _read_set_chunks(data)][1:]
+
+    if boundaries[-1] < size:
+        boundaries.append(size)
+    return boundaries
+
+def write_read_set(file, batch, indices):
+    """
+    Appends the given reads of the batch to a read set, opened for writing in binary mode
+    The reads are written as one chunk, made up of:
+        the length of the header (8 bytes)
+        the header (in JSON), with the number of reads, the key orders of the batch (see ReadBatch),
+            and the name, NumPy type, and length of each column
+        the data of each column, padded to READS_ALIGNMENT bytes
+    """
+
+    if file.tell() == 0:
+        file.write(READS_MAGIC)
+    if len(indices) == 0:
+        return
+
+    columns = []
+    for name in READS_INTEGER_FIELDS:
+        columns.append((name, numpy.asarray(batch.integers(name)[indices], dtype='<i8')))
+    columns.append((READS_KEY_ORDER, numpy.asarray(batch.keyOrderIndices[indices], dtype='<i2')))
+    columns.append((READS_DEREVERSED, numpy.asarray(batch.dereversed[indices], dtype=numpy.uint8)))
+
+    for name in READS_STRING_FIELDS:
+        strings = [_encode_string(string) for string in batch.values(name, indices)]
+        offsets = numpy.zeros(len(strings) + 1, dtype='<i8')
+        offsets[1:] = numpy.cumsum([len(string) for string in strings])
+        columns.append((name + READS_OFFSETS, offsets))
+        columns.append((name, numpy.frombuffer(''.join(strings), dtype=numpy.uint8)))
+
+    # Pad the header so that the first column is aligned
+    header = json.dumps({
+        'reads': len(indices),
+        'key orders': batch.keyOrders,
+        'columns': [[name, column.dtype.str, len(column)] for name, column in columns]
+    })
+    header += ' ' * (_aligned(8 + len(header)) - 8 - len(header))
+    file.write(numpy.array([len(header)], dtype='<i8').tostring())
+    file.write(header)
+
+    for name, column in columns:
+        data = column.tostring()
+        file.write(data)
+        file.write('\0' * (_aligned(len(data)) - len(data)))
+
+def _aligned(size):
+    """
+    Helper for read sets
+    Rounds the given number of bytes up to a multiple of READS_ALIGNMENT
+    """
+
+    return -(-size // READS_ALIGNMENT) * READS_ALIGNMENT
+
+def _encode_string(string):
+    """
+    Helper for write_read_set
+    Returns the bytes of the given field, encoding decoded JSON as UTF-8 and missing fields as empty
+    """
+
+    if string is None:
+        return ''
+    if isinstance(string, unicode):
+        return string.encode('utf-8')
+    return string
+
+def _parse_integers(block, starts, ends):
+    """
+    Helper for SAMBatch and decode_mismatches
+    Parses the (optionally signed) decimal integer between each of the given bounds of the block
+    Returns a NumPy array of the integers
+    """
+
+    negative = block[starts] == ord('-')
+    starts = starts + (negative | (block[starts] == ord('+')))
+    assert numpy.all(ends > starts), 'Expected an integer in the SAM file'
+
+    # Shift in one digit of every integer at a time
+    values = numpy.zeros(len(starts), dtype=int)
+    for offset in range(numpy.max(ends - starts) if len(starts) > 0 else 0):
+        inside = starts + offset < ends
+        digits = block[numpy.where(inside, starts + offset, starts)].astype(int) - ord('0')
+        assert numpy.all((digits >= 0) & (digits <= 9)), 'Expected an integer in the SAM file'
+        values = numpy.where(inside, values * 10 + digits, values)
+
+    return numpy.where(negative, -values, values)
+
+def _prefix_codes(block, starts, ends, length):
+    """
+    Helper for SAMBatch
+    Packs the given number of bytes from each of the given starts into one integer
+        or -1 if the end comes first
+    """
+
+    codes = numpy.zeros(len(starts), dtype=numpy.int64)
+    for offset in range(length):
+        codes = codes * 256 + block[numpy.minimum(starts + offset, len(block) - 1)]
+    return numpy.where(ends - starts >= length, codes, -1)
+
+def _locate_tag(tagCodes, tagLines, tagStarts, tagEnds, numLines, prefix):
+    """
+    Helper for SAMBatch
+    Finds the optional fields starting with the given prefix (i.e. SAM_A_SCR)
+        among the optional fields on each line, given the _prefix_codes of each field
+    Returns a tuple of:
+        a mask of the lines with the field,
+        the position of the first such field on each line, which orders the keys of parse_SAM_data,
+        the start and end of the value of the last such field, which is the value of parse_SAM_data
+    """
+
+    prefixCode = _prefix_codes(numpy.frombuffer(prefix, dtype=numpy.uint8),
+            numpy.zeros(1, dtype=int), numpy.array([len(prefix)]), len(prefix))
+    matches = numpy.flatnonzero(tagCodes == prefixCode)
+
+    # Fields are in order, so each line's fields are next to each other
+    lines = tagLines[matches]
+    first = numpy.ones(len(lines), dtype=bool)
+    last = numpy.ones(len(lines), dtype=bool)
+    first[1:] = lines[1:] != lines[:-1]
+    last[:-1] = lines[1:] != lines[:-1]
+
+    found = numpy.zeros(numLines, dtype=bool)
+    position = numpy.zeros(numLines, dtype=int)
+    starts = numpy.zeros(numLines, dtype=int)
+    ends = numpy.zeros(numLines, dtype=int)
+    found[lines] = True
+    position[lines[first]] = matches[first]
+    starts[lines[last]] = tagStarts[matches[last]] + len(prefix)
+    ends[lines[last]] = tagEnds[matches[last]]
+    return found, position, starts, ends
+
+def _tag_keys(tagOrder):
+    """
+    Helper for SAMBatch
+    Returns the optional fields in the given order
+        numbered as one digit per field (see SAM_TAGS), holding its rank or 0 if it is missing
+    """
+
+    base = len(SAM_TAGS) + 1
+    ranks = [(tagOrder // base**index) % base for index in range(len(SAM_TAGS))]
+    return [tag for rank, tag in sorted(zip(ranks, SAM_TAGS)) if rank > 0]
+
+def _json_keys(tags):
+    """
+    Helper for SAMBatch
+    Returns the keys in the order json.dumps(parse_SAM_data(line)) writes them
+        for a line with the given optional fields, in the order they first appear on it
+    """
+
+    # Insert the keys in the same order as parse_SAM_data
+    #   and let the dictionary decide the order they are written in
+    data = {}
+    for key in SAM_FIELDS + tags:
+        data[key] = None
+    return tuple(data.keys())
+
+def _json_template(keys, dereversed):
+    """
+    Helper for ReadBatch.to_json
+    Returns the format of a line of JSON with the given keys in the given order
+        where the flag is only quoted if it has not been dereversed into an integer
+    """
+
+    if (keys, dereversed) not in JSON_TEMPLATE_CACHE:
+        template = ', '.join([('"%s": %%s' if key == SAM_FLAG and dereversed else '"%s": "%%s"') % key
+                              for key in keys])
+        JSON_TEMPLATE_CACHE[(keys, dereversed)] = '{%s}\n' % template
+    return JSON_TEMPLATE_CACHE[(keys, dereversed)]
+
+def _escape_json(strings):
+    """
+    Helper for ReadBatch.to_json
+    Escapes the quotes and backslashes of the given strings, as json.dumps(...) would
+    """
+
+    text = '\t'.join(strings)
+    if '"' not in text and '\\' not in text:
+        return strings
+    return text.replace('\\', '\\\\').replace('"', '\\"').split('\t')
+
+class ReadBatch(object):
+    """
+    Mapping data of a batch of reads, stored by field rather than by read
+    The integer fields are parsed once into NumPy arrays:
+        flags, positions, mappingQualities, nextPositions, templateLengths, alignScores, and numMismatches
+        Reads without an AS or NM field are False in hasAlignScores or hasNumMismatches
+    The other fields are lists of strings, only parsed by column(...) when first used
+        Reads without an optional field have None
+    The orders in which json.dumps(...) writes the keys of the reads are listed in keyOrders
+        and the order of each read is numbered in keyOrderIndices
+    Reads with any byte JSON would escape are marked in unusual
+    Subclasses parse a batch out of a particular input format
+    """
+
+    def __init__(self):
+        self.columns = {}
+
+    def __len__(self):
+        return len(self.flags)
+
+    def column(self, name):
+        """
+        Returns the list of values of the given field, i.e. SAM_SEQ
+        """
+
+        if name not in self.columns:
+            self.columns[name] = self._strings(name)
+        return self.columns[name]
+
+    def integers(self, name):
+        """
+        Returns the NumPy array of values of the given integer field, i.e. SAM_POS
+        """
+
+        return {
+            SAM_FLAG: self.flags,
+            SAM_POS: self.positions,
+            SAM_MAPQ: self.mappingQualities,
+            SAM_PNEXT: self.nextPositions,
+            SAM_TLEN: self.templateLengths,
+            SAM_A_SCR: self.alignScores,
+            SAM_NUMMM: self.numMismatches
+        }[name]
+
+    def values(self, name, indices):
+        """
+        Returns the values of the given field of the given reads
+        """
+
+        if name in self.columns:
+            column = self.columns[name]
+            return [column[index] for index in indices]
+        return self._strings(name, indices)
+
+    def record(self, index):
+        """
+        Returns the given read as a dictionary, like parse_SAM_data(...)
+            including any changes made by dereverse(...)
+        """
+
+        data = self._record(index)
+        if self.dereversed[index]:
+            data[SAM_FLAG] = int(self.flags[index])
+            data[SAM_SEQ] = self.column(SAM_SEQ)[index]
+            data[SAM_QUAL] = self.column(SAM_QUAL)[index]
+            if SAM_MSMAT in data:
+                data[SAM_MSMAT] = self.column(SAM_MSMAT)[index]
+        return data
+
+    def to_json(self, indices):
+        """
+        Returns a line of JSON for each of the given reads
+        Same as json.dumps(self.record(index)), but formats all the reads
+            with the same order of optional fields at once
+        """
+
+        lines = [None] * len(indices)
+        formats = numpy.where(self.unusual[indices], -1, self.keyOrderIndices[indices] * 2 + self.dereversed[indices])
+        for format in numpy.unique(formats).tolist():
+            chosen = numpy.flatnonzero(formats == format)
+            reads = indices[chosen]
+            if format < 0:
+                formatted = [json.dumps(self.record(index)) + '\n' for index in reads]
+
+            else:
+                keys = self.keyOrders[format // 2]
+                template = _json_template(keys, format % 2 == 1)
+                values = []
+                for key, column in zip(keys, self._json_columns(keys, reads)):
+                    # Dereversed flags are integers
+                    if key == SAM_FLAG and format % 2 == 1:
+                        values.append(map(str, self.flags[reads].tolist()))
+                    else:
+                        values.append(_escape_json(column))
+                formatted = [template % read for read in zip(*values)]
+
+            for position, line in zip(chosen.tolist(), formatted):
+                lines[position] = line
+        return lines
+
+    def _json_columns(self, keys, reads):
+        """
+        Helper for to_json
+        Returns the values of each of the given fields of the given reads
+        """
+
+        return [self.values(key, reads) for key in keys]
+
+    def dereverse(self, reverse):
+        """
+        Reverses and complements the reads marked in the given mask
+            into "ordinary" sequences and flips the relevant flag bits
+        """
+
+        indices = numpy.flatnonzero(reverse)
+        if len(indices) == 0:
+            return
+
+        # Reversing the joined fields reverses each field, but also their order
+        sequences = self.column(SAM_SEQ)
+        qualities = self.column(SAM_QUAL)
+        reversedSequences = '\t'.join([sequences[index] for index in indices])[::-1]
+        reversedQualities = '\t'.join([qualities[index] for index in indices])[::-1]
+        reversedSequences = complement_sequence(reversedSequences).split('\t')[::-1]
+        reversedQualities = reversedQualities.split('\t')[::-1]
+        for index, sequence, quality in zip(indices, reversedSequences, reversedQualities):
+            sequences[index] = sequence
+            qualities[index] = quality
+
+        # Mismatching positions are reversed token by token
+        mismatches = self.column(SAM_MSMAT)
+        withMismatches = [index for index in indices if mismatches[index] is not None]
+        reversedMismatches = [''.join(MISMATCH_SEARCH_REGEX.findall(mismatches[index])[::-1])
+                              for index in withMismatches]
+        reversedMismatches = complement_sequence('\t'.join(reversedMismatches)).split('\t')
+        for index, mismatch in zip(withMismatches, reversedMismatches):
+            mismatches[index] = mismatch
+
+        # Flip the relevant flag bits
+        self.flags[indices] ^= SAM_REV_COMPLEMENT_FLAG_MASK | SAM_TRANSFORMED_REV_COMP_FLAG_MASK
+        self.dereversed[indices] = True
+
+class SAMBatch(ReadBatch):
+    """
+    Batch of reads parsed out of a block of complete lines of a SAM file
+    Fields are found by the positions of the tabs in the block, so lines are never split up
+        and fields are only copied out of the block when used
+    """
+
+    def __init__(self, text, limit=None):
+        ReadBatch.__init__(self)
+        self.text = text
+        block = numpy.frombuffer(text, dtype=numpy.uint8)
+
+        # Find the reads, skipping headers and blank lines and stripping carriage returns
+        lineEnds = numpy.flatnonzero(block == ord('\n'))
+        lineStarts = numpy.append(0, lineEnds[:-1] + 1)[:len(lineEnds)]
+        lineEnds -= (lineEnds > lineStarts) & (block[lineEnds - 1] == ord('\r'))
+        reads = (lineEnds > lineStarts) & (block[lineStarts] != ord('@'))
+        self.lineStarts = lineStarts[reads][:limit]
+        self.lineEnds = lineEnds[reads][:limit]
+        numLines = len(self.lineStarts)
+
+        # Each mandatory field but the last is followed by a tab
+        tabs = numpy.flatnonzero(block == ord('\t'))
+        firstTabs = numpy.searchsorted(tabs, self.lineStarts)
+        numTabs = numpy.searchsorted(tabs, self.lineEnds) - firstTabs
+        assert numpy.all(numTabs >= len(SAM_FIELDS) - 1), \
+            'Every read of a SAM file requires %d fields' % len(SAM_FIELDS)
+        fieldTabs = numpy.minimum(firstTabs[:, None] + numpy.arange(len(SAM_FIELDS)), len(tabs) - 1)
+        fieldTabs = tabs[fieldTabs].T
+        fieldStarts = numpy.vstack((self.lineStarts, fieldTabs[:-1] + 1))
+        fieldEnds = numpy.vstack((fieldTabs[:-1],
+                numpy.where(numTabs >= len(SAM_FIELDS), fieldTabs[-1], self.lineEnds)))
+        self.bounds = dict(zip(SAM_FIELDS, zip(fieldStarts, fieldEnds)))
+
+        # Every other tab starts an optional field
+        numTags = numTabs - (len(SAM_FIELDS) - 1)
+        tagLines = numpy.repeat(numpy.arange(numLines), numTags)
+        tagTabs = numpy.arange(len(tagLines)) \
+            + numpy.repeat(firstTabs + len(SAM_FIELDS) - 1 - (numpy.cumsum(numTags) - numTags), numTags)
+        tagStarts = tabs[tagTabs] + 1
+        tagEnds = numpy.minimum(numpy.append(tabs, len(block))[tagTabs + 1], self.lineEnds[tagLines])
+
+        # Number the order in which the optional fields first appear on each line
+        #   as one digit per field, holding its rank or 0 if it is missing (see _tag_keys)
+        self.found = {}
+        positions = {}
+        tagCodes = {}
+        for tag in SAM_TAGS:
+            if len(tag) not in tagCodes:
+                tagCodes[len(tag)] = _prefix_codes(block, tagStarts, tagEnds, len(tag))
+            self.found[tag], positions[tag], starts, ends = \
+                _locate_tag(tagCodes[len(tag)], tagLines, tagStarts, tagEnds, numLines, tag)
+            self.bounds[tag] = (starts, ends)
+        tagOrders = numpy.zeros(numLines, dtype=int)
+        for index, tag in enumerate(SAM_TAGS):
+            rank = numpy.ones(numLines, dtype=int)
+            for other in SAM_TAGS:
+                rank += self.found[other] & (positions[other] < positions[tag])
+            tagOrders += numpy.where(self.found[tag], rank, 0) * (len(SAM_TAGS) + 1)**index
+        tagOrders, self.keyOrderIndices = numpy.unique(tagOrders, return_inverse=True)
+        self.keyOrders = [_json_keys(_tag_keys(tagOrder)) for tagOrder in tagOrders.tolist()]
+
+        # JSON escapes anything that is not printable ASCII, so those reads are left to json.dumps(...)
+        unusual = numpy.flatnonzero(((block < ord(' ')) & (block != ord('\t'))) | (block > ord('~')))
+        lines = numpy.searchsorted(self.lineEnds, unusual, 'right')
+        unusual, lines = unusual[lines < numLines], lines[lines < numLines]
+        self.unusual = numpy.zeros(numLines, dtype=bool)
+        self.unusual[lines[unusual >= self.lineStarts[lines]]] = True
+
+        # Parse the integer fields
+        self.flags = _parse_integers(block, *self.bounds[SAM_FLAG])
+        self.positions = _parse_integers(block, *self.bounds[SAM_POS])
+        self.mappingQualities = _parse_integers(block, *self.bounds[SAM_MAPQ])
+        self.nextPositions = _parse_integers(block, *self.bounds[SAM_PNEXT])
+        self.templateLengths = _parse_integers(block, *self.bounds[SAM_TLEN])
+        self.hasAlignScores = self.found[SAM_A_SCR]
+        self.alignScores = numpy.zeros(numLines, dtype=int)
+        self.alignScores[self.hasAlignScores] = _parse_integers(block,
+                *[bound[self.hasAlignScores] for bound in self.bounds[SAM_A_SCR]])
+        self.hasNumMismatches = self.found[SAM_NUMMM]
+        self.numMismatches = numpy.zeros(numLines, dtype=int)
+        self.numMismatches[self.hasNumMismatches] = _parse_integers(block,
+                *[bound[self.hasNumMismatches] for bound in self.bounds[SAM_NUMMM]])
+        self.dereversed = numpy.zeros(numLines, dtype=bool)
+
+    def _strings(self, name, reads=None):
+        starts, ends = self.bounds[name]
+        found = self.found.get(name)
+        if reads is not None:
+            starts, ends = starts[reads], ends[reads]
+            found = None if found is None else found[reads]
+
+        strings = [self.text[start:end] for start, end in zip(starts.tolist(), ends.tolist())]
+        if found is not None:
+            strings = [string if isFound else None for string, isFound in zip(strings, found.tolist())]
+        return strings
+
+    def _record(self, index):
+        return parse_SAM_data(self.text[self.lineStarts[index]:self.lineEnds[index]])
+
+    def _json_columns(self, keys, reads):
+        # Split up the lines to get the mandatory fields, unless they were already parsed
+        fields = None
+        columns = []
+        for key in keys:
+            if key in SAM_FIELDS and key not in self.columns:
+                if fields is None:
+                    fields = zip(*[self.text[start:end].split('\t', len(SAM_FIELDS))
+                        for start, end in zip(self.lineStarts[reads].tolist(), self.lineEnds[reads].tolist())])
+                columns.append(fields[SAM_FIELDS.index(key)])
+            else:
+                columns.append(self.values(key, reads))
+        return columns
+
+class JSONBatch(ReadBatch):
+    """
+    Batch of reads decoded from the lines of a processed SAM file (exported in JSON)
+    """
+
+    def __init__(self, lines):
+        ReadBatch.__init__(self)
+        self.records = [json.loads(line) for line in lines]
+
+        # Parse the integer fields, taking 0 for any missing optional fields
+        fields = zip(*[(data[SAM_FLAG], data[SAM_POS], data[SAM_MAPQ], data[SAM_PNEXT], data[SAM_TLEN],
+                        data.get(SAM_A_SCR, 0), data.get(SAM_NUMMM, 0)) for data in self.records])
+        fields = [numpy.array(map(int, field), dtype=int) for field in fields or [()] * 7]
+        self.flags, self.positions, self.mappingQualities, self.nextPositions, self.templateLengths, \
+            self.alignScores, self.numMismatches = fields
+        self.hasAlignScores = numpy.array([SAM_A_SCR in data for data in self.records], dtype=bool)
+        self.hasNumMismatches = numpy.array([SAM_NUMMM in data for data in self.records], dtype=bool)
+
+        # The reads are written out with their keys in the order they were decoded in
+        keyOrders = {}
+        self.keyOrderIndices = numpy.array([keyOrders.setdefault(tuple(map(str, data.keys())), len(keyOrders))
+                                            for data in self.records], dtype=int)
+        self.keyOrders = sorted(keyOrders, key=keyOrders.get)
+
+        # Flags are only written out as integers once they have been dereversed
+        self.dereversed = numpy.array([not isinstance(data[SAM_FLAG], basestring) for data in self.records],
+                                      dtype=bool)
+
+    def _strings(self, name, reads=None):
+        records = self.records if reads is None else [self.records[read] for read in reads]
+        return [data.get(name) for data in records]
+
+    def _record(self, index):
+        return self.records[index]
+
+    def to_json(self, indices):
+        """
+        Returns a line of JSON for each of the given reads
+        The reads were decoded from JSON, so they are simply encoded again
+        """
+
+        return [json.dumps(self.record(index)) + '\n' for index in indices]
+
+class ReadSetBatch(ReadBatch):
+    """
+    Batch of reads in one chunk of a read set (see write_read_set)
+    The integer fields are copied out of the file up front
+        but strings are only copied out when used
+    """
+
+    def __init__(self, columns, numReads, keyOrders):
+        ReadBatch.__init__(self)
+        self.data = columns
+        self.blobs = {}
+        self.keyOrders = [tuple(map(str, keys)) for keys in keyOrders]
+
+        self.flags, self.positions, self.mappingQualities, self.nextPositions, self.templateLengths, \
+            self.alignScores, self.numMismatches = \
+            [numpy.array(columns[name][:numReads], dtype=int) for name in READS_INTEGER_FIELDS]
+        self.keyOrderIndices = numpy.array(columns[READS_KEY_ORDER][:numReads], dtype=int)
+        self.dereversed = numpy.array(columns[READS_DEREVERSED][:numReads], dtype=bool)
+        self.found = dict([(tag, numpy.array([tag in keys for keys in self.keyOrders], dtype=bool)
+                                 [self.keyOrderIndices]) for tag in SAM_TAGS])
+        self.hasAlignScores = self.found[SAM_A_SCR]
+        self.hasNumMismatches = self.found[SAM_NUMMM]
+        self._unusual = None
+
+    @property
+    def unusual(self):
+        # Only look through the strings once JSON is needed
+        if self._unusual is None:
+            self._unusual = numpy.zeros(len(self), dtype=bool)
+            for name in READS_STRING_FIELDS:
+                offsets = self.data[name + READS_OFFSETS][:(len(self) + 1)]
+                blob = self.data[name][:offsets[-1]]
+                unusual = numpy.flatnonzero((blob < ord(' ')) | (blob > ord('~')))
+                self._unusual[numpy.searchsorted(offsets, unusual, 'right') - 1] = True
+        return self._unusual
+
+    def _strings(self, name, reads=None):
+        if name in READS_INTEGER_FIELDS:
+            integers = self.integers(name)
+            strings = map(str, (integers if reads is None else integers[reads]).tolist())
+
+        else:
+            if name not in self.blobs:
+                self.blobs[name] = self.data[name].tostring()
+            blob = self.blobs[name]
+            offsets = self.data[name + READS_OFFSETS]
+            starts, ends = offsets[:len(self)], offsets[1:(len(self) + 1)]
+            if reads is not None:
+                starts, ends = starts[reads], ends[reads]
+            strings = [blob[start:end] for start, end in zip(starts.tolist(), ends.tolist())]
+
+        if name in self.found:
+            found = self.found[name] if reads is None else self.found[name][reads]
+            strings = [string if isFound else None for string, isFound in zip(strings, found.tolist())]
+        return strings
+
+    def _record(self, index):
+        # Keep the keys in the order they are written in
+        data = OrderedDict()
+        for key in self.keyOrders[self.keyOrderIndices[index]]:
+            data[key] = self.values(key, [index])[0]
+        return data
@@ -13,13 +13,64 @@ Size of the histogram
 """
 HISTOGRAM_SIZE = 75
 
+"""
+Number of reads scanned at once, which bounds the size of the padded matrix of each block
+"""
+SCANNER_BLOCK_SIZE = 2**12
+
+"""
+Windows scoring within this much of the best window are tied with it
+  since sums of logs only match products of probabilities up to rounding
+"""
+SCORE_TOLERANCE = 1e-9
+
+def scan_sequences(tables, sequences):
+    """
+    Applies each of the given log odds tables (see get_log_odds_table)
+        to the UTR region of each of the given sequences (see utr_lengths)
+    The sequences are encoded once, and the tables of each width are applied together
+    Returns a tuple of NumPy arrays, with a row per table and a column per sequence:
+        a mask of the sequences where the best window scores above 0 (a motif hit)
+        the distance from the last best window to the tail, or 0 without a hit
+    """
+
+    tails = utr_lengths(sequences)
+    codes, lengths = encode_sequences(sequences)
+    hits = numpy.zeros((len(tables), len(sequences)), dtype=bool)
+    distances = numpy.zeros((len(tables), len(sequences)), dtype=int)
+    for width in set([table.shape[1] for table in tables]):
+        chosen = [index for index, table in enumerate(tables) if table.shape[1] == width]
+        scores = apply_log_odds_to_sequences(numpy.array([tables[index] for index in chosen]), codes, tails)
+        if scores.shape[-1] == 0:
+            continue
+
+        # Sequences too short for a window score -inf, so they never hit
+        maxScores = numpy.max(scores, -1)
+        lastHits = scores.shape[-1] - 1 \
+            - numpy.argmax(scores[..., ::-1] >= maxScores[..., None] - SCORE_TOLERANCE, -1)
+        hits[chosen] = maxScores > 0
+        distances[chosen] = numpy.where(hits[chosen], tails - lastHits, 0)
+    return hits, distances
+
+def _load_model(filename):
+    """
+    Helper for scanner
+    Opens and normalizes a weight matrix model
+    """
+
+    assert_is_json_file(filename)
+    with open(filename, 'r') as f:
+        return normalize_wmm(json.load(f))
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
-            description='Takes a weight matrix model and a filtered SAM file (exported in JSON) and applies the WMM on the data.  Outputs the number of model "hits", average distance from hit to cleave site, and a histogram of hit positions')
+            description='Takes a weight matrix model and a filtered SAM file (exported in JSON or as a read set) and applies the WMM on the data.  Outputs the number of model "hits", average distance from hit to cleave site, and a histogram of hit positions')
     parser.add_argument('wmm', type=str, help='A weight matrix model')
     parser.add_argument('background', type=str, help='A wight matrix model of the background')
-    parser.add_argument('file', type=str, help='A filtered SAM file')
-    parser.add_argument('output', type=str, help='File to store the histogram table')
+    parser.add_argument('file', type=str, help='A filtered SAM file, compressed if it ends in %s' % GZIP_FILE)
+    parser.add_argument('output', type=str, help='File to store the histogram table, compressed into BGZF if it ends in %s' % GZIP_FILE)
+    parser.add_argument('--pair', type=str, nargs=3, action='append', metavar=('WMM', 'BACKGROUND', 'OUTPUT'), help='Another model, background, and histogram file to scan the data with in the same pass; may be repeated')
+    parser.add_argument('--save_summaries', action='store_true', help='Should the hits and average distance of each model also be saved next to its histogram table (with a %s extension)?' % SUMMARY_FILE)
     parser.add_argument('--limit', type=int, required=False, help='How many lines of input should be read?')
     parser.add_argument('--verbose', action='store_true', help='Should progress and summary statistics be printed?')
 
@@ -30,74 +81,67 @@ if __name__ == '__main__':
     if args.verbose:
         startTime = time.clock()
 
-    # Open the WMM
-    assert_is_json_file(args.wmm)
-    model = None
-    with open(args.wmm, 'r') as f:
-        model = json.load(f)
-    model = normalize_wmm(model)
+    # Every (WMM, background, histogram file) is scanned in the same pass
+    pairs = [(args.wmm, args.background, args.output)] + (args.pair or [])
+    if args.save_summaries:
+        for wmm, background, outputFile in pairs:
+            assert split_extension(outputFile)[1] != SUMMARY_FILE, \
+                'Histogram file "%s" would be overwritten by its summary' % outputFile
 
-    # Open the background model
-    assert_is_json_file(args.background)
-    background = None
-    with open(args.background, 'r') as f:
-        background = json.load(f)
-    background = normalize_wmm(background)
+    # Open the WMMs and background models
+    # The WMM and background only need to be compared once per nucleotide
+    tables = [get_log_odds_table(_load_model(wmm), _load_model(background))
+              for wmm, background, outputFile in pairs]
 
     # Handle SAM input
-    assert_is_json_file(args.file)
-    iterator = json_generator(args.file)
+    # Limit the number of input lines read (for debugging purposes)
+    iterator = read_batches(args.file, args.limit)
 
-    # Open the histogram file
-    output = open(args.output, 'w')
+    # Open the histogram files
+    outputs = [open_stream(outputFile, 'w') for wmm, background, outputFile in pairs]
 
-    # Declare the statistics we're looking for
-    motifHits = 0
-    motifDistance = 0
-    motifHistogram = numpy.zeros(HISTOGRAM_SIZE)
+    # Declare the statistics we're looking for, for each pair
+    motifHits = numpy.zeros(len(pairs), dtype=int)
+    motifDistance = numpy.zeros(len(pairs), dtype=int)
+    motifHistograms = [numpy.zeros(HISTOGRAM_SIZE, dtype=int) for pair in pairs]
 
-    # Use a generator to read in and process the file line by line
+    # Use a generator to read in and process the file a batch of reads at a time
+    # Every read of a block is encoded once and scanned by every pair at once
     counter = 0
-    for data in iterator:
-        # Limit the number of input lines read (for debugging purposes)
-        if args.limit is not None and counter >= args.limit:
-            break
-        counter += 1
-
-        # Find the location of the tail
-        tail = POLY_A_TAIL_SEARCH_REGEX.search(data[SAM_SEQ])
-        tail = len(data[SAM_SEQ]) if tail is None else tail.start()
-
-        # Extract the UTR region of the sequence
-        sequence = matrixify_sequence(data[SAM_SEQ][:tail])
-
-        # Apply the WMM and background to the sequence
-        scores = apply_wmm_to_sequence(model, sequence) / apply_wmm_to_sequence(background, sequence)
-
-        # Check for a motif hit
-        scores = numpy.log(scores)
-        maxScore = numpy.max(scores)
-        if maxScore <= 0:
-            continue
-
-        # There's a hit, so tabulate it
-        lastHitIndex = numpy.where(scores == maxScore)[-1][-1]
-        lastHitDistance = tail - lastHitIndex
-        motifHits += 1
-        motifDistance += lastHitDistance
-        motifHistogram[lastHitDistance] += 1
-
-    # Output the number of hits and average distance
-    print 'Motif hits: %d out of %d' % (motifHits, counter)
-    print 'Average distance: %f' % (float(motifDistance) / motifHits)
-
-    # Output the histogram
-    output.write('Distance\tCount\n')
-    for i in range(HISTOGRAM_SIZE):
-        output.write('%d\t%d\n' % (i + 1, motifHistogram[i]))
-
-    # Close the histogram output file
-    output.close()
+    for batch in iterator:
+        sequences = batch.column(SAM_SEQ)
+        for start in range(0, len(sequences), SCANNER_BLOCK_SIZE):
+            hits, distances = scan_sequences(tables, sequences[start:(start + SCANNER_BLOCK_SIZE)])
+            counter += hits.shape[1]
+
+            # Tabulate the hits, growing the histograms for any distance past the end
+            motifHits += numpy.sum(hits, 1)
+            motifDistance += numpy.sum(distances, 1)
+            for index in range(len(pairs)):
+                counts = numpy.bincount(distances[index][hits[index]], minlength=len(motifHistograms[index]))
+                counts[:len(motifHistograms[index])] += motifHistograms[index]
+                motifHistograms[index] = counts
+
+    for index, (wmm, background, outputFile) in enumerate(pairs):
+        # Output the number of hits and average distance
+        summary = 'Motif hits: %d out of %d\n' % (motifHits[index], counter) \
+            + 'Average distance: %f\n' % (float(motifDistance[index]) / motifHits[index])
+        if len(pairs) > 1:
+            print '%s vs %s:' % (wmm, background)
+        sys.stdout.write(summary)
+
+        if args.save_summaries:
+            with open(split_extension(outputFile)[0] + SUMMARY_FILE, 'w') as f:
+                f.write(summary)
+
+        # Output the histogram
+        output = outputs[index]
+        output.write('Distance\tCount\n')
+        for i in range(len(motifHistograms[index])):
+            output.write('%d\t%d\n' % (i + 1, motifHistograms[index][i]))
+
+        # Close the histogram output file
+        output.close()
 
     if args.verbose:
         # Print how long the filter took
@@ -3,13 +3,17 @@ import re
 import json
 import numpy
 
+# Import some helper functions and globals
+from streams import *
+
 """
 File extension indicating that an input file should be parsed as a JSON file
 """
 JSON_FILE = '.json'
 
 """
-Motif length the Weight Matrix Model will represent
+Default motif length a Weight Matrix Model will represent
+  Each model's own length is its number of columns
 """
 WMM_LENGTH = 6
 
@@ -43,6 +47,49 @@ WMM_STANDARD_COUNT = numpy.array([
     [0, 0, 0, 1, 0  , 0.5, 0  , 0.5, 0.5, 0  , 0.33, 0.33, 0.33, 0   , 0.25]
 ])
 
+"""
+Code of any byte that is not an IUPAC nucleotide, also used to pad batches of sequences
+"""
+PADDING_CODE = len(NUCLEOTIDES)
+
+"""
+Usage: BASE_CODES[bases]
+Code of each byte (see NUCLEOTIDES), or PADDING_CODE if the byte is not an IUPAC nucleotide
+"""
+BASE_CODES = numpy.empty(256, dtype=numpy.uint8)
+BASE_CODES.fill(PADDING_CODE)
+BASE_CODES[map(ord, NUCLEOTIDES.keys())] = NUCLEOTIDES.values()
+
+"""
+Usage: CODE_COUNTS[codes]
+Columns of WMM_STANDARD_COUNT indexed by the code of each nucleotide
+PADDING_CODE counts as no nucleotide at all
+"""
+CODE_COUNTS = numpy.vstack((WMM_STANDARD_COUNT.T, numpy.zeros(4)))
+
+"""
+Usage: BASE_COUNTS[bases]
+Columns of WMM_STANDARD_COUNT indexed by the byte of each IUPAC nucleotide
+Any other byte counts as no nucleotide at all
+"""
+BASE_COUNTS = CODE_COUNTS[BASE_CODES]
+
+"""
+IUPAC nucleotides and their complements
+"""
+COMPLEMENTS = {
+    'A': 'T', 'C': 'G', 'G': 'C', 'T': 'A',
+    'R': 'Y', 'Y': 'R', 'K': 'M', 'M': 'K',
+    'B': 'V', 'D': 'H', 'H': 'D', 'V': 'B'}
+
+"""
+Usage: sequence.translate(COMPLEMENT_TABLE)
+Complements each nucleotide of a sequence and uppercases everything else
+COMPLEMENT_UNICODE_TABLE does the same for unicode sequences, except for the uppercasing
+"""
+COMPLEMENT_TABLE = ''.join([COMPLEMENTS.get(chr(byte), chr(byte).upper()) for byte in range(256)])
+COMPLEMENT_UNICODE_TABLE = dict([(ord(base), unicode(complement)) for base, complement in COMPLEMENTS.items()])
+
 #####################
 ## SAM File Fields ##
 #####################
@@ -83,13 +130,19 @@ Indicates if the sequence was a reverse complement
 """
 SAM_TRANSFORMED_REV_COMP_FLAG_MASK = 0x1000
 
+"""
+IUPAC nucleotides that might be an A (or a T)
+Note: This is extremely lenient and counts uncertain A's as part of the tail
+"""
+POLY_A_BASES = 'ARWMDHVN'
+POLY_T_BASES = 'TYWKBDHN'
+
 """
 Usage: POLY_A_TAIL_SEARCH_REGEX.search(data[SAM_SEQ])
 Finds the poly-A tail of the given sequence
-Note: This is extremely lenient and counts uncertain A's as part of the tail
 """
-POLY_A_TAIL_SEARCH_REGEX = re.compile(r"([ARWMDHVN]+)$")
-POLY_T_TAIL_SEARCH_REGEX = re.compile(r"^([TYWKBDHN]+)")
+POLY_A_TAIL_SEARCH_REGEX = re.compile(r"([%s]+)$" % POLY_A_BASES)
+POLY_T_TAIL_SEARCH_REGEX = re.compile(r"^([%s]+)" % POLY_T_BASES)
 
 """
 Usage: MISMATCH_SEARCH_REGEX.findall(data[SAM_MSMAT])
@@ -103,106 +156,83 @@ def assert_is_json_file(filename):
 
 def json_generator(filename):
     """
-    Opens a processed SAM file that was exported in JSON
+    Opens a processed SAM file that was exported in JSON (which may be compressed, see open_stream)
     And iterates over the values and returns the decoded JSON
     """
 
-    with open(filename, 'r') as file:
+    with open_stream(filename) as file:
         for line in file:
             yield json.loads(line)
 
 def complement_sequence(sequence):
     """
     Takes a nucleotide sequence and complements it
+    Anything that is not an uppercase nucleotide is uppercased
     """
 
-    # Replace nucleotides with a lowercase nucleotide (to prevent re-replacement)
-    sequence = sequence.replace('A', 't')
-    sequence = sequence.replace('C', 'g')
-    sequence = sequence.replace('G', 'c')
-    sequence = sequence.replace('T', 'a')
-    sequence = sequence.replace('R', 'y')
-    sequence = sequence.replace('Y', 'r')
-    sequence = sequence.replace('K', 'm')
-    sequence = sequence.replace('M', 'k')
-    sequence = sequence.replace('B', 'v')
-    sequence = sequence.replace('D', 'h')
-    sequence = sequence.replace('H', 'd')
-    sequence = sequence.replace('V', 'b')
+    if isinstance(sequence, unicode):
+        return sequence.translate(COMPLEMENT_UNICODE_TABLE).upper()
+    return sequence.translate(COMPLEMENT_TABLE)
+
+def encode_sequence(sequence):
+    """
+    Converts a sequence into a NumPy array of nucleotide codes (see BASE_CODES)
+    """
 
-    # Uppercase the replaced string
-    return sequence.upper()
+    if isinstance(sequence, unicode):
+        sequence = sequence.encode('ascii', 'replace')
+    return BASE_CODES.take(numpy.frombuffer(sequence, dtype=numpy.uint8))
+
+def encode_sequences(sequences):
+    """
+    Converts a batch of sequences into a matrix of nucleotide codes (see BASE_CODES)
+        with one row per sequence, padded at the end with PADDING_CODE
+    Returns a tuple of (matrix of codes, NumPy array of the length of each sequence)
+    """
+
+    lengths = numpy.array([len(sequence) for sequence in sequences], dtype=int)
+    codes = numpy.empty((len(sequences), numpy.max(lengths) if len(sequences) > 0 else 0), dtype=numpy.uint8)
+    codes.fill(PADDING_CODE)
+
+    # Scatter the bases of every sequence into its row at once
+    inside = numpy.arange(codes.shape[1]) < lengths[:, None]
+    codes[inside] = encode_sequence(''.join(sequences))
+    return codes, lengths
 
 def matrixify_sequence(sequence):
     """
     Converts a sequence into a 4 by N matrix of nucleotides to sequence position
+    Also takes the nucleotide codes of a sequence (see encode_sequence)
+        or of a batch of sequences (see encode_sequences), which returns a batch of matrices
     """
 
-    # Flatten the sequence into a 15 by N matrix
-    flattened = numpy.zeros((len(NUCLEOTIDES), len(sequence)))
-    for index in range(len(sequence)):
-        base = sequence[index]
-        flattened[NUCLEOTIDES[base], index] = 1
+    if isinstance(sequence, basestring):
+        sequence = encode_sequence(sequence)
 
     # Convert the 15 IUPAC nucleotides into the 4 canonical ones
-    return numpy.dot(WMM_STANDARD_COUNT, flattened)
+    return numpy.rollaxis(CODE_COUNTS[sequence], -1, -2)
 
-COUNT_AGGREGATOR_CACHE = {}
-def get_wmm_count_aggregator(seqLen=None, probabilities=None):
+def count_wmm_windows(sequence, width=WMM_LENGTH, probabilities=None):
     """
-    If a sequence length is provided, 
-        returns a sequence length by WMM_LENGTH matrix 
-            used to aggregate nucleotide counts into a WMM
-    If a probability array is provided,
-        returns a len(probabilities) by WMM_LENGTH matrix 
-            used to aggregate weighted nucleotide counts into a WMM
+    Aggregates the nucleotides of every window of the given width of a matrixified sequence
+        (See: matrixify_sequence(...)) into a WMM
+    If a probability array is provided (one per window),
+        each window is weighted by its probability
+    Returns a 4 by width matrix
     """
 
-    
-    if seqLen is not None:
-        # Generating the aggregator matrix might be expensive, 
-        #   so cache it for each supplied length
-        if seqLen in COUNT_AGGREGATOR_CACHE:
-            return COUNT_AGGREGATOR_CACHE[seqLen]
-            
-        probabilities = numpy.ones(seqLen)
-    
-    elif probabilities is not None:
-        probabilities = numpy.reshape(probabilities, (-1))
-        
-    else:
-        print 'Either "seqLen" or "probabilities" must be provided'
-        exit()
+    numWindows = sequence.shape[1] - width + 1
+    if probabilities is None:
+        probabilities = numpy.ones(max(numWindows, 0))
+    probabilities = numpy.reshape(probabilities, (-1))
+    assert len(probabilities) == max(numWindows, 0), "Expected a probability for each window"
+
+    # Each position of the WMM sees the same windows, shifted along by its index
+    counts = numpy.zeros((4, width))
+    for index in range(width):
+        counts[:, index] = numpy.dot(sequence[:, index:(index + len(probabilities))], probabilities)
+    return counts
 
-    '''
-    Construct a matrix that looks like:
-    | 1 0 0 0 0 0 |
-    | 1 1 0 0 0 0 |
-    | 1 1 1 0 0 0 |
-    | 1 1 1 1 0 0 |
-    | 1 1 1 1 1 0 |
-    | 1 1 1 1 1 1 |
-    |     ...     |
-    | 1 1 1 1 1 1 |
-    | 0 1 1 1 1 1 |
-    | 0 0 1 1 1 1 |
-    | 0 0 0 1 1 1 |
-    | 0 0 0 0 1 1 |
-    | 0 0 0 0 0 1 |
-    Where the 1's correspond to the passed in probability matrix
-    '''
-    probRows = numpy.size(probabilities)
-    numRows = probRows + WMM_LENGTH - 1
-    aggregator = numpy.zeros((numRows, WMM_LENGTH))
-    for index in range(0, WMM_LENGTH):
-        aggregator[index:(index + probRows), index] = probabilities
-    
-    # For the count aggregator, store the result since it can be reused
-    if seqLen is not None:
-        COUNT_AGGREGATOR_CACHE[seqLen] = aggregator
-        
-    return aggregator
-    
 def normalize_wmm(wmm):
     """
     Normalizes and returns the provided Weight Matrix Model
@@ -211,7 +241,7 @@ def normalize_wmm(wmm):
     """
     
     wmm = numpy.array(wmm)
-    assert wmm.shape[1] == WMM_LENGTH, "Weight matrix model must have %d columns" % WMM_LENGTH
+    assert wmm.ndim == 2 and wmm.shape[0] == 4, "Weight matrix model must have 4 rows"
     
     return wmm / numpy.sum(wmm, 0)
     
@@ -219,7 +249,7 @@ def apply_wmm_to_sequence(wmm, sequence):
     """
     Applies the given WMM to the given matrixified sequence 
         (See: matrixify_sequence(...))
-    Returns a Numpy array of length sequence.shape()[1] - WMM_LENGTH + 1
+    Returns a Numpy array of length sequence.shape()[1] - wmm.shape[1] + 1
         where each probabiltity corresponds to the probability 
         of the WMM matching the sequence at that index
     """
@@ -244,11 +274,57 @@ def apply_wmm_to_sequence(wmm, sequence):
     '''
     scores = numpy.dot(numpy.transpose(sequence), wmm)
     
-    resultLength = scores.shape[0] - WMM_LENGTH + 1
+    resultLength = scores.shape[0] - wmm.shape[1] + 1
     assert resultLength > 0, "Not enough data to apply the WMM against"
     
     # Shift and combine the columns upwards
     probabilities = scores[0:resultLength, 0]
-    for index in range(1, WMM_LENGTH):
+    for index in range(1, wmm.shape[1]):
         probabilities *= scores[index:(index + resultLength), index]
     return probabilities
+
+def get_log_wmm_table(wmm):
+    """
+    Precomputes the log probability of each nucleotide code (see BASE_CODES) at each position of the WMM
+    Returns a len(CODE_COUNTS) by wmm.shape[1] matrix, where PADDING_CODE scores -inf
+    """
+
+    with numpy.errstate(divide='ignore'):
+        return numpy.log(numpy.dot(CODE_COUNTS, wmm))
+
+def get_log_odds_table(wmm, background):
+    """
+    Precomputes the log of the ratio between the given WMM and background model
+        for each nucleotide code (see BASE_CODES) at each position of the WMM
+    A background with a single column applies to every position
+    Returns a len(CODE_COUNTS) by wmm.shape[1] matrix, where PADDING_CODE scores -inf
+    """
+
+    assert background.shape[1] in [1, wmm.shape[1]], \
+        "Background model must have 1 or %d columns, like the WMM" % wmm.shape[1]
+    with numpy.errstate(invalid='ignore'):
+        table = get_log_wmm_table(wmm) - get_log_wmm_table(background)
+    table[PADDING_CODE] = -numpy.inf
+    return table
+
+def apply_log_odds_to_sequences(table, codes, lengths):
+    """
+    Applies the given log odds table (see get_log_odds_table)
+        to a batch of sequences (see encode_sequences) of the given lengths
+    Same as numpy.log(apply_wmm_to_sequence(wmm, ...) / apply_wmm_to_sequence(background, ...))
+        but adds up logs instead of multiplying probabilities, for every sequence at once
+    Returns a matrix with a row per sequence and a column per window of the longest sequence
+        where windows that do not fit inside a sequence score -inf
+    A stack of tables (i.e. numpy.array([table, ...])) returns a stack of matrices, one per table
+    """
+
+    width = table.shape[-1]
+    numWindows = max(codes.shape[1] - width + 1, 0)
+
+    # Slide the WMM along every sequence at once, one position at a time
+    scores = numpy.zeros(table.shape[:-2] + (codes.shape[0], numWindows))
+    with numpy.errstate(invalid='ignore'):
+        for index in range(width):
+            scores += table[..., codes[:, index:(index + numWindows)], index]
+
+    return numpy.where(numpy.arange(numWindows) > lengths[:, None] - width, -numpy.inf, scores)
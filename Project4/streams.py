@@ -0,0 +1,305 @@
+import os
+import zlib
+import struct
+import multiprocessing
+
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
+"""
+File extension of gzip compressed files, i.e. all.sam.gz
+  Files written with this extension are BGZF files, which any gzip reader can also read
+"""
+GZIP_FILE = '.gz'
+
+"""
+Number of bytes compressed into each block of a BGZF file
+  So that a block is never bigger than 64 KB once compressed, like samtools
+"""
+BGZF_BLOCK_SIZE = 0xff00
+
+"""
+The empty block at the end of every BGZF file
+"""
+BGZF_EOF = '1f8b08040000000000ff0600424302001b0003000000000000000000'.decode('hex')
+
+"""
+Level of compression of written BGZF files
+"""
+GZIP_LEVEL = 6
+
+"""
+Number of compressed bytes read (or uncompressed bytes written) at a time
+  Each is inflated (or deflated) in one go by a background thread
+"""
+GZIP_CHUNK_SIZE = 2**20
+
+"""
+Number of background threads inflating or deflating the blocks of a BGZF file at once
+  zlib lets go of the interpreter while it works, so the threads run at the same time
+"""
+GZIP_THREADS = min(4, multiprocessing.cpu_count())
+
+"""
+Number of chunks (see GZIP_CHUNK_SIZE) the background threads may work on ahead of the reader or writer
+"""
+GZIP_PREFETCH = 8
+
+def split_extension(filename):
+    """
+    Splits the given filename into its root and extension, like os.path.splitext(...)
+        but ignoring any GZIP_FILE extension, i.e. ('all', '.sam') for all.sam.gz
+    """
+
+    if filename.endswith(GZIP_FILE):
+        filename = filename[:-len(GZIP_FILE)]
+    return os.path.splitext(filename)
+
+def open_stream(filename, mode='rb'):
+    """
+    Opens the given file for reading or writing, like open(...)
+    Files with the GZIP_FILE extension are decompressed as they are read (see GzipReader)
+        or compressed into BGZF as they are written (see BGZFWriter)
+    """
+
+    if not filename.endswith(GZIP_FILE):
+        return open(filename, mode)
+    elif 'r' in mode:
+        return GzipReader(filename)
+    return BGZFWriter(filename)
+
+def _bgzf_block_size(data, offset):
+    """
+    Helper for GzipReader
+    Finds the size of the BGZF block starting at the given offset of the data, given in its header
+    Returns None if the data ends before the header does, or if the block is not a BGZF block
+    """
+
+    if len(data) < offset + 12 or data[offset:(offset + 4)] != '\x1f\x8b\x08\x04':
+        return None
+    extraEnd = offset + 12 + struct.unpack_from('<H', data, offset + 10)[0]
+    position = offset + 12
+    while position + 4 <= min(extraEnd, len(data)):
+        length = struct.unpack_from('<H', data, position + 2)[0]
+        if data[position:(position + 2)] == 'BC' and length == 2 and position + 6 <= len(data):
+            return struct.unpack_from('<H', data, position + 4)[0] + 1
+        position += 4 + length
+    return None
+
+def _inflate_bgzf(data):
+    """
+    Helper for GzipReader
+    Inflates a string of whole BGZF blocks, checking the length and CRC of each
+    """
+
+    pieces = []
+    offset = 0
+    while offset < len(data):
+        blockSize = _bgzf_block_size(data, offset)
+        extraLength = struct.unpack_from('<H', data, offset + 10)[0]
+        piece = zlib.decompressobj(-zlib.MAX_WBITS).decompress(
+            data[(offset + 12 + extraLength):(offset + blockSize - 8)])
+        crc, length = struct.unpack_from('<II', data, offset + blockSize - 8)
+        assert len(piece) == length and zlib.crc32(piece) & 0xffffffff == crc, 'Corrupt BGZF block'
+        pieces.append(piece)
+        offset += blockSize
+    return ''.join(pieces)
+
+def _deflate_bgzf(data):
+    """
+    Helper for BGZFWriter
+    Deflates the data into BGZF blocks of BGZF_BLOCK_SIZE bytes before compression
+    """
+
+    blocks = []
+    for start in range(0, len(data), BGZF_BLOCK_SIZE):
+        block = data[start:(start + BGZF_BLOCK_SIZE)]
+        deflater = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS)
+        compressed = deflater.compress(block) + deflater.flush()
+        blocks.append(struct.pack('<BBBBIBBHBBHH', 31, 139, 8, 4, 0, 0, 255, 6, ord('B'), ord('C'), 2,
+                                  len(compressed) + 25))
+        blocks.append(compressed)
+        blocks.append(struct.pack('<II', zlib.crc32(block) & 0xffffffff, len(block)))
+    return ''.join(blocks)
+
+class GzipReader(object):
+    """
+    Reads a gzip file, inflating it ahead of the reader in background threads
+    A BGZF file is read in chunks of whole blocks, which several threads inflate at once
+        while any other gzip file is inflated in order by one thread
+    Supports read(...), readline(), and iterating over lines, like a file opened with open(...)
+    """
+
+    def __init__(self, filename):
+        self.name = filename
+        self.file = open(filename, 'rb')
+        self.compressed = ''
+        self.pending = deque()
+        self.buffer = ''
+        self.position = 0
+
+        # Only the blocks of a BGZF file can be inflated on their own
+        self.bgzf = _bgzf_block_size(self.file.read(18), 0) is not None
+        self.file.seek(0)
+        self.inflater = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.pool = ThreadPool(GZIP_THREADS if self.bgzf else 1)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def __iter__(self):
+        while True:
+            line = self.readline()
+            if not line:
+                return
+            yield line
+
+    def _inflate_gzip(self, data):
+        """
+        Helper for GzipReader
+        Inflates the next chunk of a gzip file, which might hold the end of one member and the start of another
+        """
+
+        pieces = []
+        while data:
+            pieces.append(self.inflater.decompress(data))
+            data = self.inflater.unused_data
+            if data:
+                self.inflater = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        return ''.join(pieces)
+
+    def _next_piece(self):
+        """
+        Helper for GzipReader
+        Keeps the background threads GZIP_PREFETCH chunks ahead
+        Returns the next piece of the inflated file, or None at the end of the file
+        """
+
+        while len(self.pending) < GZIP_PREFETCH:
+            chunk = self.file.read(GZIP_CHUNK_SIZE)
+            if not chunk:
+                assert not self.compressed, 'File "%s" is truncated or not BGZF' % self.name
+                break
+
+            if not self.bgzf:
+                self.pending.append(self.pool.apply_async(self._inflate_gzip, (chunk,)))
+                continue
+
+            # Cut the chunk after its last whole block, keeping the rest for the next chunk
+            data = self.compressed + chunk
+            end = 0
+            blockSize = _bgzf_block_size(data, end)
+            while blockSize is not None and end + blockSize <= len(data):
+                end += blockSize
+                blockSize = _bgzf_block_size(data, end)
+            self.compressed = data[end:]
+            if end > 0:
+                self.pending.append(self.pool.apply_async(_inflate_bgzf, (data[:end],)))
+
+        if not self.pending:
+            return None
+        return self.pending.popleft().get()
+
+    def read(self, size=-1):
+        pieces = [self.buffer[self.position:]]
+        length = len(pieces[0])
+        while size < 0 or length < size:
+            piece = self._next_piece()
+            if piece is None:
+                break
+            pieces.append(piece)
+            length += len(piece)
+
+        self.buffer = ''.join(pieces)
+        self.position = length if size < 0 else min(size, length)
+        return self.buffer[:self.position]
+
+    def readline(self):
+        searched = self.position
+        end = self.buffer.find('\n', searched)
+        while end < 0:
+            piece = self._next_piece()
+            if piece is None:
+                end = len(self.buffer) - 1
+                break
+            self.buffer = self.buffer[self.position:] + piece
+            searched = len(self.buffer) - len(piece)
+            self.position = 0
+            end = self.buffer.find('\n', searched)
+
+        line = self.buffer[self.position:(end + 1)]
+        self.position = end + 1
+        return line
+
+    def seek(self, offset):
+        # Compressed files can only be read from the start
+        assert offset == 0 and self.file.tell() == 0, 'File "%s" can only be read from the start' % self.name
+
+    def close(self):
+        self.pool.terminate()
+        self.file.close()
+
+class BGZFWriter(object):
+    """
+    Writes a BGZF file, deflating its blocks (see BGZF_BLOCK_SIZE) in background threads
+    Supports write(...), writelines(...), tell() (counting bytes before compression), and close()
+        like a file opened with open(...)
+    """
+
+    def __init__(self, filename):
+        self.name = filename
+        self.file = open(filename, 'wb')
+        self.pieces = []
+        self.length = 0
+        self.position = 0
+        self.pending = deque()
+        self.pool = ThreadPool(GZIP_THREADS)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def _flush(self, limit):
+        """
+        Helper for BGZFWriter
+        Hands the whole blocks written so far to the background threads (or every byte, at the end)
+            and writes out the deflated blocks of all but the last given number of chunks
+        """
+
+        data = ''.join(self.pieces)
+        end = len(data) if limit == 0 else len(data) - len(data) % BGZF_BLOCK_SIZE
+        if end > 0:
+            self.pending.append(self.pool.apply_async(_deflate_bgzf, (data[:end],)))
+        self.pieces = [data[end:]]
+        self.length = len(data) - end
+
+        while len(self.pending) > limit:
+            self.file.write(self.pending.popleft().get())
+
+    def write(self, data):
+        self.pieces.append(data)
+        self.length += len(data)
+        self.position += len(data)
+        if self.length >= GZIP_CHUNK_SIZE:
+            self._flush(GZIP_PREFETCH)
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def tell(self):
+        return self.position
+
+    def close(self):
+        if self.file.closed:
+            return
+        self._flush(0)
+        self.file.write(BGZF_EOF)
+        self.file.close()
+        self.pool.close()
+        self.pool.join()